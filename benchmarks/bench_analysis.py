@@ -0,0 +1,62 @@
+# Critical-path analysis and makespan prediction on a large random DAG.
+# Times are the best of --repeat runs, and each pass is also given as a
+# multiple of one graphlib topological sort of the same graph, which keeps
+# the figures comparable across machines. Both passes should come in under
+# 1.0 there.
+#
+#   PYTHONPATH=src python benchmarks/bench_analysis.py --nodes 100000
+import argparse
+import graphlib
+import json
+import random
+import sys
+import time
+
+from wfrcwflib.analysis import critical_path, predict_makespan
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--nodes", type=int, default=100000)
+    p.add_argument("--fan-in", type=int, default=3)
+    p.add_argument("--workers", type=int, default=64)
+    p.add_argument("--repeat", type=int, default=3)
+    args = p.parse_args(argv)
+
+    rng = random.Random(0)
+    dag = {
+        f"s{i}": {f"s{j}" for j in rng.sample(range(i), min(i, args.fan_in))}
+        for i in range(args.nodes)
+    }
+    runtimes = {f"s{i}": rng.uniform(1, 100) for i in range(args.nodes)}
+
+    def best(f):
+        seconds = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = f()
+            seconds.append(time.perf_counter() - start)
+        return result, min(seconds)
+
+    # For scale: one topological sort with the standard library
+    _, graphlib_seconds = best(
+        lambda: list(graphlib.TopologicalSorter(dag).static_order()))
+    cp, cp_seconds = best(lambda: critical_path(dag, runtimes))
+    makespan, makespan_seconds = best(
+        lambda: predict_makespan(dag, runtimes, args.workers))
+
+    json.dump({
+        "nodes": args.nodes,
+        "graphlib_static_order_seconds": graphlib_seconds,
+        "critical_path_length": cp.length,
+        "critical_path_steps": len(cp.path),
+        "critical_path_seconds": cp_seconds,
+        "critical_path_vs_graphlib": cp_seconds / graphlib_seconds,
+        "workers": args.workers,
+        "predicted_makespan": makespan,
+        "predict_makespan_seconds": makespan_seconds,
+        "predict_makespan_vs_graphlib": makespan_seconds / graphlib_seconds,
+    }, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
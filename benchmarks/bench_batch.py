@@ -0,0 +1,50 @@
+# Per-job launch overhead of tiny commands, one subprocess each versus
+# batched through one shell.
+#
+#   PYTHONPATH=src python benchmarks/bench_batch.py --jobs 10000
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from wfrcwflib.workflow import (
+    InputConnector, PositionalArgument,
+    Step, WorkflowFile, RunnableCommand,
+)
+from wfrcwflib.command import run_batch
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--jobs", type=int, default=10000)
+    p.add_argument("--batch-size", type=int, default=500)
+    args = p.parse_args(argv)
+
+    step = Step("touch", "true", [PositionalArgument(InputConnector(".txt"))])
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        commands = [
+            RunnableCommand(step, tmp, {".txt": WorkflowFile(tmp, f"s{i}", ".txt")})
+            for i in range(args.jobs)
+        ]
+        start = time.perf_counter()
+        for command in commands:
+            command.run()
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(0, len(commands), args.batch_size):
+            run_batch(commands[i:i + args.batch_size])
+        batched = time.perf_counter() - start
+
+    json.dump({
+        "jobs": args.jobs,
+        "batch_size": args.batch_size,
+        "per_job_ms_single": single / args.jobs * 1e3,
+        "per_job_ms_batched": batched / args.jobs * 1e3,
+    }, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
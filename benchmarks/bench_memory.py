@@ -0,0 +1,95 @@
+# Bytes per step for the argument/connector representation.
+#
+#   PYTHONPATH=src python benchmarks/bench_memory.py --steps 100000
+#
+# "before" rebuilds the original layout (plain dataclasses with a __dict__
+# and a fresh connector and ext string per use) for comparison.
+import argparse
+import json
+import sys
+import tracemalloc
+from dataclasses import dataclass, field
+
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector,
+    PositionalArgument, OptionalArgument,
+    Step,
+)
+
+@dataclass
+class OldConnector:
+    ext: str
+
+class OldInputConnector(OldConnector):
+    pass
+
+class OldOutputConnector(OldConnector):
+    pass
+
+@dataclass
+class OldPositionalArgument:
+    value: object
+
+@dataclass
+class OldOptionalArgument:
+    flag: str
+    values: list = field(default_factory=list)
+
+@dataclass
+class OldStep:
+    name: str
+    prog: str
+    args: list = field(default_factory=list)
+    stdout: object = None
+
+def ext(s):
+    # Parsed strings are fresh objects, not the literals in this file
+    return "".join(list(s))
+
+def build_before(n):
+    return [
+        OldStep(f"s{i}", "bwa", [
+            OldPositionalArgument("mem"),
+            OldOptionalArgument("-t", ["4"]),
+            OldPositionalArgument(OldInputConnector(ext(".bwt"))),
+            OldPositionalArgument(OldInputConnector(ext(".fastq"))),
+            OldOptionalArgument("-o", [OldOutputConnector(ext(".sam"))]),
+        ])
+        for i in range(n)
+    ]
+
+def build_after(n):
+    return [
+        Step(f"s{i}", "bwa", [
+            PositionalArgument("mem"),
+            OptionalArgument("-t", ["4"]),
+            PositionalArgument(InputConnector.shared(ext(".bwt"))),
+            PositionalArgument(InputConnector.shared(ext(".fastq"))),
+            OptionalArgument("-o", [OutputConnector.shared(ext(".sam"))]),
+        ])
+        for i in range(n)
+    ]
+
+def measure(build, n):
+    tracemalloc.start()
+    objs = build(n)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return current / n
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--steps", type=int, default=100_000)
+    args = p.parse_args(argv)
+    before = measure(build_before, args.steps)
+    after = measure(build_after, args.steps)
+    json.dump({
+        "steps": args.steps,
+        "bytes_per_step_before": round(before),
+        "bytes_per_step_after": round(after),
+    }, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Compares the table-driven parser behind parse() with the original
+# line-splitting parser built on next_token().
+#
+#   PYTHONPATH=src python benchmarks/bench_parse.py --steps 5000
+import argparse
+import json
+import sys
+import time
+
+from wfrcwflib.parse import parse, parse_paragraphs
+
+def make_library(n_steps, n_connections):
+    lines = []
+    for i in range(n_steps):
+        lines += [
+            f"step s{i}  # generated",
+            "  bwa",
+            "  mem",
+            "  -t 4 -k 19",
+            "  { input .bwt }",
+            "  { input .fastq }",
+            "  -o { output .sam }",
+            "",
+        ]
+    lines.append("workflow generated")
+    for i in range(n_connections):
+        lines.append(f"  s{i} .sam --> s{i + 1} .fastq")
+    return lines
+
+def measure(fn, lines, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in fn(lines):
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--steps", type=int, default=5000)
+    p.add_argument("--connections", type=int, default=5000)
+    p.add_argument("--repeat", type=int, default=5)
+    args = p.parse_args(argv)
+
+    lines = make_library(args.steps, args.connections)
+    assert list(parse(lines)) == list(parse_paragraphs(lines))
+    results = {
+        "lines": len(lines),
+        "state_machine": measure(parse, lines, args.repeat),
+        "next_token": measure(parse_paragraphs, lines, args.repeat),
+    }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Staging and hashing throughput on large files, by staging method.
+#
+#   PYTHONPATH=src python benchmarks/bench_stage.py --files 8 --size-mb 512
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from wfrcwflib.workflow import WorkflowFile
+from wfrcwflib.stage import Stager
+
+def read_digest(path, chunk_size=1 << 20):
+    # The old file_digest, for comparison
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=8)
+    p.add_argument("--size-mb", type=int, default=256)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--dir", default=None, help="where to write test files")
+    args = p.parse_args(argv)
+
+    results = {"files": args.files, "size_mb": args.size_mb}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        tmp = Path(tmp)
+        src = tmp / "src"
+        src.mkdir()
+        block = os.urandom(1 << 20)
+        files = []
+        for i in range(args.files):
+            with open(src / f"s{i}.fastq", "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(block)
+            files.append(WorkflowFile(src, f"s{i}", ".fastq"))
+
+        for method in ["hardlink", "reflink", "copy"]:
+            stager = Stager(tmp / method, methods=(method,), max_workers=args.workers)
+            try:
+                stager.stage(files)
+                results[f"{method}_mb_per_second"] = stager.staged.rate
+            except OSError as e:
+                results[f"{method}_mb_per_second"] = f"unsupported: {e}"
+
+        paths = [f.path for f in files]
+        stager = Stager(tmp / "hash", max_workers=1)
+        start = time.perf_counter()
+        for path in paths:
+            read_digest(path)
+        results["read_digest_serial_mb_per_second"] = \
+            args.files * args.size_mb * 1.048576 / (time.perf_counter() - start)
+        stager.digest(paths)
+        results["mmap_digest_serial_mb_per_second"] = stager.hashed.rate
+        stager = Stager(tmp / "hash", max_workers=args.workers)
+        stager.digest(paths)
+        results["mmap_digest_parallel_mb_per_second"] = stager.hashed.rate
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
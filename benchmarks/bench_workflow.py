@@ -0,0 +1,156 @@
+# Benchmarks for the workflow graph layer.
+#
+#   PYTHONPATH=src python benchmarks/bench_workflow.py --output new.json
+#   PYTHONPATH=src python benchmarks/bench_workflow.py --compare old.json
+#
+# Results are written as JSON so runs from two commits can be compared.
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector,
+    PositionalArgument,
+    Step, Workflow, UnresolvedWorkflow,
+)
+
+def make_step(name):
+    return Step(name, "cat", [
+        PositionalArgument(InputConnector(".a")),
+        PositionalArgument(InputConnector(".b")),
+        PositionalArgument(OutputConnector(".out")),
+    ])
+
+def make_registry(n):
+    return {f"s{i}": make_step(f"s{i}") for i in range(n)}
+
+def chain_connections(n):
+    for i in range(1, n):
+        yield (f"s{i-1}", ".out", f"s{i}", ".a")
+
+def fanout_connections(n):
+    for i in range(1, n):
+        yield ("s0", ".out", f"s{i}", ".a")
+
+def diamond_connections(n):
+    # Blocks of four steps: top -> (left, right) -> bottom, with each
+    # block's bottom feeding the next block's top.
+    for top in range(0, n - 3, 4):
+        left, right, bottom = top + 1, top + 2, top + 3
+        yield (f"s{top}", ".out", f"s{left}", ".a")
+        yield (f"s{top}", ".out", f"s{right}", ".a")
+        yield (f"s{left}", ".out", f"s{bottom}", ".a")
+        yield (f"s{right}", ".out", f"s{bottom}", ".b")
+        if bottom + 1 < n:
+            yield (f"s{bottom}", ".out", f"s{bottom + 1}", ".a")
+
+shapes = {
+    "chain": chain_connections,
+    "fanout": fanout_connections,
+    "diamond": diamond_connections,
+}
+
+def build(registry, connections):
+    w = Workflow("bench", registry)
+    for args in connections:
+        w.connect(*args)
+    return w
+
+def operations(registry, connections):
+    w = build(registry, connections)
+    uw = UnresolvedWorkflow("bench", connections)
+    return {
+        "connect": lambda: build(registry, connections),
+        "connections_out": lambda: w.connections_out,
+        "inputs": lambda: list(w.inputs),
+        "outputs": lambda: list(w.outputs),
+        "dag": lambda: w.dag,
+        "order": lambda: w.order,
+        "resolve": lambda: uw.resolve(registry),
+    }
+
+def measure(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+def run(sizes, shape_names, repeat):
+    results = []
+    for shape in shape_names:
+        for n in sizes:
+            registry = make_registry(n)
+            connections = list(shapes[shape](n))
+            ops = operations(registry, connections)
+            for op, fn in ops.items():
+                # Keep any output from the code under test off the report
+                with open(os.devnull, "w") as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    seconds, peak = measure(fn, repeat)
+                results.append({
+                    "shape": shape, "steps": n, "op": op,
+                    "seconds": seconds, "peak_bytes": peak,
+                })
+                print(
+                    f"{shape:8} {n:>7} {op:16} {seconds * 1e3:10.3f} ms "
+                    f"{peak / 1024:10.1f} KiB", file=sys.stderr)
+    return {"commit": git_commit(), "results": results}
+
+def compare(old, new):
+    def key(r):
+        return (r["shape"], r["steps"], r["op"])
+    baseline = {key(r): r for r in old["results"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    for r in new["results"]:
+        b = baseline.get(key(r))
+        if b is None:
+            continue
+        time_ratio = r["seconds"] / b["seconds"] if b["seconds"] else float("nan")
+        mem_ratio = r["peak_bytes"] / b["peak_bytes"] if b["peak_bytes"] else float("nan")
+        print(
+            f"{r['shape']:8} {r['steps']:>7} {r['op']:16} "
+            f"time x{time_ratio:6.2f}  mem x{mem_ratio:6.2f}")
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--sizes", default="10,1000,100000")
+    p.add_argument("--shapes", default=",".join(shapes))
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--output", help="write JSON results to this file")
+    p.add_argument("--compare", help="JSON results from an earlier run")
+    args = p.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    report = run(sizes, args.shapes.split(","), args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+from dataclasses import dataclass
+from typing import Sequence
+import collections
+import functools
+import graphlib
+import heapq
+import itertools
+import statistics
+
+
+# Works on any DAG in the form of Workflow.dag (node => {dependency, ...}),
+# with runtimes given per node. Nodes are numbered once up front so that
+# the passes below run over plain lists, and they only follow predecessor
+# lists, which is all a DAG in this form gives for free; successor lists
+# are built only for the makespan simulation, which needs them.
+
+def observations_from_spans(spans):
+    # step name => durations of its command spans, as a TimingTracer
+    # records them while a runner works
+    observed = collections.defaultdict(list)
+    for s in spans:
+        if s.name in ("command.run", "command.run_async") and \
+                s.duration is not None:
+            observed[s.attrs["step"]].append(s.duration)
+    return observed
+
+def estimate_runtimes(observed, statistic=statistics.median):
+    # step name => [duration, ...] to step name => expected runtime
+    return {
+        step: statistic(durations)
+        for step, durations in observed.items() if durations
+    }
+
+
+@dataclass
+class Graph:
+    nodes: list
+    weights: list[float]
+    preds: list[tuple[int, ...]]
+    # Node indexes in topological order
+    order: Sequence[int]
+
+    @classmethod
+    def from_dag(cls, dag, runtimes=None, default=None):
+        # Nodes without a runtime weigh default, which is the mean of the
+        # known runtimes (or 1 when none are known)
+        runtimes = runtimes or {}
+        if default is None:
+            known = [runtimes[n] for n in dag if n in runtimes]
+            default = statistics.fmean(known) if known else 1.0
+        nodes = list(dag)
+        index = dict(zip(nodes, range(len(nodes))))
+        lookup = index.__getitem__
+        # Tuples of ints drop out of the cyclic GC's tracking, lists never do
+        preds = [tuple(map(lookup, deps)) for deps in dag.values()]
+        weights = list(map(runtimes.get, nodes, itertools.repeat(default)))
+        graph = cls(nodes, weights, preds, range(len(nodes)))
+        # Graphs are usually listed dependencies first, which makes the
+        # listing itself a topological order; otherwise fall back to Kahn's
+        # algorithm. A self-loop fails the check too, and Kahn's catches it.
+        for i, ps in enumerate(preds):
+            if ps and max(ps) >= i:
+                break
+        else:
+            return graph
+        succs = graph.succs
+        indegree = list(map(len, preds))
+        order = [i for i, d in enumerate(indegree) if d == 0]
+        for i in order:
+            for s in succs[i]:
+                indegree[s] -= 1
+                if not indegree[s]:
+                    order.append(s)
+        if len(order) != len(nodes):
+            stuck = [nodes[i] for i, d in enumerate(indegree) if d]
+            raise graphlib.CycleError("nodes are in a cycle", stuck)
+        graph.order = order
+        return graph
+
+    @functools.cached_property
+    def succs(self):
+        succs = [[] for _ in self.nodes]
+        appends = [x.append for x in succs]
+        for i, ps in enumerate(self.preds):
+            for p in ps:
+                appends[p](i)
+        return succs
+
+    def bottom_levels(self):
+        # Longest path from each node to the end, counting the node itself.
+        # Each node's level is final once its successors, later in the
+        # order, have pushed theirs up to it.
+        weights = self.weights
+        preds = self.preds
+        levels = [0.0] * len(self.nodes)
+        below = [0.0] * len(self.nodes)
+        for i in reversed(self.order):
+            level = levels[i] = weights[i] + below[i]
+            for p in preds[i]:
+                if below[p] < level:
+                    below[p] = level
+        return levels
+
+    def earliest_starts(self):
+        weights = self.weights
+        preds = self.preds
+        starts = [0.0] * len(self.nodes)
+        finishes = [0.0] * len(self.nodes)
+        lookup = finishes.__getitem__
+        for i in self.order:
+            start = starts[i] = max(map(lookup, preds[i]), default=0.0)
+            finishes[i] = start + weights[i]
+        return starts
+
+
+@dataclass
+class CriticalPath:
+    # Makespan with unlimited workers, i.e. the length of the critical path
+    length: float
+    path: list
+    # node => time it can slip without delaying the whole graph
+    slack: dict
+    earliest_start: dict
+    latest_start: dict
+
+
+def upstream(dag, nodes):
+    # nodes and everything they depend on, directly or not
+    closure = set(nodes)
+    stack = list(closure)
+    while stack:
+        for dep in dag[stack.pop()]:
+            if dep not in closure:
+                closure.add(dep)
+                stack.append(dep)
+    return closure
+
+def bottom_levels(dag, runtimes=None, default=None):
+    graph = Graph.from_dag(dag, runtimes, default)
+    return dict(zip(graph.nodes, graph.bottom_levels()))
+
+def critical_path(dag, runtimes=None, default=None):
+    graph = Graph.from_dag(dag, runtimes, default)
+    nodes = graph.nodes
+    if not nodes:
+        return CriticalPath(0.0, [], {}, {}, {})
+    weights = graph.weights
+    es = graph.earliest_starts()
+    bl = graph.bottom_levels()
+    length = max(bl)
+    # A node's latest start leaves exactly its bottom level before the end
+    ls = [length - b for b in bl]
+    slack = [l - e for e, l in zip(es, ls)]
+    tolerance = 1e-9 * max(length, 1.0)
+    # Walk back from a critical sink along critical predecessors
+    i = max(
+        (i for i in range(len(nodes)) if slack[i] <= tolerance),
+        key=lambda i: es[i] + weights[i])
+    path = [i]
+    while True:
+        start = es[i]
+        critical = [
+            p for p in sorted(graph.preds[i])
+            if slack[p] <= tolerance and abs(es[p] + weights[p] - start) <= tolerance
+        ]
+        if not critical:
+            break
+        i = critical[0]
+        path.append(i)
+    path.reverse()
+    return CriticalPath(
+        length,
+        [nodes[i] for i in path],
+        dict(zip(nodes, slack)),
+        dict(zip(nodes, es)),
+        dict(zip(nodes, ls)),
+    )
+
+def predict_makespan(dag, runtimes=None, workers=1, samples=1, default=None):
+    # Simulates list scheduling of `samples` copies of the graph on
+    # `workers` identical workers, highest bottom level first and earlier
+    # samples first among equals, much as the runners schedule jobs
+    graph = Graph.from_dag(dag, runtimes, default)
+    n = len(graph.nodes)
+    if not n or samples < 1:
+        return 0.0
+    weights = graph.weights
+    succs = graph.succs
+    bl = graph.bottom_levels()
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+    indegree = [len(ps) for ps in graph.preds] * samples
+    ready = [
+        (-bl[i], k, i)
+        for k in range(samples) for i in range(n) if not graph.preds[i]
+    ]
+    heapq.heapify(ready)
+    running = []
+    free = workers
+    now = 0.0
+    while ready or running:
+        while free and ready:
+            _, k, i = heappop(ready)
+            heappush(running, (now + weights[i], k, i))
+            free -= 1
+        now, k, i = heappop(running)
+        free += 1
+        offset = k * n
+        for s in succs[i]:
+            indegree[offset + s] -= 1
+            if not indegree[offset + s]:
+                heappush(ready, (-bl[s], k, s))
+    return now
@@ -0,0 +1,188 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from wfrcwflib.stage import mmap_digest
+
+
+def file_digest(path, chunk_size=1 << 23):
+    # Same sha256 as reading the file in chunks, see stage.mmap_digest
+    return mmap_digest(path, chunk_size)
+
+
+def insert_rows(conn, sql, rows):
+    # Writes a batch of rows in one transaction, on a connection opened with
+    # isolation_level=None. BEGIN IMMEDIATE takes the database write lock up
+    # front, so concurrent runners sharing a database serialise here.
+    if not rows:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(sql, rows)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class DigestIndex:
+    # Stored digests are trusted as long as the file's stat signature
+    # (size, mtime_ns, inode) is unchanged, so only modified files are hashed.
+    def __init__(self, db_path, hasher=file_digest, timeout=30.0):
+        self.db_path = Path(db_path)
+        self.hasher = hasher
+        self.rehashed = 0
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.db_path, timeout=timeout, isolation_level=None,
+            check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "inode INTEGER, digest TEXT)")
+        # One bulk read on open keeps cold-start lookups in memory
+        rows = self._conn.execute(
+            "SELECT path, size, mtime_ns, inode, digest FROM digests")
+        self._entries = {r[0]: r[1:] for r in rows}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def is_current(self, path):
+        entry = self._entries.get(os.fspath(path))
+        return entry is not None and entry[:3] == self.signature(path)
+
+    def digest(self, path):
+        key = os.fspath(path)
+        signature = self.signature(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[:3] == signature:
+            return entry[3]
+        digest = self.hasher(path)
+        with self._lock:
+            self.rehashed += 1
+            self._entries[key] = self._dirty[key] = signature + (digest,)
+        return digest
+
+    def flush(self):
+        with self._lock:
+            rows = [(k,) + v for k, v in self._dirty.items()]
+            self._dirty.clear()
+        insert_rows(
+            self._conn, "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+            rows)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+@dataclass
+class RunCache:
+    manifest_path: Path
+    hasher: Callable[[Path], str] = file_digest
+    hits: int = 0
+    misses: int = 0
+    # When given, inputs are hashed through the index, which skips files
+    # whose stat signature is unchanged; it is flushed by save()
+    index: DigestIndex | None = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.entries = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(command):
+        return str(command.output_dir / command.output_basename)
+
+    def fingerprint(self, command):
+        h = hashlib.sha256()
+        h.update(repr(command.step).encode())
+        for arg in command.command_args():
+            h.update(arg.encode())
+            h.update(b"\0")
+        hasher = self.hasher if self.index is None else self.index.digest
+        for ext, input_file in sorted(command.input_files.items()):
+            h.update(ext.encode())
+            h.update(hasher(input_file.path).encode())
+        return h.hexdigest()
+
+    def is_current(self, command):
+        # A command found out of date stays so until it is recorded or the
+        # cache saved, as runners do at the end of a run, so a job checked
+        # while pruning to targets isn't hashed again when it is launched
+        key = self.key(command)
+        with self._lock:
+            if key in self._pending:
+                return False
+        fingerprint = self.fingerprint(command)
+        entry = self.entries.get(key)
+        current = (
+            entry is not None and
+            entry["fingerprint"] == fingerprint and
+            all(Path(fp).exists() for fp in entry["outputs"])
+        )
+        with self._lock:
+            if current:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._pending[key] = fingerprint
+        return current
+
+    def record(self, command):
+        key = self.key(command)
+        with self._lock:
+            fingerprint = self._pending.pop(key, None)
+        if fingerprint is None:
+            fingerprint = self.fingerprint(command)
+        outputs = [str(f.path) for _, f in command.output_files]
+        with self._lock:
+            self.entries[key] = {
+                "step": command.step.name,
+                "fingerprint": fingerprint,
+                "outputs": outputs,
+            }
+
+    def invalidate(self, step_name=None):
+        with self._lock:
+            if step_name is None:
+                self.entries.clear()
+            else:
+                self.entries = {
+                    k: v for k, v in self.entries.items()
+                    if v["step"] != step_name
+                }
+
+    def save(self):
+        if self.index is not None:
+            self.index.flush()
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with self._lock:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            self._pending.clear()
+        os.replace(tmp_path, self.manifest_path)
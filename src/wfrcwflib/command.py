@@ -1,9 +1,33 @@
 from typing import Optional
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import graphlib
+import hashlib
+import itertools
+import os
+import re
+import shlex
 import subprocess
 import collections
+import tempfile
+import time
 from pathlib import Path
 
+from wfrcwflib import tracing
+
+from wfrcwflib.workflow import CommandSpace, WorkflowError
+from wfrcwflib.cache import RunCache
+from wfrcwflib.conda import CondaEnvironments, command_environ
+from wfrcwflib.matrix import Sample
+from wfrcwflib.pipeline import (
+    Pipeline, fuse_pipes, job_commands, job_resources,
+)
+from wfrcwflib.schedule import Scheduler
+from wfrcwflib.analysis import upstream
+from wfrcwflib.history import RunHistory, wait_with_metrics
+from wfrcwflib.executor import Executor, Job, LocalExecutor
+
         
 class Project:
     def __init__(self, workflow, config, sources, output_dir):
@@ -19,19 +43,397 @@ class Project:
         self.sources[input] = source
 
         
+class CommandFailed(Exception):
+    def __init__(self, step_name, returncode, sample_name=None):
+        msg = f"step {step_name} exited with status {returncode}"
+        if sample_name is not None:
+            msg += f" for sample {sample_name}"
+        super().__init__(msg)
+        self.step_name = step_name
+        self.returncode = returncode
+        self.sample_name = sample_name
+
+
+def newer_than(inputs, outputs):
+    # Whether every output exists and is no older than every input
+    try:
+        newest_input = max(
+            (os.stat(p).st_mtime_ns for p in inputs), default=0)
+        oldest_output = min(
+            (os.stat(p).st_mtime_ns for p in outputs), default=None)
+    except FileNotFoundError:
+        return False
+    return oldest_output is not None and oldest_output >= newest_input
+
+def failure(job, procs):
+    # Like a shell with pipefail, report the last command of a pipeline that
+    # failed; upstream ones often just die of SIGPIPE when it exits
+    for command, proc in reversed(list(zip(job_commands(job), procs))):
+        if proc.returncode != 0:
+            return command.step.name, proc.returncode
+    return None
+
+
+class Targets:
+    # What a run was asked to build. (step, ext) outputs and step names are
+    # checked against the workflow up front; output paths, which each select
+    # the one sample producing them, once every sample has been seen.
+    def __init__(self, workflow, targets):
+        self.steps = set()
+        # absolute path => target as given
+        self.paths = {}
+        self.matched = set()
+        for target in targets:
+            if isinstance(target, tuple):
+                step_name, ext = target
+                if step_name not in workflow.dag or ext not in {
+                        o.ext for o in workflow.registry[step_name].outputs}:
+                    raise WorkflowError(f"{step_name} has no output {ext}")
+                self.steps.add(step_name)
+            elif isinstance(target, str) and target in workflow.registry:
+                if target not in workflow.dag:
+                    raise WorkflowError(
+                        f"step {target} is not in workflow {workflow.name}")
+                self.steps.add(target)
+            else:
+                self.paths[os.path.abspath(target)] = target
+
+    def steps_for(self, files):
+        steps = set(self.steps)
+        for path in self.paths:
+            key = files.producer(path)
+            if key is not None:
+                steps.add(key[0])
+                self.matched.add(path)
+        return steps
+
+    def check(self):
+        missing = [
+            str(target) for path, target in self.paths.items()
+            if path not in self.matched
+        ]
+        if missing:
+            raise WorkflowError(f"no sample produces {', '.join(missing)}")
+
+
+class SampleWindow:
+    # The samples a runner is working on, up to window at a time, each with
+    # a sorter over the jobs it still needs. Runners take the jobs that have
+    # become ready from ready(), report each one back to done() when it
+    # finishes, and yield the samples these hand back as finished.
+    def __init__(self, runner, workflow, samples, window=1, targets=None,
+                 force=False):
+        self.runner = runner
+        self.workflow = workflow
+        self.dag, self.units = runner.plan(workflow)
+        self.space = CommandSpace(workflow, runner.intermediate_dir)
+        self.targets = None
+        if targets is not None:
+            self.targets = Targets(workflow, targets)
+        self.samples = iter(samples)
+        self.window = window
+        self.force = force
+        # sample index => (sample, sorter, commands, files)
+        self.active = {}
+        # Indexes of samples that may have newly ready jobs
+        self.touched = set()
+        self._admitted = itertools.count()
+
+    def __bool__(self):
+        return bool(self.active)
+
+    def admit(self):
+        while len(self.active) < self.window:
+            sample = next(self.samples, None)
+            if sample is None:
+                return
+            files = self.space.file_space(sample.sources)
+            sample_dag = self.dag
+            if self.targets is not None:
+                sample_dag = self.runner.prune(
+                    self.workflow, self.dag, self.units, files, self.targets,
+                    self.force)
+            ts = graphlib.TopologicalSorter(sample_dag)
+            ts.prepare()
+            idx = next(self._admitted)
+            self.active[idx] = (sample, ts, {}, files)
+            self.touched.add(idx)
+
+    def ready(self):
+        # Returns the newly ready jobs as (sample index, step name, job),
+        # and the samples that turned out to have nothing left to run as
+        # (sample, commands)
+        jobs = []
+        finished = []
+        for idx in sorted(self.touched):
+            sample, ts, commands, files = self.active[idx]
+            for step_name in ts.get_ready():
+                job = self.runner.make_job(
+                    self.workflow, self.units[step_name], files, commands)
+                jobs.append((idx, step_name, job))
+            if not ts.is_active():
+                # Nothing to run, the targets are up to date
+                del self.active[idx]
+                finished.append((sample, commands))
+        self.touched.clear()
+        return jobs, finished
+
+    def sample(self, idx):
+        return self.active[idx][0]
+
+    def done(self, idx, step_name):
+        # Returns (sample, commands) when this was the sample's last job
+        sample, ts, commands, _ = self.active[idx]
+        ts.done(step_name)
+        if ts.is_active():
+            self.touched.add(idx)
+            return None
+        del self.active[idx]
+        self.touched.discard(idx)
+        return sample, commands
+
+    def check(self):
+        # Once every sample has been through
+        if self.targets is not None:
+            self.targets.check()
+
+
 @dataclass
 class LocalRunner:
     intermediate_dir: Path
+    max_jobs: int = 1
+    cache: RunCache | None = None
+    batch_size: int = 1
+    # step name => conda env
+    conda_envs: dict[str, str] = field(default_factory=dict)
+    environments: CondaEnvironments | None = None
+    # Run stdout --> stdin connections as OS pipes, see fuse_pipes
+    pipes: bool = False
+    # Starts jobs as their cpus and memory fit, rather than max_jobs at once
+    scheduler: Scheduler | None = None
+    # Records each job's run time and resource usage
+    history: RunHistory | None = None
 
-    def step_output_dir(self, step):
-        
-        return self.intermediate_dir / step.name
+    def make_command(self, files, step_name):
+        return files.command(step_name, self.conda_envs.get(step_name))
+
+    def plan(self, workflow):
+        # The graph of jobs to schedule, and the steps each job runs
+        if self.pipes:
+            return fuse_pipes(workflow)
+        dag = workflow.dag
+        return dag, {step_name: (step_name,) for step_name in dag}
+
+    def make_job(self, workflow, unit, files, commands):
+        job = self.build_job(workflow, unit, files)
+        for command in job_commands(job):
+            commands[command.step.name] = command
+            command.output_dir.mkdir(parents=True, exist_ok=True)
+        return job
+
+    def build_job(self, workflow, unit, files):
+        # The job for unit, without touching the filesystem
+        job = [self.make_command(files, step_name) for step_name in unit]
+        if len(job) == 1:
+            return job[0]
+        keep = [
+            (c.step.name, c.step.stdin.ext) not in workflow.transient
+            for c in job[1:]
+        ]
+        return Pipeline(job, keep)
+
+    def environ(self, command):
+        return command_environ(self.environments, command)
+
+    def run_commands(self, commands, force=False):
+        # Runs in a worker thread; returns one result per command
+        results = [None] * len(commands)
+        todo = []
+        for i, command in enumerate(commands):
+            if not force and self.cache is not None and \
+                    self.cache.is_current(command):
+                results[i] = subprocess.CompletedProcess(
+                    command.command_args(), 0)
+            else:
+                todo.append(i)
+        # Batches only ever hold one step, so they share an environment
+        environ = self.environ(commands[0])
+        if len(todo) == 1:
+            results[todo[0]] = commands[todo[0]].run(environ)
+        elif todo:
+            procs = run_batch([commands[i] for i in todo], environ=environ)
+            for i, proc in zip(todo, procs):
+                results[i] = proc
+        if self.cache is not None:
+            for i in todo:
+                if results[i].returncode == 0:
+                    self.cache.record(commands[i])
+        return results
+
+    def record(self, job, procs):
+        if self.history is not None:
+            for command, proc in zip(job_commands(job), procs):
+                self.history.record(command, proc.returncode)
+
+    def run_pipeline(self, pipeline, force=False):
+        # Runs in a worker thread. A pipeline that skips any of its files
+        # can't be checked against the cache, so it always runs.
+        commands = pipeline.commands
+        cached = self.cache is not None and pipeline.materialized
+        if cached and not force and \
+                all(self.cache.is_current(c) for c in commands):
+            return [
+                subprocess.CompletedProcess(c.command_args(), 0)
+                for c in commands
+            ]
+        procs = pipeline.run([self.environ(c) for c in commands])
+        if cached and all(p.returncode == 0 for p in procs):
+            for command in commands:
+                self.cache.record(command)
+        return procs
+
+    def run_jobs(self, jobs, force=False):
+        # Returns, for each job, one result per command it ran
+        if len(jobs) == 1 and isinstance(jobs[0], Pipeline):
+            return [self.run_pipeline(jobs[0], force)]
+        return [[proc] for proc in self.run_commands(jobs, force)]
+
+    def batches(self, jobs):
+        # Group ready jobs of the same step, batch_size at a time; pipelines
+        # always go on their own
+        if self.batch_size <= 1:
+            for job in jobs:
+                yield [job]
+            return
+        by_step = collections.defaultdict(list)
+        for job in jobs:
+            _, step_name, command = job
+            if isinstance(command, Pipeline):
+                yield [job]
+            else:
+                by_step[step_name].append(job)
+        for group in by_step.values():
+            for i in range(0, len(group), self.batch_size):
+                yield group[i:i + self.batch_size]
 
-    def run(self, workflow, sources, output_dir):
-        for step in workflow.steps:
-            configured_step = step.configure(config)
-            job = configured_step.make_job(self)
-            job.run()
+    def up_to_date(self, job):
+        # Checked against the cache when there is one; otherwise, as with
+        # make, a job is up to date when its outputs are newer than its
+        # inputs. The cache has no entries for a pipeline that skips some
+        # of its files, so that is judged by the files it reads from
+        # outside against the ones it keeps.
+        if isinstance(job, Pipeline) and not job.materialized:
+            return newer_than(*job.endpoints())
+        for command in job_commands(job):
+            inputs = [wf.path for wf in command.input_files.values()]
+            outputs = [wf.path for _, wf in command.output_files]
+            if self.cache is None:
+                if not newer_than(inputs, outputs):
+                    return False
+            elif not all(map(os.path.exists, inputs)) or \
+                    not self.cache.is_current(command):
+                return False
+        return True
+
+    def prune(self, workflow, dag, units, files, targets, force=False):
+        # The part of dag one sample needs to bring targets up to date: the
+        # jobs upstream of them, less those that are up to date with
+        # nothing out of date further upstream
+        head_of = {s: head for head, unit in units.items() for s in unit}
+        wanted = upstream(
+            dag, {head_of[s] for s in targets.steps_for(files)})
+        stale = set()
+        ts = graphlib.TopologicalSorter({head: dag[head] for head in wanted})
+        for head in ts.static_order():
+            if force or not stale.isdisjoint(dag[head]) or not \
+                    self.up_to_date(
+                        self.build_job(workflow, units[head], files)):
+                stale.add(head)
+        return {head: set(dag[head]) & stale for head in stale}
+
+    def run_targets(self, workflow, samples, targets, force=False, window=1):
+        # Runs only what targets need, see prune. Targets are (step, ext)
+        # outputs, step names or output paths. Returns sample name =>
+        # step name => the command made for it, for the steps that ran.
+        return {
+            sample.name: commands
+            for sample, commands in self.run_samples(
+                workflow, samples, force, window, targets)
+        }
+
+    def run(self, workflow, sources, force=False):
+        sample = Sample(workflow.name, sources)
+        commands = {}
+        for _, commands in self.run_samples(workflow, [sample], force):
+            pass
+        return commands
+
+    def run_matrix(self, matrix, force=False, targets=None):
+        completed = []
+        for sample, _ in self.run_samples(
+                matrix.workflow, matrix, force, matrix.window, targets):
+            completed.append(sample.name)
+        return completed
+
+    def run_samples(self, workflow, samples, force=False, window=1,
+                    targets=None):
+        # Jobs from every sample in the window share one worker pool, so
+        # ready steps are scheduled across samples rather than per sample.
+        samples = SampleWindow(self, workflow, samples, window, targets, force)
+        if not samples.dag:
+            return
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.prepare(samples.dag, samples.units)
+        running = {}
+
+        def submit(batch):
+            future = executor.submit(
+                self.run_jobs, [job for _, _, job in batch], force)
+            running[future] = batch
+
+        executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        try:
+            samples.admit()
+            while samples:
+                ready, finished = samples.ready()
+                yield from finished
+                for batch in self.batches(ready):
+                    if scheduler is None:
+                        submit(batch)
+                    else:
+                        # A batch runs its commands one after another
+                        _, step_name, job = batch[0]
+                        scheduler.push(batch, step_name, *job_resources(job))
+                if scheduler is not None:
+                    for batch in scheduler.pop(self.max_jobs - len(running)):
+                        submit(batch)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    if scheduler is not None:
+                        scheduler.release(batch)
+                    results = future.result()
+                    for (idx, step_name, job), procs in zip(batch, results):
+                        self.record(job, procs)
+                        failed = failure(job, procs)
+                        if failed is not None:
+                            raise CommandFailed(
+                                *failed, samples.sample(idx).name)
+                        finished = samples.done(idx, step_name)
+                        if finished is not None:
+                            yield finished
+                samples.admit()
+            samples.check()
+        finally:
+            # On failure, drop queued jobs but let running ones finish
+            executor.shutdown(wait=True, cancel_futures=True)
+            if scheduler is not None:
+                scheduler.clear()
+            if self.history is not None:
+                self.history.flush()
+            if self.cache is not None:
+                self.cache.save()
 
     # @property
     # def argv(self):
@@ -49,11 +451,310 @@ class LocalRunner:
 
     
 
-class Job:
-    def __init__(self, step, input_fps, output_fps):
-        self.step = step
-        self.input_fps = input_fps
-        self.output_fps = output_fps
+
+@dataclass
+class AsyncRunner(LocalRunner):
+    # Runs every job as a subprocess on one event loop instead of parking a
+    # thread on each, so max_jobs can be in the thousands. Commands are not
+    # batched; batch_size is ignored.
+    max_jobs: int = 256
+    # Per-job stdout is read in chunk_size pieces and written to disk through
+    # a buffer_size file buffer
+    chunk_size: int = 1 << 16
+    buffer_size: int = 1 << 20
+
+    def run_samples(self, workflow, samples, force=False, window=1,
+                    targets=None):
+        # Drives the async generator one sample at a time, so callers of
+        # run() and run_matrix() see the same interface as LocalRunner
+        loop = asyncio.new_event_loop()
+        results = self.arun_samples(
+            workflow, samples, force, window, targets)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(anext(results))
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.close()
+
+    async def run_command(self, command, force=False):
+        if not force and self.cache is not None and \
+                await asyncio.to_thread(self.cache.is_current, command):
+            return subprocess.CompletedProcess(command.command_args(), 0)
+        environ = None
+        if command.conda_env is not None and self.environments is not None:
+            # Activation may shell out to conda the first time round
+            environ = await asyncio.to_thread(self.environ, command)
+        proc = await run_async(
+            command, environ, self.chunk_size, self.buffer_size)
+        if proc.returncode == 0 and self.cache is not None:
+            await asyncio.to_thread(self.cache.record, command)
+        return proc
+
+    async def run_job(self, job, force=False):
+        # Pipelines pump their kept files from threads, so they get one
+        if isinstance(job, Pipeline):
+            return await asyncio.to_thread(self.run_pipeline, job, force)
+        return [await self.run_command(job, force)]
+
+    async def arun_samples(self, workflow, samples, force=False, window=1,
+                           targets=None):
+        samples = SampleWindow(self, workflow, samples, window, targets, force)
+        if not samples.dag:
+            return
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.prepare(samples.dag, samples.units)
+        # Ready jobs wait here until a slot frees up, which bounds the
+        # number of live processes (and open pipes and files) at max_jobs
+        queued = collections.deque()
+        running = {}
+
+        try:
+            samples.admit()
+            while samples:
+                ready, finished = samples.ready()
+                for sample_commands in finished:
+                    yield sample_commands
+                for entry in ready:
+                    if scheduler is None:
+                        queued.append(entry)
+                    else:
+                        _, step_name, job = entry
+                        scheduler.push(entry, step_name, *job_resources(job))
+                if scheduler is not None:
+                    queued.extend(scheduler.pop(self.max_jobs - len(running)))
+                while queued and len(running) < self.max_jobs:
+                    entry = queued.popleft()
+                    task = asyncio.create_task(self.run_job(entry[2], force))
+                    running[task] = entry
+                done = set()
+                if running:
+                    done, _ = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    entry = running.pop(task)
+                    if scheduler is not None:
+                        scheduler.release(entry)
+                    idx, step_name, job = entry
+                    procs = task.result()
+                    self.record(job, procs)
+                    failed = failure(job, procs)
+                    if failed is not None:
+                        raise CommandFailed(*failed, samples.sample(idx).name)
+                    finished = samples.done(idx, step_name)
+                    if finished is not None:
+                        yield finished
+                samples.admit()
+            samples.check()
+        finally:
+            # As with LocalRunner, queued jobs are dropped and running ones
+            # are left to finish
+            if running:
+                await asyncio.wait(running)
+            if scheduler is not None:
+                scheduler.clear()
+            if self.history is not None:
+                self.history.flush()
+            if self.cache is not None:
+                self.cache.save()
+
+
+def job_name(sample_name, step_name):
+    # Safe as a file name and as a cluster job name. Sanitizing can map
+    # different names to one ("a b" and "a_b", or "a.b" + "c" and "a" +
+    # "b.c"), so a short hash of the raw pair keeps them apart.
+    safe = re.sub(r"[^\w.-]", "_", f"{sample_name}.{step_name}")
+    raw = f"{sample_name}\0{step_name}".encode()
+    return f"{safe}.{hashlib.sha256(raw).hexdigest()[:8]}"
+
+
+@dataclass
+class ExecutorRunner(LocalRunner):
+    # Hands each job to an Executor, which decides where and when it runs,
+    # e.g. a BatchExecutor submitting to a cluster. max_jobs bounds the jobs
+    # submitted at once; commands are not batched and scheduler is unused.
+    # Without an executor, jobs run in a LocalExecutor of max_jobs threads.
+    executor: Executor | None = None
+
+    def is_current(self, job, force=False):
+        # A pipeline that skips any of its files can't be checked
+        if force or self.cache is None:
+            return False
+        if isinstance(job, Pipeline) and not job.materialized:
+            return False
+        return all(self.cache.is_current(c) for c in job_commands(job))
+
+    def run_samples(self, workflow, samples, force=False, window=1,
+                    targets=None):
+        samples = SampleWindow(self, workflow, samples, window, targets, force)
+        if not samples.dag:
+            return
+        executor = self.executor
+        if executor is None:
+            executor = LocalExecutor(self.max_jobs, self.environments)
+        queued = collections.deque()
+        # Job => (sample index, step name)
+        running = {}
+
+        try:
+            samples.admit()
+            while samples:
+                ready, finished = samples.ready()
+                yield from finished
+                # (sample index, step name, job, whether it ran)
+                finished = []
+                for idx, step_name, work in ready:
+                    name = job_name(samples.sample(idx).name, step_name)
+                    job = Job(name, work)
+                    if self.is_current(work, force):
+                        job.finish([0] * len(job.commands))
+                        finished.append((idx, step_name, job, False))
+                    else:
+                        queued.append((idx, step_name, job))
+                while queued and len(running) < self.max_jobs:
+                    idx, step_name, job = queued.popleft()
+                    executor.submit(job)
+                    running[job] = (idx, step_name)
+                if not finished:
+                    for job in executor.poll():
+                        idx, step_name = running.pop(job)
+                        finished.append((idx, step_name, job, True))
+                for idx, step_name, job, ran in finished:
+                    procs = [
+                        subprocess.CompletedProcess(c.command_args(), r)
+                        for c, r in zip(job.commands, job.returncodes)
+                    ]
+                    self.record(job.work, procs)
+                    failed = failure(job.work, procs)
+                    if failed is not None:
+                        raise CommandFailed(*failed, samples.sample(idx).name)
+                    if ran and self.cache is not None and not (
+                            isinstance(job.work, Pipeline) and
+                            not job.work.materialized):
+                        for command in job.commands:
+                            self.cache.record(command)
+                    sample_commands = samples.done(idx, step_name)
+                    if sample_commands is not None:
+                        yield sample_commands
+                samples.admit()
+            samples.check()
+        finally:
+            # Unlike the other runners, jobs still out are called off: on a
+            # cluster they would otherwise hold on to their allocation
+            for job in running:
+                executor.cancel(job)
+            if self.executor is None:
+                executor.close()
+            if self.history is not None:
+                self.history.flush()
+            if self.cache is not None:
+                self.cache.save()
+
+
+def run_batch(commands, shell="/bin/sh", environ=None):
+    # Runs many commands from one shell process instead of paying a
+    # fork/exec of Python's subprocess machinery for each. Every command
+    # gets its own exit status, and its stdout goes to the step's stdout
+    # target or, failing that, to a capture file returned as
+    # CompletedProcess.stdout.
+    with tempfile.TemporaryDirectory(prefix="wfrcwf-batch-") as tmp:
+        tmp = Path(tmp)
+        argvs = []
+        captures = []
+        script = []
+        for i, command in enumerate(commands):
+            argv = command.command_args(conda_run=environ is None)
+            argvs.append(argv)
+            target = command.stdout_path
+            if target is None:
+                target = tmp / f"{i}.out"
+                captures.append(target)
+            else:
+                captures.append(None)
+            redirects = f"> {shlex.quote(str(target))}"
+            if command.stdin_path is not None:
+                redirects = f"< {shlex.quote(command.stdin_path)} {redirects}"
+            script.append(f"{shlex.join(argv)} {redirects}; echo {i} $?")
+        script_fp = tmp / "batch.sh"
+        script_fp.write_text("\n".join(script) + "\n")
+        with tracing.span("command.run_batch", jobs=len(commands)):
+            proc = subprocess.run(
+                [shell, str(script_fp)], stdout=subprocess.PIPE, text=True,
+                env=environ)
+        # Commands the shell never reported on (e.g. it was killed) fail
+        statuses = {}
+        for line in proc.stdout.splitlines():
+            i, status = line.split()
+            statuses[int(i)] = int(status)
+        results = []
+        for i, argv in enumerate(argvs):
+            returncode = statuses.get(i, proc.returncode or 1)
+            capture = captures[i]
+            stdout = None
+            if capture is not None and capture.exists():
+                stdout = capture.read_bytes()
+            results.append(subprocess.CompletedProcess(argv, returncode, stdout))
+    return results
+
+
+async def process_exit(pid):
+    # Waits, without reaping, for a child to exit. A pidfd lets the event
+    # loop watch it; elsewhere a thread blocks on it instead.
+    if not hasattr(os, "pidfd_open"):
+        await asyncio.to_thread(
+            os.waitid, os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        return
+    loop = asyncio.get_running_loop()
+    fd = os.pidfd_open(pid)
+    try:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+    finally:
+        os.close(fd)
+
+
+async def run_async(command, environ=None, chunk_size=1 << 16,
+                    buffer_size=1 << 20):
+    # A step's stdout target is fed from a pipe: the event loop reads
+    # chunk_size at a time into a large file buffer. Between reads the pipe
+    # fills up and the child blocks, so a fast writer cannot outrun the disk.
+    # The child is reaped here rather than by asyncio, so that wait4 can
+    # collect its resource usage.
+    argv = command.command_args(conda_run=environ is None)
+    loop = asyncio.get_running_loop()
+    with tracing.span("command.run_async", step=command.step.name), \
+            command.open_stdin() as stdin, \
+            command.open_stdout(buffer_size) as stdout:
+        started = time.monotonic()
+        proc = subprocess.Popen(
+            argv, stdin=stdin, env=environ,
+            stdout=None if stdout is None else subprocess.PIPE)
+        try:
+            if stdout is not None:
+                reader = asyncio.StreamReader(limit=chunk_size)
+                transport, _ = await loop.connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(reader), proc.stdout)
+                try:
+                    while chunk := await reader.read(chunk_size):
+                        stdout.write(chunk)
+                finally:
+                    transport.close()
+            await process_exit(proc.pid)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        returncode, command.metrics = wait_with_metrics(proc, started)
+    return subprocess.CompletedProcess(argv, returncode)
+
 
     
     
@@ -0,0 +1,118 @@
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import os
+import subprocess
+import threading
+
+# Set per shell or per call, so never worth carrying over from activation
+_volatile_vars = {"_", "PWD", "OLDPWD", "SHLVL"}
+
+
+def conda_meta_stamp(prefix):
+    # Installing or removing packages rewrites conda-meta/history and adds
+    # or removes files in conda-meta, so this changes whenever the env does
+    meta = Path(prefix) / "conda-meta"
+    try:
+        return [
+            meta.stat().st_mtime_ns,
+            (meta / "history").stat().st_mtime_ns,
+        ]
+    except FileNotFoundError:
+        return None
+
+
+def command_environ(environments, command):
+    # The activated environ to run command in, or None to run it as it is
+    if command.conda_env is None or environments is None:
+        return None
+    return environments.environ(command.conda_env)
+
+
+@dataclass
+class CondaEnvironments:
+    # Activates each env once with `conda run`, then launches commands
+    # directly with the recorded environment variables.
+    cache_path: Path | None = None
+    conda: str = "conda"
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self.activations = 0
+        self._envs = {}
+        if self.cache_path is not None and Path(self.cache_path).exists():
+            with open(self.cache_path) as f:
+                self._envs = json.load(f)
+
+    def activate(self, env_name):
+        args = [self.conda, "run", "-n", env_name, "env", "-0"]
+        proc = subprocess.run(args, stdout=subprocess.PIPE, check=True)
+        self.activations += 1
+        activated = {}
+        for item in proc.stdout.decode().split("\0"):
+            if "=" in item:
+                k, _, v = item.partition("=")
+                activated[k] = v
+        # Keep only what activation changes, to overlay on our own environ
+        changed = {
+            k: v for k, v in activated.items()
+            if k not in _volatile_vars and os.environ.get(k) != v
+        }
+        removed = [
+            k for k in os.environ
+            if k not in activated and k not in _volatile_vars
+        ]
+        prefix = activated.get("CONDA_PREFIX")
+        return {
+            "prefix": prefix,
+            "stamp": conda_meta_stamp(prefix) if prefix else None,
+            "changed": changed,
+            "removed": removed,
+            # What the changed values were derived from, e.g. PATH before
+            # the env's bin was put in front of it
+            "base": {k: os.environ.get(k) for k in [*changed, "PATH"]},
+        }
+
+    def is_current(self, entry):
+        # An activation recorded from a different base environment (another
+        # PATH, say) would overlay stale values on ours
+        if entry is None or not entry["prefix"] or "base" not in entry:
+            return False
+        if conda_meta_stamp(entry["prefix"]) != entry["stamp"]:
+            return False
+        return all(os.environ.get(k) == v for k, v in entry["base"].items())
+
+    def entry(self, env_name):
+        with self._lock:
+            entry = self._envs.get(env_name)
+            if self.is_current(entry):
+                return entry
+            entry = self._envs[env_name] = self.activate(env_name)
+            self.save()
+            return entry
+
+    def environ(self, env_name):
+        entry = self.entry(env_name)
+        env = dict(os.environ)
+        for k in entry["removed"]:
+            env.pop(k, None)
+        env.update(entry["changed"])
+        return env
+
+    def invalidate(self, env_name=None):
+        with self._lock:
+            if env_name is None:
+                self._envs.clear()
+            else:
+                self._envs.pop(env_name, None)
+            self.save()
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        cache_path = Path(self.cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._envs, f)
+        os.replace(tmp_path, cache_path)
@@ -0,0 +1,288 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Protocol
+import os
+import re
+import shlex
+import subprocess
+import time
+
+from wfrcwflib import tracing
+from wfrcwflib.conda import command_environ
+from wfrcwflib.workflow import RunnableCommand
+from wfrcwflib.pipeline import Pipeline, job_commands, job_resources
+
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+finished_states = {DONE, FAILED, CANCELLED}
+
+
+@dataclass(eq=False)
+class Job:
+    # One unit of work for an executor: a command, or a pipeline of them
+    name: str
+    work: RunnableCommand | Pipeline
+    state: str = PENDING
+    # One per command once finished; None for a command that never reported
+    returncodes: list[int | None] | None = None
+    # The id the executor knows the job by, e.g. a cluster job id
+    external_id: str | None = None
+
+    @property
+    def commands(self):
+        return job_commands(self.work)
+
+    @property
+    def cpus(self):
+        return job_resources(self.work)[0]
+
+    @property
+    def memory(self):
+        return job_resources(self.work)[1]
+
+    @property
+    def finished(self):
+        return self.state in finished_states
+
+    def finish(self, returncodes):
+        self.returncodes = list(returncodes)
+        ok = all(r == 0 for r in self.returncodes)
+        self.state = DONE if ok else FAILED
+
+
+class Executor(Protocol):
+    # Runs Jobs somewhere. poll() blocks for up to timeout seconds (None
+    # for no limit) until at least one submitted job finishes, and returns
+    # every job that finished since the last poll.
+    def submit(self, job): ...
+
+    def poll(self, timeout=None): ...
+
+    def cancel(self, job): ...
+
+    def close(self):
+        pass
+
+
+class LocalExecutor(Executor):
+    # Jobs run in a pool of threads on this machine
+    def __init__(self, max_jobs=1, environments=None):
+        self.environments = environments
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs)
+        self._futures = {}
+
+    def environ(self, command):
+        return command_environ(self.environments, command)
+
+    def _run(self, job):
+        job.state = RUNNING
+        if isinstance(job.work, Pipeline):
+            procs = job.work.run([self.environ(c) for c in job.commands])
+        else:
+            procs = [job.work.run(self.environ(job.work))]
+        return [p.returncode for p in procs]
+
+    def submit(self, job):
+        self._futures[self._pool.submit(self._run, job)] = job
+
+    def poll(self, timeout=None):
+        if not self._futures:
+            return []
+        done, _ = wait(self._futures, timeout, return_when=FIRST_COMPLETED)
+        finished = []
+        for future in done:
+            job = self._futures.pop(future)
+            if future.cancelled():
+                job.state = CANCELLED
+            else:
+                job.finish(future.result())
+            finished.append(job)
+        return finished
+
+    def cancel(self, job):
+        # Only jobs that haven't started can be called off
+        for future, j in list(self._futures.items()):
+            if j is job and future.cancel():
+                del self._futures[future]
+                job.state = CANCELLED
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def job_script(job, exit_path):
+    # A POSIX shell script that runs the job's commands, piped together for
+    # a pipeline, and then writes one exit status per command to exit_path.
+    # Each command records its own status, since plain sh has no PIPESTATUS.
+    commands = job.commands
+    keep = job.work.keep if isinstance(job.work, Pipeline) else []
+    status_paths = [f"{exit_path}.{i}" for i in range(len(commands))]
+    stages = []
+    for i, command in enumerate(commands):
+        cmd = shlex.join(command.command_args())
+        if i == 0 and command.stdin_path is not None:
+            cmd += f" < {shlex.quote(command.stdin_path)}"
+        if i == len(commands) - 1 and command.stdout_path is not None:
+            cmd += f" > {shlex.quote(command.stdout_path)}"
+        stage = f"{{ {cmd}; echo $? > {shlex.quote(status_paths[i])}; }}"
+        if i < len(keep) and keep[i]:
+            stage += f" | tee {shlex.quote(command.stdout_path)}"
+        stages.append(stage)
+    statuses = " ".join(f'"$(cat {shlex.quote(p)})"' for p in status_paths)
+    tmp = shlex.quote(f"{exit_path}.tmp")
+    return "\n".join([
+        "#!/bin/sh",
+        " | ".join(stages),
+        f"echo {statuses} > {tmp}",
+        f"rm -f {' '.join(shlex.quote(p) for p in status_paths)}",
+        # Renamed into place, so a poll never sees a partial file
+        f"mv {tmp} {shlex.quote(str(exit_path))}",
+        "",
+    ])
+
+
+@dataclass
+class BatchExecutor(Executor):
+    # Submits each job as a script to a batch scheduler, sbatch/qsub style.
+    # Templates are formatted with {script}, {name}, {log}, {cpus}, {memory}
+    # and {resources}; the first word the submit command prints is the job
+    # id.
+    # Completion is seen through the exit file each script writes in
+    # script_dir, which must be on a filesystem the nodes share. All
+    # outstanding jobs are checked with one directory scan and at most one
+    # status command per poll.
+    script_dir: Path
+    submit_command: str = (
+        "sbatch --parsable -J {name} -o {log} {resources} {script}")
+    # The flags that make up {resources}, each left out when the job doesn't
+    # declare the resource; --mem=0 would ask Slurm for a whole node's memory
+    cpus_flag: str = "--cpus-per-task={cpus}"
+    memory_flag: str = "--mem={memory}M"
+    # Lists the ids still queued or running, among {ids} or all of the
+    # user's; None to rely on exit files alone. A failing status command
+    # skips lost-job detection for that poll, so it must exit 0 when the
+    # jobs have left the queue (squeue -j exits 1 for unknown ids)
+    status_command: str | None = "squeue -h -o %i --me"
+    cancel_command: str = "scancel {ids}"
+    poll_interval: float = 10.0
+    # Polls a job may be missing from the queue without an exit file before
+    # it counts as lost, to allow for shared filesystem lag
+    lost_after: int = 2
+
+    def __post_init__(self):
+        self.script_dir = Path(self.script_dir)
+        self.script_dir.mkdir(parents=True, exist_ok=True)
+        # external id => job
+        self._jobs = {}
+        self._missing = {}
+        self.polls = 0
+        self.status_failures = 0
+
+    def paths(self, job):
+        base = self.script_dir / job.name
+        return (
+            base.with_name(job.name + ".sh"),
+            base.with_name(job.name + ".log"),
+            base.with_name(job.name + ".exit"),
+        )
+
+    def resources(self, job):
+        flags = []
+        if job.cpus > 0:
+            flags.append(self.cpus_flag.format(cpus=job.cpus))
+        if job.memory > 0:
+            flags.append(self.memory_flag.format(memory=job.memory))
+        return " ".join(flags)
+
+    def submit(self, job):
+        script, log, exit_path = self.paths(job)
+        exit_path.unlink(missing_ok=True)
+        script.write_text(job_script(job, exit_path))
+        script.chmod(0o755)
+        args = shlex.split(self.submit_command.format(
+            script=shlex.quote(str(script)), name=shlex.quote(job.name),
+            log=shlex.quote(str(log)), cpus=job.cpus, memory=job.memory,
+            resources=self.resources(job)))
+        with tracing.span("executor.submit", job=job.name):
+            proc = subprocess.run(
+                args, stdout=subprocess.PIPE, text=True, check=True)
+        job.external_id = proc.stdout.split()[0].split(";")[0]
+        job.state = RUNNING
+        self._jobs[job.external_id] = job
+
+    def queued_ids(self):
+        # None when there is no status command, or it failed; either way
+        # nothing can be said about jobs missing from the queue
+        if self.status_command is None:
+            return None
+        ids = " ".join(shlex.quote(i) for i in self._jobs)
+        args = shlex.split(self.status_command.format(ids=ids))
+        proc = subprocess.run(args, stdout=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            self.status_failures += 1
+            return None
+        return {line.split()[0] for line in proc.stdout.splitlines() if line.strip()}
+
+    def check(self):
+        # One pass over every outstanding job
+        self.polls += 1
+        with tracing.span("executor.poll", jobs=len(self._jobs)):
+            exits = {
+                entry.name for entry in os.scandir(self.script_dir)
+                if entry.name.endswith(".exit")
+            }
+            finished = []
+            unresolved = []
+            for external_id, job in self._jobs.items():
+                _, _, exit_path = self.paths(job)
+                if exit_path.name in exits:
+                    words = exit_path.read_text().split()
+                    job.finish(int(w) if re.fullmatch(r"-?\d+", w) else None
+                               for w in words)
+                    finished.append(job)
+                else:
+                    unresolved.append(job)
+            queued = self.queued_ids() if unresolved else None
+            if queued is None:
+                unresolved = []
+            for job in unresolved:
+                if job.external_id in queued:
+                    self._missing.pop(job.external_id, None)
+                    continue
+                misses = self._missing.get(job.external_id, 0) + 1
+                self._missing[job.external_id] = misses
+                if misses >= self.lost_after:
+                    job.finish([None] * len(job.commands))
+                    finished.append(job)
+            for job in finished:
+                del self._jobs[job.external_id]
+                self._missing.pop(job.external_id, None)
+        return finished
+
+    def poll(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._jobs:
+            finished = self.check()
+            if finished:
+                return finished
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+        return []
+
+    def cancel(self, job):
+        if job.external_id not in self._jobs:
+            return
+        args = shlex.split(self.cancel_command.format(
+            ids=shlex.quote(job.external_id)))
+        subprocess.run(args)
+        del self._jobs[job.external_id]
+        self._missing.pop(job.external_id, None)
+        job.state = CANCELLED
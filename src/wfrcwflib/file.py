@@ -1,5 +1,11 @@
 from dataclasses import dataclass, field
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import collections
+import fnmatch
+import os
+
+from wfrcwflib import tracing
 
 class Filetype:
     pass
@@ -10,11 +16,13 @@ class SuffixedFiletype(Filetype):
     suffix: str
     alt_suffixes: list[str] = field(default_factory=list)
 
+    @property
+    def suffixes(self):
+        return [self.suffix] + list(self.alt_suffixes)
+
     def gather(self, dir: Path):
-        fps = list(dir.iterdir())
-        for fp in fps:
-            if fp.endswith(self.suffix):
-                yield fp
+        for match in FiletypeScanner([self]).scan(dir):
+            yield match.paths[0]
                 
 
 @dataclass
@@ -26,10 +34,123 @@ class FiletypeRegistry(dict):
     def register(self, t):
         self[t.name] = t
 
+    def scan(self, dir):
+        return FiletypeScanner(self.values()).scan(dir)
+
+@dataclass
+class FileMatch:
+    filetype: Filetype
+    stem: str
+    paths: tuple[Path, ...]
+
+class FiletypeScanner:
+    # Reverse-suffix index: each file name is checked once per distinct
+    # suffix length, however many filetypes are registered.
+    def __init__(self, filetypes):
+        # suffix => [(filetype, component index or None)]
+        self._by_suffix = collections.defaultdict(list)
+        for t in filetypes:
+            if isinstance(t, SuffixedFiletypeBundle):
+                for i, component in enumerate(t.components):
+                    for suffix in component.suffixes:
+                        self._by_suffix[suffix].append((t, i))
+            else:
+                for suffix in t.suffixes:
+                    self._by_suffix[suffix].append((t, None))
+        self._lengths = sorted({len(s) for s in self._by_suffix}, reverse=True)
+
+    def classify(self, name):
+        for n in self._lengths:
+            if len(name) <= n:
+                continue
+            for t, component in self._by_suffix.get(name[-n:], ()):
+                yield t, component, name[:-n]
+
+    def feed(self, paths, pending=None):
+        # Bundle components wait in pending until all of a stem's parts
+        # have been seen, then the whole bundle is yielded at once.
+        if pending is None:
+            pending = {}
+        for path in paths:
+            for t, component, stem in self.classify(path.name):
+                if component is None:
+                    yield FileMatch(t, stem, (path,))
+                    continue
+                key = (t.name, path.parent, stem)
+                parts = pending.setdefault(key, [None] * len(t.components))
+                parts[component] = path
+                if all(p is not None for p in parts):
+                    del pending[key]
+                    yield FileMatch(t, stem, tuple(parts))
+
+    def scan(self, dir):
+        with tracing.span("files.scan", dir=str(dir)):
+            yield from self.feed(iter_files(dir))
+
+def iter_files(dir):
+    with os.scandir(dir) as it:
+        for entry in it:
+            if entry.is_file():
+                yield Path(entry.path)
+
 @dataclass
 class FileSource:
     dir: Path
     filetype: Filetype
 
     def gather(self):
-        filepaths = list(self.dir.iterdir())
+        return FiletypeScanner([self.filetype]).scan(self.dir)
+
+@dataclass
+class MultiFileSource:
+    dirs: list[Path]
+    filetype: Filetype
+    max_depth: int | None = None
+    exclude: list[str] = field(default_factory=list)
+    max_workers: int = 16
+
+    def is_excluded(self, name, relpath):
+        return any(
+            fnmatch.fnmatch(name, pat) or fnmatch.fnmatch(relpath, pat)
+            for pat in self.exclude
+        )
+
+    def list_dir(self, root, dir, depth):
+        files = []
+        subdirs = []
+        with os.scandir(dir) as it:
+            for entry in it:
+                relpath = os.path.relpath(entry.path, root)
+                if self.is_excluded(entry.name, relpath):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if self.max_depth is None or depth < self.max_depth:
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(Path(entry.path))
+        return files, subdirs, depth
+
+    def iter_files(self):
+        # Each directory listing is its own task, so slow stat calls on
+        # network filesystems overlap instead of adding up.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {
+                executor.submit(self.list_dir, root, root, 0): root
+                for root in self.dirs
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root = running.pop(future)
+                    files, subdirs, depth = future.result()
+                    yield from files
+                    for subdir in subdirs:
+                        future = executor.submit(
+                            self.list_dir, root, subdir, depth + 1)
+                        running[future] = root
+
+    def gather(self):
+        with tracing.span("files.gather", roots=len(self.dirs)):
+            scanner = FiletypeScanner([self.filetype])
+            matches = scanner.feed(self.iter_files())
+            return sorted(matches, key=lambda m: m.paths)
@@ -0,0 +1,172 @@
+from dataclasses import dataclass, astuple
+from pathlib import Path
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from wfrcwflib.cache import insert_rows
+
+
+@dataclass(frozen=True, slots=True)
+class Metrics:
+    started: float
+    wall: float
+    user: float
+    sys: float
+    # In KB
+    max_rss: int
+    # Bytes passed to read and write calls, including those of descendants,
+    # as /proc/<pid>/io's rchar and wchar count them: page cache hits and
+    # pipes included, so not the same as bytes that reached the disk. None
+    # where /proc is unavailable
+    rchar: int | None = None
+    wchar: int | None = None
+
+
+def read_proc_io(pid):
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(fields["rchar"]), int(fields["wchar"])
+
+def wait_with_metrics(proc, started):
+    # Reaps a Popen with wait4 to get its resource usage, which covers the
+    # descendants it waited for. On Linux the I/O counters are read first,
+    # while the exited process is still a zombie. started is the
+    # time.monotonic() reading taken when the process was started.
+    rchar = wchar = None
+    if sys.platform.startswith("linux"):
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        rchar, wchar = read_proc_io(proc.pid)
+    _, status, ru = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    max_rss = ru.ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024
+    metrics = Metrics(
+        time.time() - wall, wall, ru.ru_utime, ru.ru_stime, max_rss,
+        rchar, wchar)
+    return proc.returncode, metrics
+
+def command_fingerprint(command):
+    # Identifies what ran, unlike RunCache.fingerprint without hashing the
+    # input files
+    h = hashlib.sha256()
+    h.update(repr(command.step).encode())
+    for arg in command.command_args():
+        h.update(arg.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks of sorted values
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+metric_names = [
+    "wall", "user", "sys", "max_rss", "rchar", "wchar",
+]
+
+class RunHistory:
+    # One row per job that ran, written in batches by flush(). Each
+    # RunHistory is one run, so rows from separate runs can be told apart.
+    def __init__(self, db_path, timeout=30.0, run_id=None):
+        self.db_path = Path(db_path)
+        self.run_id = run_id or uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._pending = []
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.db_path, timeout=timeout, isolation_level=None,
+            check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "run_id TEXT, step TEXT, inputs TEXT, fingerprint TEXT, "
+            "returncode INTEGER, started REAL, wall REAL, user REAL, "
+            "sys REAL, max_rss INTEGER, rchar INTEGER, "
+            "wchar INTEGER)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_key "
+            "ON jobs (step, inputs, fingerprint)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, command, returncode):
+        # Commands that didn't run here (cache hits, batches) have no metrics
+        if command.metrics is None:
+            return
+        row = (
+            self.run_id, command.step.name, command.output_basename,
+            command_fingerprint(command), returncode,
+        ) + astuple(command.metrics)
+        with self._lock:
+            self._pending.append(row)
+
+    def flush(self):
+        with self._lock:
+            rows = self._pending
+            self._pending = []
+        insert_rows(
+            self._conn,
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def jobs(self, step=None):
+        self.flush()
+        sql = "SELECT * FROM jobs"
+        params = ()
+        if step is not None:
+            sql += " WHERE step = ?"
+            params = (step,)
+        cursor = self._conn.execute(sql + " ORDER BY started", params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def percentiles(self, metric="wall", qs=(50, 90, 99), step=None,
+                    successful=True):
+        # step => {q: value} over every recorded run of the step
+        if metric not in metric_names:
+            raise ValueError(f"unknown metric {metric!r}")
+        self.flush()
+        sql = f"SELECT step, {metric} FROM jobs WHERE {metric} IS NOT NULL"
+        params = []
+        if step is not None:
+            sql += " AND step = ?"
+            params.append(step)
+        if successful:
+            sql += " AND returncode = 0"
+        values = {}
+        for step_name, value in self._conn.execute(
+                sql + f" ORDER BY step, {metric}", params):
+            values.setdefault(step_name, []).append(value)
+        return {
+            step_name: {q: percentile(vs, q) for q in qs}
+            for step_name, vs in values.items()
+        }
+
+    def runtimes(self, q=50):
+        # step => runtime, e.g. for Scheduler.runtimes or analysis
+        return {
+            step: ps[q]
+            for step, ps in self.percentiles("wall", (q,)).items()
+        }
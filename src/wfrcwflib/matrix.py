@@ -0,0 +1,69 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+import graphlib
+import itertools
+
+from wfrcwflib.workflow import WorkflowFile
+
+
+@dataclass
+class Sample:
+    name: str
+    # (step, input) => source
+    sources: dict[tuple[str, str], WorkflowFile] = field(default_factory=dict)
+
+    @classmethod
+    def from_files(cls, workflow, filepaths):
+        filepaths = [Path(fp) for fp in filepaths]
+        sources = {}
+        for step_name, ext in workflow.inputs:
+            for fp in filepaths:
+                if fp.name.endswith(ext):
+                    basename = fp.name[:-len(ext)]
+                    sources[(step_name, ext)] = WorkflowFile(fp.parent, basename, ext)
+                    break
+            else:
+                raise ValueError(
+                    f"no file for input {step_name} {ext} among {filepaths}")
+        basenames = [f.basename for f in sources.values()]
+        name = "__".join(dict.fromkeys(basenames))
+        return cls(name, sources)
+
+
+def gather_samples(workflow, groups):
+    # Each group is a single path or a tuple of paths, e.g. an R1/R2 pair
+    for group in groups:
+        if isinstance(group, (str, Path)):
+            group = (group,)
+        yield Sample.from_files(workflow, group)
+
+
+class SampleMatrix:
+    # Samples are consumed lazily, so the (sample, step) job graph is never
+    # materialised beyond the samples currently in flight.
+    def __init__(self, workflow, samples, window=1000):
+        self.workflow = workflow
+        self.samples = samples
+        self.window = window
+        self.dag = workflow.dag
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def sorter(self):
+        ts = graphlib.TopologicalSorter(self.dag)
+        ts.prepare()
+        return ts
+
+    def jobs(self):
+        order = self.workflow.order
+        for sample in self.samples:
+            for step_name in order:
+                deps = {(sample.name, dep) for dep in self.dag[step_name]}
+                yield (sample.name, step_name), deps
+
+    def chunks(self, size=None):
+        size = size or self.window
+        samples = iter(self.samples)
+        while chunk := list(itertools.islice(samples, size)):
+            yield chunk
@@ -1,11 +1,18 @@
+from pathlib import Path
+import collections.abc
+import hashlib
+import marshal
+import os
+
 from wfrcwflib.workflow import (
     Step, PositionalArgument, OptionalArgument,
-    InputConnector, OutputConnector,
+    Connector, InputConnector, OutputConnector,
+    InputPrefixConnector, OutputPrefixConnector,
+    StdoutConnector, OutputStdoutConnector, StdinConnector,
+    Placeholder, placeholders,
     UnresolvedWorkflow,
 )
-
-class ParseError(Exception):
-    pass
+from wfrcwflib.state import ParseError, WFSM, parse_resource
 
 def next_token(line):
     toks = line.split(maxsplit=1)
@@ -28,19 +35,23 @@ def parse_connector(line):
         raise ParseError("connector must start with '{ '")
 
     cmd, rest = next_token(rest)
-    if not cmd in connectors:
-        raise ParseError("invalid connector type")
-    cls = connectors[cmd]
+    if cmd in placeholders:
+        value = placeholders[cmd]
+    else:
+        if not cmd in connectors:
+            raise ParseError("invalid connector type")
+        cls = connectors[cmd]
 
-    ext, rest = next_token(rest)
-    if not ext:
-        raise ParseError("connector ext cannot be empty")
+        ext, rest = next_token(rest)
+        if not ext:
+            raise ParseError("connector ext cannot be empty")
+        value = cls.shared(ext)
 
     connector_close, rest = next_token(rest)
     if not connector_close == "}":
         raise ParseError("connector must end with ' }'")
 
-    return cls(ext), rest
+    return value, rest
 
 def parse_argument_value(line):
     if line.startswith("{"):
@@ -58,24 +69,27 @@ def parse_optional_argument(line):
     flag, rest = next_token(line)
     if not flag.startswith("-"):
         raise ParseError("optional argument flags must start with '-'")
-    obj = OptionalArgument(flag)
+    values = []
     while rest:
         value, rest = parse_argument_value(rest)
-        obj.values.append(value)
-    return obj
+        values.append(value)
+    return OptionalArgument(flag, values)
 
 def parse_step(lines):
     lines = iter(lines)
 
     name, name_rest = next_token(next(lines))
-    if name_rest:
-        raise ParseError("name must appear by itself")
+    settings = {}
+    while name_rest:
+        setting, name_rest = next_token(name_rest)
+        key, value = parse_resource(setting)
+        settings[key] = value
 
     prog, prog_rest = next_token(next(lines))
     if prog_rest:
         raise ParseError("prog must appear by itself")
 
-    obj = Step(name, prog)
+    obj = Step(name, prog, **settings)
     for line in lines:
         if line.startswith("-"):
             arg = parse_optional_argument(line)
@@ -130,8 +144,16 @@ def split_paragraphs(lines):
     if paragraph:
         yield paragraph
 
-def parse(lines):
-    paragraphs = split_paragraphs(lines)
+def parse(lines, stream=False):
+    # Lines may come straight from a file object; comments and surrounding
+    # whitespace are handled by the tokenizer. With stream=True, each
+    # workflow's connections are read lazily as they are iterated (e.g. by
+    # UnresolvedWorkflow.resolve), instead of being collected up front.
+    return WFSM(stream).parse(lines)
+
+def parse_paragraphs(lines):
+    # The original line-splitting parser, kept for comparison
+    paragraphs = split_paragraphs(preprocess(lines))
     for p in paragraphs:
         obj = parse_paragraph(p)
         yield obj
@@ -148,3 +170,153 @@ def preprocess(lines):
         line = strip_comment(line)
         line = strip_whitespace(line)
         yield line
+
+# Parsed files are cached in a compact marshalled form of plain tuples.
+# Bump the version whenever that form changes, to drop stale caches.
+CACHE_VERSION = 4
+
+connector_classes = {
+    cls.__name__: cls for cls in [
+        InputConnector, OutputConnector,
+        InputPrefixConnector, OutputPrefixConnector,
+        StdoutConnector, OutputStdoutConnector, StdinConnector,
+    ]
+}
+
+def encode_value(value):
+    if isinstance(value, Connector):
+        return (type(value).__name__, value.ext)
+    if isinstance(value, Placeholder):
+        return ("Placeholder", value.name)
+    return value
+
+def decode_value(value):
+    if isinstance(value, tuple):
+        cls_name, ext = value
+        if cls_name == "Placeholder":
+            return placeholders[ext]
+        return connector_classes[cls_name].shared(ext)
+    return value
+
+def encode(obj):
+    if isinstance(obj, Step):
+        args = []
+        for arg in obj.args:
+            if isinstance(arg, OptionalArgument):
+                values = tuple(encode_value(v) for v in arg.values)
+                args.append(("o", arg.flag, values))
+            else:
+                args.append(("p", encode_value(arg.value)))
+        stdout = None if obj.stdout is None else encode_value(obj.stdout)
+        stdin = None if obj.stdin is None else encode_value(obj.stdin)
+        return (
+            "step", obj.name, obj.prog, tuple(args), stdout, stdin,
+            obj.cpus, obj.memory)
+    if isinstance(obj, UnresolvedWorkflow):
+        return ("workflow", obj.name, tuple(obj.connections))
+    raise TypeError(f"cannot encode {obj!r}")
+
+def decode(ast):
+    match ast:
+        case ("step", name, prog, args, stdout, stdin, cpus, memory):
+            obj = Step(name, prog, cpus=cpus, memory=memory)
+            for arg in args:
+                if arg[0] == "o":
+                    _, flag, values = arg
+                    obj.args.append(OptionalArgument(
+                        flag, [decode_value(v) for v in values]))
+                else:
+                    obj.args.append(PositionalArgument(decode_value(arg[1])))
+            if stdout is not None:
+                obj.stdout = decode_value(stdout)
+            if stdin is not None:
+                obj.stdin = decode_value(stdin)
+            return obj
+        case ("workflow", name, connections):
+            return UnresolvedWorkflow(name, list(connections))
+    raise ParseError(f"invalid cached object {ast!r}")
+
+def cache_path(path, cache_dir=None):
+    # Keyed on the resolved path, so files of the same name in different
+    # directories can share a cache_dir
+    path = Path(path)
+    if cache_dir is None:
+        cache_dir = path.parent / "__wfcache__"
+    key = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"{path.name}.{key}.marshal"
+
+def _read_cache(fp):
+    try:
+        # marshal.load() on a file object reads in tiny pieces; one read()
+        # and loads() is an order of magnitude faster
+        with open(fp, "rb") as f:
+            cached = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not (isinstance(cached, tuple) and len(cached) == 4):
+        return None
+    if cached[0] != CACHE_VERSION:
+        return None
+    return cached
+
+def _write_cache(fp, cached):
+    tmp_fp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+    try:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_fp, "wb") as f:
+            f.write(marshal.dumps(cached))
+        os.replace(tmp_fp, fp)
+    except OSError:
+        # An unwritable cache only costs us the warm start
+        pass
+
+def load_compiled(path, cache_dir=None):
+    # Warm starts cost one read and hash of the file and one unmarshal. The
+    # cached form is only used for the same file with the same content;
+    # size and mtime can match after an edit.
+    path = Path(path)
+    fp = cache_path(path, cache_dir)
+    resolved = str(path.resolve())
+    data = path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    cached = _read_cache(fp)
+    if cached is not None and cached[1:3] == (resolved, digest):
+        return cached[3]
+    lines = data.decode().splitlines()
+    asts = tuple(encode(obj) for obj in parse(lines))
+    _write_cache(fp, (CACHE_VERSION, resolved, digest, asts))
+    return asts
+
+def load(path, cache_dir=None):
+    return [decode(ast) for ast in load_compiled(path, cache_dir)]
+
+class LazyRegistry(collections.abc.Mapping):
+    # Objects are decoded on first lookup, so a workflow that uses a few
+    # steps of a large library only pays for those steps.
+    def __init__(self, asts):
+        self._asts = asts
+        self._objs = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._objs[name]
+        except KeyError:
+            obj = self._objs[name] = decode(self._asts[name])
+            return obj
+
+    def __iter__(self):
+        return iter(self._asts)
+
+    def __len__(self):
+        return len(self._asts)
+
+def load_registry(path, cache_dir=None):
+    steps = {}
+    workflows = {}
+    for ast in load_compiled(path, cache_dir):
+        kind, name = ast[0], ast[1]
+        if kind == "step":
+            steps[name] = ast
+        else:
+            workflows[name] = ast
+    return LazyRegistry(steps), LazyRegistry(workflows)
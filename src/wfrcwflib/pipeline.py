@@ -0,0 +1,188 @@
+from dataclasses import dataclass
+import contextlib
+import os
+import subprocess
+import threading
+import time
+
+from wfrcwflib import tracing
+from wfrcwflib.history import wait_with_metrics
+from wfrcwflib.workflow import RunnableCommand, WorkflowError, path_str
+
+
+def fuse_pipes(workflow):
+    # Collapses chains of stdout --> stdin connections into units that run
+    # as one pipeline. A step is piped from its upstream only when that is
+    # its sole connection and its upstream's stdout has no other consumer,
+    # so piped steps never wait on anything else and the collapsed graph
+    # stays acyclic. Returns the DAG of units, keyed by each unit's first
+    # step, and first step => step names in the unit.
+    connections_in = workflow.connections_in
+    connected = {}
+    for (to_step, to_input), src in connections_in.items():
+        if src is not None:
+            connected.setdefault(to_step, []).append((src, to_input))
+    # step1 => step2 piped from it
+    piped_to = {}
+    for to_step, conns in connected.items():
+        if len(conns) != 1:
+            continue
+        (from_step, from_output), to_input = conns[0]
+        consumers = list(workflow.connections_out[(from_step, from_output)])
+        if len(consumers) == 1 and \
+                workflow.is_pipe(from_step, from_output, to_step, to_input):
+            piped_to[from_step] = to_step
+    piped = set(piped_to.values())
+    for to_step, to_input in workflow.transient:
+        if to_step not in piped:
+            raise WorkflowError(
+                f"{to_step} {to_input} cannot be piped, so its file must be kept")
+
+    dag = workflow.dag
+    units = {}
+    head_of = {}
+    for step_name in dag:
+        if step_name in piped:
+            continue
+        unit = [step_name]
+        while unit[-1] in piped_to:
+            unit.append(piped_to[unit[-1]])
+        units[step_name] = tuple(unit)
+        for s in unit:
+            head_of[s] = step_name
+    unit_dag = {}
+    for head, unit in units.items():
+        deps = {head_of[dep] for s in unit for dep in dag[s]}
+        deps.discard(head)
+        unit_dag[head] = deps
+    return unit_dag, units
+
+
+@dataclass
+class Pipeline:
+    commands: list[RunnableCommand]
+    # keep[i] says whether commands[i]'s stdout is also written to its file
+    keep: list[bool]
+    chunk_size: int = 1 << 20
+
+    @property
+    def materialized(self):
+        return all(self.keep)
+
+    def endpoints(self):
+        # The files the pipeline reads from outside, and the ones it writes
+        # to disk, leaving out stdout --> stdin links it doesn't keep
+        skipped = {
+            c.stdout_path for c, kept in zip(self.commands, self.keep)
+            if not kept
+        }
+        produced = [
+            path_str(wf.dir, wf.filename)
+            for c in self.commands for _, wf in c.output_files
+        ]
+        inputs = [
+            path_str(wf.dir, wf.filename)
+            for c in self.commands for wf in c.input_files.values()
+        ]
+        own = set(produced)
+        return (
+            [p for p in inputs if p not in own],
+            [p for p in produced if p not in skipped],
+        )
+
+    def run(self, environs=None):
+        # Starts every command at once, each reading the previous one's
+        # stdout. A kept connection goes through a thread that copies the
+        # stream both to its file and on to the next command. environs has
+        # an activated environment (or None) per command. Returns one
+        # CompletedProcess per command.
+        if environs is None:
+            environs = [None] * len(self.commands)
+        argvs = []
+        procs = []
+        starts = []
+        tees = []
+        last = len(self.commands) - 1
+        with tracing.span("command.run_pipeline", steps=len(self.commands)), \
+                contextlib.ExitStack() as stack:
+            stdin = stack.enter_context(self.commands[0].open_stdin())
+            try:
+                for i, (command, environ) in enumerate(
+                        zip(self.commands, environs)):
+                    argv = command.command_args(conda_run=environ is None)
+                    if i == last:
+                        stdout = stack.enter_context(command.open_stdout())
+                    else:
+                        stdout = subprocess.PIPE
+                    if i > 0:
+                        stdin = subprocess.PIPE if self.keep[i - 1] \
+                            else procs[-1].stdout
+                    starts.append(time.monotonic())
+                    proc = subprocess.Popen(
+                        argv, stdin=stdin, stdout=stdout, env=environ)
+                    if i > 0:
+                        upstream = procs[-1]
+                        if self.keep[i - 1]:
+                            t = threading.Thread(target=tee, args=(
+                                upstream.stdout, self.commands[i - 1].stdout_path,
+                                proc.stdin, self.chunk_size))
+                            t.start()
+                            tees.append(t)
+                        else:
+                            # Only the child holds the pipe now, so the
+                            # upstream gets SIGPIPE if the child exits early
+                            upstream.stdout.close()
+                    argvs.append(argv)
+                    procs.append(proc)
+            except BaseException:
+                for proc in procs:
+                    proc.kill()
+                raise
+            finally:
+                for command, proc, started in zip(self.commands, procs, starts):
+                    _, command.metrics = wait_with_metrics(proc, started)
+                for t in tees:
+                    t.join()
+        return [
+            subprocess.CompletedProcess(argv, proc.returncode)
+            for argv, proc in zip(argvs, procs)
+        ]
+
+
+def job_commands(job):
+    # A job is one command, or a Pipeline of steps piped together
+    if isinstance(job, Pipeline):
+        return job.commands
+    return [job]
+
+def job_resources(job):
+    # Piped commands run side by side, so their resources add up
+    commands = job_commands(job)
+    return (
+        sum(c.step.cpus for c in commands),
+        sum(c.step.memory for c in commands),
+    )
+
+
+def tee(src, path, dest, chunk_size=1 << 20):
+    # Copies the pipe src to the file at path and to dest. If dest's reader
+    # goes away, the file still gets the rest of the stream.
+    with src, open(path, "wb") as f:
+        fd = src.fileno()
+        while chunk := os.read(fd, chunk_size):
+            f.write(chunk)
+            if dest is not None:
+                try:
+                    dest.write(chunk)
+                except BrokenPipeError:
+                    close_quietly(dest)
+                    dest = None
+    if dest is not None:
+        close_quietly(dest)
+
+
+def close_quietly(f):
+    try:
+        f.close()
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,164 @@
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from wfrcwflib.analysis import bottom_levels
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def available_memory():
+    # In MB, like Step.memory
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+@dataclass
+class Scheduler:
+    # Hands out ready jobs as they fit in the node's cpus and memory, highest
+    # critical-path level first. Smaller jobs may start ahead of a waiting
+    # bigger one (backfilling), but only backfill_limit times in a row before
+    # everything else is held back so that the big one can start.
+    cpus: int = field(default_factory=available_cpus)
+    memory: int = field(default_factory=available_memory)
+    backfill_limit: int = 100
+    # step name => expected runtime, to weight the critical path
+    runtimes: dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._queue = []
+        self._seq = itertools.count()
+        # id(item) => (item, cpus, memory) while the item runs. Items may
+        # be unhashable (a batch is a list); holding on to the item keeps
+        # its id from being reused by another object until it is released.
+        self._held = {}
+        self._levels = {}
+        self._blocked = None
+        self._skips = 0
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.peak_cpus = 0
+        self.peak_memory = 0
+        self.launched = 0
+        self.cpu_seconds = 0.0
+        self.memory_seconds = 0.0
+        self._started = None
+        self._last = None
+
+    def prepare(self, dag, units=None):
+        # Jobs are prioritised by the critical path through dag. A job that
+        # runs several steps at once (a pipeline) weighs as its slowest.
+        weights = {}
+        for node in dag:
+            steps = (node,) if units is None else units[node]
+            weights[node] = max(self.runtimes.get(s, 1.0) for s in steps)
+        self._levels = bottom_levels(dag, weights)
+
+    def fits(self, cpus, memory):
+        return (
+            self.used_cpus + cpus <= self.cpus and
+            self.used_memory + memory <= self.memory
+        )
+
+    def push(self, item, step_name, cpus, memory=0):
+        if cpus > self.cpus or memory > self.memory:
+            raise ValueError(
+                f"step {step_name} needs {cpus} cpus and {memory} MB, but "
+                f"the node has {self.cpus} cpus and {self.memory} MB")
+        key = (-self._levels.get(step_name, 0.0), -cpus, -memory)
+        with self._lock:
+            heapq.heappush(
+                self._queue, (key, next(self._seq), item, cpus, memory))
+
+    def __len__(self):
+        return len(self._queue)
+
+    def pop(self, limit=None):
+        # Reserves resources for, and returns, the jobs to start now
+        launched = []
+        skipped = []
+        with self._lock:
+            while self._queue and self.used_cpus < self.cpus:
+                if limit is not None and len(launched) >= limit:
+                    break
+                entry = heapq.heappop(self._queue)
+                _, seq, item, cpus, memory = entry
+                if self.fits(cpus, memory):
+                    self._acquire(item, cpus, memory)
+                    launched.append(item)
+                    continue
+                skipped.append(entry)
+                if len(skipped) == 1:
+                    if seq != self._blocked:
+                        self._blocked = seq
+                        self._skips = 0
+                    if self._skips >= self.backfill_limit:
+                        break
+            if skipped and launched:
+                self._skips += 1
+            for entry in skipped:
+                heapq.heappush(self._queue, entry)
+        return launched
+
+    def release(self, item):
+        with self._lock:
+            _, cpus, memory = self._held.pop(id(item))
+            self._account()
+            self.used_cpus -= cpus
+            self.used_memory -= memory
+
+    def clear(self):
+        # Forgets queued and running jobs, e.g. after a run was abandoned
+        with self._lock:
+            self._account()
+            self._queue.clear()
+            self._held.clear()
+            self.used_cpus = 0
+            self.used_memory = 0
+
+    def _acquire(self, item, cpus, memory):
+        self._account()
+        if self._started is None:
+            self._started = self._last
+        self._held[id(item)] = (item, cpus, memory)
+        self.used_cpus += cpus
+        self.used_memory += memory
+        assert self.used_cpus <= self.cpus and self.used_memory <= self.memory
+        self.peak_cpus = max(self.peak_cpus, self.used_cpus)
+        self.peak_memory = max(self.peak_memory, self.used_memory)
+        self.launched += 1
+
+    def _account(self):
+        # Integrates the resources in use over time, for report()
+        now = time.monotonic()
+        if self._last is not None:
+            dt = now - self._last
+            self.cpu_seconds += self.used_cpus * dt
+            self.memory_seconds += self.used_memory * dt
+        self._last = now
+
+    def report(self):
+        wall = 0.0
+        if self._started is not None:
+            wall = self._last - self._started
+        cpu_capacity = self.cpus * wall
+        memory_capacity = self.memory * wall
+        return {
+            "jobs": self.launched,
+            "wall_seconds": wall,
+            "cpu_utilisation":
+                self.cpu_seconds / cpu_capacity if cpu_capacity else 0.0,
+            "memory_utilisation":
+                self.memory_seconds / memory_capacity if memory_capacity else 0.0,
+            "peak_cpus": self.peak_cpus,
+            "peak_memory": self.peak_memory,
+        }
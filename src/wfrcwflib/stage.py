@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import threading
+import time
+
+from wfrcwflib import tracing
+
+
+# Staging puts source files in place for the runners, and hashing reads
+# them for the cache. Both leave moving the bytes to the kernel where they
+# can: links and reflinks copy nothing, copy_file_range and sendfile copy
+# without a round trip through Python, and sha256 over an mmap releases the
+# GIL, so several files hash at once on separate threads.
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors that mean "this method doesn't work here", so try the next one
+unsupported = {
+    errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+    errno.ENOTTY, errno.ENOSYS, errno.EMLINK,
+}
+# Of those, the ones that hold for every file between the same two
+# filesystems. EPERM (e.g. protected_hardlinks on a file we don't own) and
+# EMLINK (the source has too many links) are about the one file.
+unsupported_between_devices = unsupported - {errno.EPERM, errno.EMLINK}
+
+
+def mmap_digest(path, chunk_size=1 << 23):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and things like pipes can't be mapped
+            while chunk := f.read(chunk_size):
+                h.update(chunk)
+            return h.hexdigest()
+        with m, memoryview(m) as view:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            # Slices of the view are windows on the mapping, not copies
+            for start in range(0, len(view), chunk_size):
+                h.update(view[start:start + chunk_size])
+    return h.hexdigest()
+
+
+def reflink(src, dest):
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOTSUP, "reflinks need Linux", src)
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+def kernel_copy(src, dest, chunk_size=1 << 30):
+    # copy_file_range stays in the kernel and can share blocks on some
+    # filesystems (NFS 4.2 server-side copy, XFS, btrfs); sendfile is the
+    # older Linux fallback, and elsewhere shutil does the best it can
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        infd, outfd = fsrc.fileno(), fdest.fileno()
+        size = os.fstat(infd).st_size
+        for copy in (getattr(os, "copy_file_range", None),
+                     getattr(os, "sendfile", None)):
+            if copy is None or not sys.platform.startswith("linux"):
+                continue
+            try:
+                offset = 0
+                while offset < size:
+                    if copy is os.sendfile:
+                        n = copy(outfd, infd, offset, chunk_size)
+                    else:
+                        n = copy(infd, outfd, chunk_size, offset, offset)
+                    if n == 0:
+                        break
+                    offset += n
+                os.lseek(outfd, offset, os.SEEK_SET)
+                return
+            except OSError as e:
+                if e.errno not in unsupported:
+                    raise
+                # Start over with the next method
+                os.ftruncate(outfd, 0)
+                os.lseek(outfd, 0, os.SEEK_SET)
+        shutil.copyfileobj(fsrc, fdest, chunk_size)
+
+def copy_with_stat(src, dest):
+    kernel_copy(src, dest)
+    shutil.copystat(src, dest)
+
+def reflink_with_stat(src, dest):
+    reflink(src, dest)
+    shutil.copystat(src, dest)
+
+def symlink(src, dest):
+    os.symlink(os.path.abspath(src), dest)
+
+# Fastest first. Linked and reflinked files share storage with their
+# source, so staged inputs must never be modified in place.
+stage_methods = {
+    "hardlink": os.link,
+    "reflink": reflink_with_stat,
+    "copy": copy_with_stat,
+    "symlink": symlink,
+}
+
+
+def is_staged(src, dest):
+    # Copies keep the source's mtime, so an unchanged source that was
+    # already staged is left alone
+    try:
+        s = os.stat(src)
+        d = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    if (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino):
+        return True
+    return s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns
+
+
+@dataclass
+class Throughput:
+    files: int = 0
+    bytes: int = 0
+    # Wall time spent in stage() or digest() calls
+    seconds: float = 0.0
+    # method => files, e.g. {"hardlink": 10, "copy": 2, "skipped": 4}
+    methods: collections.Counter = field(default_factory=collections.Counter)
+
+    @property
+    def rate(self):
+        # In MB/s
+        return self.bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+
+@dataclass
+class Stager:
+    # Stages WorkflowFiles into dest_dir, trying each of methods in turn
+    # (see stage_methods) until one works for the file
+    dest_dir: Path
+    methods: tuple[str, ...] = ("hardlink", "reflink", "copy")
+    max_workers: int = 8
+    staged: Throughput = field(default_factory=Throughput)
+    hashed: Throughput = field(default_factory=Throughput)
+
+    def __post_init__(self):
+        for method in self.methods:
+            if method not in stage_methods:
+                raise ValueError(f"unknown staging method {method!r}")
+        self._lock = threading.Lock()
+        # Methods that failed for a (source device, destination device);
+        # once a hardlink fails across two filesystems it always will
+        self._failed = collections.defaultdict(set)
+
+    def stage_file(self, src, dest):
+        # Returns the method used, or "skipped"
+        if is_staged(src, dest):
+            return "skipped"
+        devices = (os.stat(src).st_dev, os.stat(dest.parent).st_dev)
+        tmp = dest.with_name(f".{dest.name}.{threading.get_ident()}.tmp")
+        last_error = None
+        for method in self.methods:
+            if method in self._failed[devices]:
+                continue
+            try:
+                stage_methods[method](src, tmp)
+            except OSError as e:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp)
+                if e.errno not in unsupported:
+                    raise
+                if e.errno in unsupported_between_devices:
+                    with self._lock:
+                        self._failed[devices].add(method)
+                last_error = e
+                continue
+            os.replace(tmp, dest)
+            return method
+        raise last_error or OSError(errno.ENOTSUP, "no staging method", src)
+
+    def stage(self, files):
+        # Returns a staged copy of each WorkflowFile, in order
+        self.dest_dir.mkdir(parents=True, exist_ok=True)
+        files = list(files)
+        started = time.perf_counter()
+        with tracing.span("files.stage", files=len(files)), \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            methods = list(executor.map(
+                lambda f: self.stage_file(f.path, self.dest_dir / f.filename),
+                files))
+        sizes = [os.stat(f.path).st_size for f in files]
+        with self._lock:
+            self.staged.files += len(files)
+            self.staged.bytes += sum(
+                size for size, m in zip(sizes, methods) if m != "skipped")
+            self.staged.seconds += time.perf_counter() - started
+            self.staged.methods.update(methods)
+        return [replace(f, dir=self.dest_dir) for f in files]
+
+    def digest(self, paths, hasher=mmap_digest):
+        # path => sha256, hashing max_workers files at a time
+        paths = list(paths)
+        started = time.perf_counter()
+        with tracing.span("files.digest", files=len(paths)), \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            digests = dict(zip(paths, executor.map(hasher, paths)))
+        with self._lock:
+            self.hashed.files += len(paths)
+            self.hashed.bytes += sum(os.stat(p).st_size for p in paths)
+            self.hashed.seconds += time.perf_counter() - started
+        return digests
+
+    def report(self):
+        return {
+            "staged_files": self.staged.files,
+            "staged_bytes": self.staged.bytes,
+            "staged_mb_per_second": self.staged.rate,
+            "methods": dict(self.staged.methods),
+            "hashed_files": self.hashed.files,
+            "hashed_bytes": self.hashed.bytes,
+            "hashed_mb_per_second": self.hashed.rate,
+        }
@@ -1,48 +1,403 @@
-from dataclasses import dataclass
-from typing import Optional, Callable
-
-class State:
-    pass
-
-@dataclass
-class KeywordState(State):
-    name: str
-    transitions: list[State]
-    terminal: bool = False
-    
-    def check(self, tok):
-        tok == self.name
-
-@dataclass
-class RegexState(State):
-    name: str
-    pattern: str
-    transitions: list[State]
-    terminal: bool = False
-
-    def check(self, tok):
-        re.match(self.pattern, tok)
-
-
-s_step_option_value = RegexState("value", ".+", [s_step_option_value, s_step_argument_sep])
-s_step_option_flag = RegexState("flag", "-", [s_step_option_value, s_step_argument_sep])
-s_step_argument_sep = KeywordState("\n", [s_step_option_flag], terminal = True)
-s_step_resource = RegexState("resource", ".+", [s_step_argument_sep])
-s_step_name_sep = KeywordState("\n", [s_step_resource])
-s_step_name = RegexState("name", "[a-z][a-z_]", [s_step_name_sep]) 
-s_step = KeywordState("step", [s_step_name])
-s_init = KeywordState("init", [s_step])
+import collections
+import re
+
+from wfrcwflib.workflow import (
+    Step, PositionalArgument, OptionalArgument,
+    InputConnector, OutputConnector,
+    UnresolvedWorkflow, placeholders,
+)
+
+
+class ParseError(Exception):
+    def __init__(self, msg, line=None, col=None):
+        if line is not None:
+            msg = f"line {line}, column {col}: {msg}"
+        super().__init__(msg)
+        self.line = line
+        self.col = col
+
+
+# Token kinds. Every non-empty line ends with NEWLINE and every empty (or
+# comment-only) line is a BLANK, which separates paragraphs.
+LBRACE = "lbrace"
+RBRACE = "rbrace"
+FLAG = "flag"
+WORD = "word"
+BAD = "bad"
+NEWLINE = "newline"
+BLANK = "blank"
+EOF = "eof"
+
+# Classifies one whitespace-delimited word; the group that matches names
+# the token kind
+token_re = re.compile(r"""
+    (?P<lbrace>\{$)
+  | (?P<rbrace>\}$)
+  | (?P<flag>-.*)
+  | (?P<word>[^{}].*)
+  | (?P<bad>.+)
+""", re.VERBOSE | re.DOTALL)
+
+class TokenKinds(dict):
+    # Workflow files repeat the same few words (flags, extensions, progs)
+    # over and over, so each distinct word is run through the regex once.
+    def __missing__(self, word):
+        kind = self[word] = token_re.match(word).lastgroup
+        return kind
+
+def split_line(line):
+    code, _, _ = line.partition("#")
+    return code, code.split()
+
+def word_columns(code, words):
+    # Columns are only needed for error messages, so they are recovered
+    # from the line on demand rather than tracked for every token
+    col = 0
+    for word in words:
+        col = code.index(word, col)
+        yield col + 1
+        col += len(word)
+
+def tokenize(lines, kinds=None):
+    # Tokens are plain (kind, text, line, col) tuples; columns are 1-based
+    if kinds is None:
+        kinds = TokenKinds()
+    lineno = 0
+    for lineno, line in enumerate(lines, 1):
+        code, words = split_line(line)
+        if words:
+            for word, col in zip(words, word_columns(code, words)):
+                yield (kinds[word], word, lineno, col)
+            yield (NEWLINE, "", lineno, len(code.rstrip()) + 1)
+        else:
+            yield (BLANK, "", lineno, 1)
+    yield (EOF, "", lineno + 1, 1)
+
+
+connectors = {
+    "input": InputConnector,
+    "output": OutputConnector,
+}
+
+# Settings that may follow a step's name, as name=N
+resources = {"cpus", "memory"}
+
+keywords = {
+    "step": "step_name",
+    "workflow": "workflow_name",
+}
+
+
+# Actions run on a transition. They get the machine and the token text, and
+# may return the next state when the table leaves it open (None).
+
+def begin_paragraph(m, text):
+    if text not in keywords:
+        raise ParseError("invalid keyword")
+    return keywords[text]
+
+def step_name(m, text):
+    m.obj = Step(text, "")
+
+def parse_resource(text):
+    # "cpus=4" => ("cpus", 4); shared with the line-splitting parser
+    key, sep, value = text.partition("=")
+    if not sep:
+        raise ParseError("name must appear by itself")
+    if key not in resources:
+        raise ParseError(f"unknown resource {key!r}")
+    if not value.isdigit():
+        raise ParseError(f"{key} must be a whole number")
+    return key, int(value)
+
+def step_resource(m, text):
+    setattr(m.obj, *parse_resource(text))
+
+def step_prog(m, text):
+    m.obj.prog = text
+
+def begin_optional(m, text):
+    m.flag = text
+    m.values = []
+
+def optional_value(m, text):
+    m.values.append(text)
+
+def end_optional(m, text):
+    m.obj.args.append(OptionalArgument(m.flag, m.values))
+    m.flag = m.values = None
+
+def positional_literal(m, text):
+    m.obj.args.append(PositionalArgument(text))
+
+def begin_positional_connector(m, text):
+    m.connector_return = "positional_end"
+
+def begin_optional_connector(m, text):
+    m.connector_return = "optional_values"
+
+def connector_kind(m, text):
+    if text in placeholders:
+        m.connector_cls = None
+        m.connector_ext = placeholders[text]
+        return "connector_close"
+    if text not in connectors:
+        raise ParseError("invalid connector type")
+    m.connector_cls = connectors[text]
+    return "connector_ext"
+
+def connector_ext(m, text):
+    m.connector_ext = text
+
+def connector_close(m, text):
+    if m.connector_cls is None:
+        c = m.connector_ext
+    else:
+        c = m.connector_cls.shared(m.connector_ext)
+    if m.connector_return == "positional_end":
+        m.obj.args.append(PositionalArgument(c))
+    else:
+        m.values.append(c)
+    return m.connector_return
+
+def workflow_name(m, text):
+    m.obj = UnresolvedWorkflow(text)
+    if m.stream:
+        # Hand the workflow out now; its connections follow one by one
+        m.results.append(m.obj)
+
+def connection_part(m, text):
+    m.connection.append(text)
+
+def connection_end(m, text):
+    m.connection.append(text)
+    from_step, from_output, _, to_step, to_input = m.connection
+    connection = (from_step, from_output, to_step, to_input)
+    if m.stream:
+        m.results.append(connection)
+    else:
+        m.obj.connections.append(connection)
+    m.connection = []
+
+def end_paragraph(m, text):
+    if m.stream and isinstance(m.obj, UnresolvedWorkflow):
+        m.results.append(end_of_connections)
+    else:
+        m.results.append(m.obj)
+    m.obj = None
+
+
+# state => {token kind => (action, next state)}
+transitions = {
+    "start": {
+        BLANK: (None, "start"),
+        WORD: (begin_paragraph, None),
+        EOF: (None, "done"),
+    },
+    "step_name": {
+        WORD: (step_name, "step_header_end"),
+    },
+    "step_header_end": {
+        WORD: (step_resource, "step_header_end"),
+        NEWLINE: (None, "step_prog"),
+    },
+    "step_prog": {
+        WORD: (step_prog, "step_prog_end"),
+        FLAG: (step_prog, "step_prog_end"),
+    },
+    "step_prog_end": {
+        NEWLINE: (None, "argument"),
+    },
+    "argument": {
+        FLAG: (begin_optional, "optional_values"),
+        WORD: (positional_literal, "positional_end"),
+        LBRACE: (begin_positional_connector, "connector_kind"),
+        BLANK: (end_paragraph, "start"),
+        EOF: (end_paragraph, "done"),
+    },
+    "positional_end": {
+        NEWLINE: (None, "argument"),
+    },
+    "optional_values": {
+        WORD: (optional_value, "optional_values"),
+        FLAG: (optional_value, "optional_values"),
+        LBRACE: (begin_optional_connector, "connector_kind"),
+        NEWLINE: (end_optional, "argument"),
+    },
+    "connector_kind": {
+        WORD: (connector_kind, None),
+    },
+    "connector_ext": {
+        WORD: (connector_ext, "connector_close"),
+        FLAG: (connector_ext, "connector_close"),
+    },
+    "connector_close": {
+        RBRACE: (connector_close, None),
+    },
+    "workflow_name": {
+        WORD: (workflow_name, "workflow_header_end"),
+    },
+    "workflow_header_end": {
+        NEWLINE: (None, "connection_from_step"),
+    },
+    "connection_from_step": {
+        WORD: (connection_part, "connection_from_output"),
+        FLAG: (connection_part, "connection_from_output"),
+        BLANK: (end_paragraph, "start"),
+        EOF: (end_paragraph, "done"),
+    },
+    "connection_from_output": {
+        WORD: (connection_part, "connection_arrow"),
+        FLAG: (connection_part, "connection_arrow"),
+    },
+    "connection_arrow": {
+        FLAG: (connection_part, "connection_to_step"),
+    },
+    "connection_to_step": {
+        WORD: (connection_part, "connection_to_input"),
+        FLAG: (connection_part, "connection_to_input"),
+    },
+    "connection_to_input": {
+        WORD: (connection_end, "connection_end"),
+        FLAG: (connection_end, "connection_end"),
+    },
+    "connection_end": {
+        NEWLINE: (None, "connection_from_step"),
+    },
+    "done": {},
+}
+
+# Error message for a token with no transition out of a state
+expected = {
+    "start": "expected 'step' or 'workflow'",
+    "step_name": "expected a step name",
+    "step_header_end": "name must appear by itself",
+    "step_prog": "expected a prog",
+    "step_prog_end": "prog must appear by itself",
+    "argument": "expected an argument",
+    "positional_end": "only one positional argument per line",
+    "optional_values": "expected an argument value",
+    "connector_kind": "expected a connector type",
+    "connector_ext": "connector ext cannot be empty",
+    "connector_close": "connector must end with ' }'",
+    "workflow_name": "expected a workflow name",
+    "workflow_header_end": "name must appear by itself",
+    "connection_from_step": "expected a connection",
+    "connection_from_output": "expected an output",
+    "connection_arrow": "expected an arrow",
+    "connection_to_step": "expected a step",
+    "connection_to_input": "expected an input",
+    "connection_end": "too many tokens in connection",
+    "done": "unexpected token after end of input",
+}
+
+
+# Marks the end of a streamed workflow's connections
+end_of_connections = object()
+
+
+class StreamingConnections:
+    # Single-pass iterator over a workflow's connections, pulled from the
+    # parser as they are read. Like itertools.groupby, moving the parser on
+    # to the next object discards whatever has not been consumed.
+    def __init__(self, events):
+        self._events = events
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.exhausted:
+            raise StopIteration
+        event = next(self._events)
+        if event is end_of_connections:
+            self.exhausted = True
+            raise StopIteration
+        return event
+
+    def __repr__(self):
+        return f"<{type(self).__name__} exhausted={self.exhausted}>"
+
 
 class WFSM:
-    def __init__(self):
-        state = s_init
-
-    def consume(self, tok):
-        next = self.next_state(tok)
-        
-    def next_state(self, tok):
-        for s in self.state.transitions:
-            if s.check(tok):
-                return s
-        return None
-            
+    def __init__(self, stream=False):
+        self.stream = stream
+        self.state = "start"
+        self.results = collections.deque()
+        self.obj = None
+        self.flag = None
+        self.values = None
+        self.connection = []
+        self.connector_cls = None
+        self.connector_ext = None
+        self.connector_return = None
+
+    def advance(self, state, kind, text):
+        # The state after a token of kind in state. Errors carry no
+        # position; the caller knows where the token was.
+        try:
+            action, next_state = transitions[state][kind]
+        except KeyError:
+            raise ParseError(expected[state]) from None
+        if action is not None:
+            res = action(self, text)
+            if next_state is None:
+                next_state = res
+        return next_state
+
+    def consume(self, token):
+        kind, text, line, col = token
+        try:
+            self.state = self.advance(self.state, kind, text)
+        except ParseError as e:
+            raise ParseError(str(e), line, col) from None
+
+    def _error(self, msg, lineno, code, words, i):
+        if i < len(words):
+            col = list(word_columns(code, words))[i]
+        elif words:
+            col = len(code.rstrip()) + 1
+        else:
+            col = 1
+        return ParseError(msg, lineno, col)
+
+    def parse(self, lines):
+        events = self._events(lines)
+        for obj in events:
+            if self.stream and isinstance(obj, UnresolvedWorkflow):
+                connections = obj.connections = StreamingConnections(events)
+                yield obj
+                for _ in connections:
+                    pass
+            else:
+                yield obj
+
+    def _events(self, lines):
+        # Feeds tokenize(lines) through advance(), as consume() would, but
+        # a line at a time, so column numbers are worked out only on error
+        kinds = TokenKinds()
+        results = self.results
+        advance = self.advance
+        state = self.state
+        lineno = 0
+        for lineno, line in enumerate(lines, 1):
+            code, words = split_line(line)
+            texts = words + [""]
+            line_kinds = [kinds[w] for w in words]
+            line_kinds.append(NEWLINE if words else BLANK)
+            for i, kind in enumerate(line_kinds):
+                try:
+                    state = advance(state, kind, texts[i])
+                except ParseError as e:
+                    self.state = state
+                    raise self._error(
+                        str(e), lineno, code, words, i) from None
+            if results:
+                self.state = state
+                while results:
+                    yield results.popleft()
+        self.state = state
+        self.consume((EOF, "", lineno + 1, 1))
+        while results:
+            yield results.popleft()
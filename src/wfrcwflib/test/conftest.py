@@ -0,0 +1,19 @@
+import pytest
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, PositionalArgument,
+    Step, WorkflowFile,
+)
+
+# Shared by the runner tests
+
+def copy_step(name, in_ext, out_ext, prog="cp"):
+    return Step(name, prog, [
+        PositionalArgument(InputConnector(in_ext)),
+        PositionalArgument(OutputConnector(out_ext)),
+    ])
+
+@pytest.fixture
+def source(tmp_path):
+    fp = tmp_path / "sample1.txt"
+    fp.write_text("hello\n")
+    return WorkflowFile(tmp_path, "sample1", ".txt")
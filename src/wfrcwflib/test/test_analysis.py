@@ -0,0 +1,68 @@
+import graphlib
+import random
+import pytest
+from wfrcwflib import tracing
+from wfrcwflib.analysis import (
+    bottom_levels, critical_path, predict_makespan,
+    observations_from_spans, estimate_runtimes,
+)
+
+# a -> b -> d, a -> c -> d, with c the slow branch
+dag = {"a": set(), "b": {"a"}, "c": {"a"}, "d": {"b", "c"}}
+runtimes = {"a": 2.0, "b": 1.0, "c": 5.0, "d": 1.0}
+
+def test_bottom_levels():
+    assert bottom_levels({"a": set(), "b": {"a"}, "c": {"a"}, "d": {"b"}}) == \
+        {"a": 3, "b": 2, "c": 1, "d": 1}
+    assert bottom_levels(dag, runtimes)["a"] == 8.0
+
+def test_critical_path():
+    cp = critical_path(dag, runtimes)
+    assert cp.length == 8.0
+    assert cp.path == ["a", "c", "d"]
+    assert cp.slack == {"a": 0.0, "b": 4.0, "c": 0.0, "d": 0.0}
+    assert cp.earliest_start["d"] == 7.0
+    assert cp.latest_start["b"] == 6.0
+    # Listing order doesn't matter
+    reversed_dag = dict(reversed(dag.items()))
+    assert critical_path(reversed_dag, runtimes) == cp
+
+def test_missing_runtimes_default_to_mean():
+    cp = critical_path(dag, {"a": 2.0, "c": 4.0})
+    assert cp.length == 2.0 + 4.0 + 3.0
+
+def test_predict_makespan():
+    assert predict_makespan(dag, runtimes, workers=1) == 9.0
+    assert predict_makespan(dag, runtimes, workers=2) == 8.0
+    # Two samples on two workers keep both busy: a a, c c, b b, d d
+    assert predict_makespan(dag, runtimes, workers=2, samples=2) == 9.0
+    assert predict_makespan(dag, runtimes, workers=100, samples=10) == 8.0
+
+def test_cycle():
+    with pytest.raises(graphlib.CycleError):
+        critical_path({"a": {"b"}, "b": {"a"}})
+    with pytest.raises(graphlib.CycleError):
+        critical_path({"a": {"a"}})
+
+def test_makespan_bounds_on_random_dag():
+    rng = random.Random(1)
+    n = 2000
+    dag = {i: set(rng.sample(range(i), min(i, 3))) for i in range(n)}
+    times = {i: rng.uniform(1, 10) for i in range(n)}
+    cp = critical_path(dag, times)
+    total = sum(times.values())
+    for workers in (1, 4, 64):
+        makespan = predict_makespan(dag, times, workers)
+        assert max(cp.length, total / workers) - 1e-6 <= makespan
+        # Graham's bound for list scheduling
+        assert makespan <= total / workers + cp.length + 1e-6
+
+def test_observations_from_spans(tmp_path):
+    spans = [
+        tracing.Span("command.run", {"step": "a"}, 0.0, 2.0),
+        tracing.Span("command.run", {"step": "a"}, 0.0, 4.0),
+        tracing.Span("command.run_async", {"step": "b"}, 0.0, 1.0),
+        tracing.Span("workflow.order", {}, 0.0, 1.0),
+    ]
+    observed = observations_from_spans(spans)
+    assert estimate_runtimes(observed) == {"a": 3.0, "b": 1.0}
@@ -0,0 +1,114 @@
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector,
+    PositionalArgument, OptionalArgument,
+    Step, Workflow, WorkflowFile,
+)
+from wfrcwflib.command import LocalRunner
+from wfrcwflib.cache import RunCache, DigestIndex, file_digest
+
+def make_workflow(tail_flag):
+    registry = {
+        "copy": Step("copy", "cp", [
+            PositionalArgument(InputConnector(".txt")),
+            PositionalArgument(OutputConnector(".a")),
+        ]),
+        "sort": Step("sort", "sort", [
+            OptionalArgument(tail_flag),
+            OptionalArgument("-o", [OutputConnector(".b")]),
+            PositionalArgument(InputConnector(".a")),
+        ]),
+    }
+    w = Workflow("copy-sort", registry)
+    w.connect("copy", ".a", "sort", ".a")
+    return w
+
+def test_file_digest(tmp_path):
+    fp = tmp_path / "a.txt"
+    fp.write_text("abc")
+    assert file_digest(fp) == \
+        "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+
+def test_run_cache_skips_current_steps(tmp_path):
+    fp = tmp_path / "s1.txt"
+    fp.write_text("b\na\n")
+    sources = {("copy", ".txt"): WorkflowFile(tmp_path, "s1", ".txt")}
+    manifest = tmp_path / "work" / "manifest.json"
+
+    runner = LocalRunner(tmp_path / "work", cache=RunCache(manifest))
+    runner.run(make_workflow("-f"), sources)
+    assert (runner.cache.hits, runner.cache.misses) == (0, 2)
+    assert manifest.exists()
+
+    # A fresh cache reads the manifest back from disk
+    runner = LocalRunner(tmp_path / "work", cache=RunCache(manifest))
+    runner.run(make_workflow("-f"), sources)
+    assert (runner.cache.hits, runner.cache.misses) == (2, 0)
+
+    # Changing the flags of the downstream step only reruns that step
+    runner.run(make_workflow("-r"), sources)
+    assert (runner.cache.hits, runner.cache.misses) == (3, 1)
+    assert (tmp_path / "work" / "sort" / "s1.b").read_text() == "b\na\n"
+
+    # Changing an input invalidates everything downstream of it
+    fp.write_text("c\nd\n")
+    runner.run(make_workflow("-r"), sources)
+    assert (runner.cache.hits, runner.cache.misses) == (3, 3)
+
+def test_run_cache_force_and_invalidate(tmp_path):
+    fp = tmp_path / "s1.txt"
+    fp.write_text("x\n")
+    sources = {("copy", ".txt"): WorkflowFile(tmp_path, "s1", ".txt")}
+    runner = LocalRunner(
+        tmp_path / "work", cache=RunCache(tmp_path / "manifest.json"))
+    w = make_workflow("-f")
+    runner.run(w, sources)
+
+    runner.run(w, sources, force=True)
+    assert (runner.cache.hits, runner.cache.misses) == (0, 2)
+
+    runner.cache.invalidate("sort")
+    runner.run(w, sources)
+    assert (runner.cache.hits, runner.cache.misses) == (1, 3)
+
+def test_digest_index_trusts_unchanged_files(tmp_path):
+    fp = tmp_path / "reads.fastq"
+    fp.write_text("@r1\nACGT\n+\nIIII\n")
+    db = tmp_path / "work" / "digests.sqlite"
+
+    with DigestIndex(db) as index:
+        wf = WorkflowFile(tmp_path, "reads", ".fastq")
+        assert wf.digest(index) == file_digest(fp)
+        assert wf.digest(index) == file_digest(fp)
+        assert index.rehashed == 1
+
+    # Reopened index has the digest on disk and does not rehash
+    with DigestIndex(db) as index:
+        assert index.is_current(fp)
+        assert index.digest(fp) == file_digest(fp)
+        assert index.rehashed == 0
+
+        fp.write_text("@r1\nACGTA\n+\nIIIII\n")
+        assert not index.is_current(fp)
+        assert index.digest(fp) == file_digest(fp)
+        assert index.rehashed == 1
+
+def test_run_cache_with_digest_index(tmp_path):
+    fp = tmp_path / "s1.txt"
+    fp.write_text("b\na\n")
+    sources = {("copy", ".txt"): WorkflowFile(tmp_path, "s1", ".txt")}
+    manifest = tmp_path / "work" / "manifest.json"
+    db = tmp_path / "work" / "digests.sqlite"
+    index = DigestIndex(db)
+    runner = LocalRunner(tmp_path / "work", cache=RunCache(manifest, index=index))
+    runner.run(make_workflow("-f"), sources)
+    assert index.rehashed == 2
+
+    # The run flushed the index along with the manifest, so a new process
+    # trusts the stored digests instead of hashing again
+    with DigestIndex(db) as reopened:
+        runner = LocalRunner(
+            tmp_path / "work", cache=RunCache(manifest, index=reopened))
+        runner.run(make_workflow("-f"), sources)
+        assert (runner.cache.hits, runner.cache.misses) == (2, 0)
+        assert reopened.rehashed == 0
+    index.close()
@@ -0,0 +1,227 @@
+import os
+import pytest
+from pathlib import Path
+from wfrcwflib import tracing
+from wfrcwflib.workflow import (
+    InputConnector, OutputStdoutConnector,
+    PositionalArgument,
+    Step, Workflow, WorkflowError, RunnableCommand,
+    CommandSpace,
+)
+from wfrcwflib.matrix import SampleMatrix, gather_samples
+from wfrcwflib.cache import RunCache, file_digest
+from wfrcwflib.command import (
+    LocalRunner, AsyncRunner, CommandFailed, Targets, run_batch,
+)
+from conftest import copy_step
+
+def test_local_runner_fan_out(tmp_path, source):
+    registry = {
+        "top": copy_step("top", ".txt", ".a"),
+        "left": copy_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+        "bottom": copy_step("bottom", ".b", ".d"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    w.connect("left", ".b", "bottom", ".b")
+
+    runner = LocalRunner(tmp_path / "work", max_jobs=4)
+    commands = runner.run(w, {("top", ".txt"): source})
+    assert set(commands) == {"top", "left", "right", "bottom"}
+    work = tmp_path / "work"
+    assert (work / "bottom" / "sample1.d").read_text() == "hello\n"
+    assert (work / "right" / "sample1.c").read_text() == "hello\n"
+
+def test_local_runner_stops_on_failure(tmp_path, source):
+    registry = {
+        "copy": copy_step("copy", ".txt", ".a"),
+        "fail": copy_step("fail", ".a", ".b", prog="false"),
+        "after": copy_step("after", ".b", ".c"),
+    }
+    w = Workflow("failing", registry)
+    w.connect("copy", ".a", "fail", ".a")
+    w.connect("fail", ".b", "after", ".b")
+
+    runner = LocalRunner(tmp_path / "work", max_jobs=2)
+    with pytest.raises(CommandFailed) as excinfo:
+        runner.run(w, {("copy", ".txt"): source})
+    assert excinfo.value.step_name == "fail"
+    assert excinfo.value.returncode == 1
+    assert not (tmp_path / "work" / "after").exists()
+
+def echo_step(name, word, prog="echo"):
+    return Step(name, prog, [
+        PositionalArgument(word),
+        PositionalArgument(InputConnector(".txt")),
+    ])
+
+def test_run_batch(tmp_path, source):
+    cat_step = Step("cat", "cat", [PositionalArgument(InputConnector(".txt"))])
+    cat_step.stdout = OutputStdoutConnector(".out")
+    commands = [
+        RunnableCommand(echo_step("e", "one"), tmp_path, {".txt": source}),
+        RunnableCommand(echo_step("f", "two", "false"), tmp_path, {".txt": source}),
+        RunnableCommand(echo_step("e", "it's"), tmp_path, {".txt": source}),
+        RunnableCommand(cat_step, tmp_path / "out", {".txt": source}),
+    ]
+    (tmp_path / "out").mkdir()
+    procs = run_batch(commands)
+    assert [p.returncode for p in procs] == [0, 1, 0, 0]
+    assert procs[0].stdout == f"one {tmp_path}/sample1.txt\n".encode()
+    assert procs[2].stdout == f"it's {tmp_path}/sample1.txt\n".encode()
+    assert procs[3].stdout is None
+    assert (tmp_path / "out" / "sample1.out").read_text() == "hello\n"
+
+def test_local_runner_batches_same_step(tmp_path):
+    w = Workflow("copy", {"copy": copy_step("copy", ".txt", ".a")})
+    w._add_step("copy")
+    files = []
+    for i in range(7):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"{i}\n")
+        files.append(fp)
+    m = SampleMatrix(w, gather_samples(w, files), window=7)
+
+    runner = LocalRunner(tmp_path / "work", max_jobs=2, batch_size=3)
+    with tracing.enabled(tracing.TimingTracer()) as tracer:
+        assert len(runner.run_matrix(m)) == 7
+    for i in range(7):
+        assert (tmp_path / "work" / "copy" / f"s{i}.a").read_text() == f"{i}\n"
+    # Seven ready jobs go out as batches of 3 and 3, and one on its own
+    assert tracer.totals()["command.run_batch"][0] == 2
+    assert tracer.totals()["command.run"][0] == 1
+
+def cat_step(name, in_ext, out_ext):
+    step = Step(name, "cat", [PositionalArgument(InputConnector(in_ext))])
+    step.stdout = OutputStdoutConnector(out_ext)
+    return step
+
+def test_run_writes_and_closes_stdout(tmp_path, source):
+    command = RunnableCommand(cat_step("cat", ".txt", ".out"), tmp_path, {".txt": source})
+    assert command.run().returncode == 0
+    assert (tmp_path / "sample1.out").read_text() == "hello\n"
+
+def test_async_runner_streams_stdout(tmp_path):
+    registry = {
+        "top": cat_step("top", ".txt", ".a"),
+        "left": cat_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    # Enough output to fill the pipe many times over
+    data = b"".join(b"%d\n" % i for i in range(300000))
+    files = []
+    for i in range(20):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_bytes(data)
+        files.append(fp)
+    m = SampleMatrix(w, gather_samples(w, files), window=5)
+
+    runner = AsyncRunner(tmp_path / "work", max_jobs=8, chunk_size=4096)
+    assert sorted(runner.run_matrix(m)) == sorted(f"s{i}" for i in range(20))
+    for i in range(20):
+        assert (tmp_path / "work" / "left" / f"s{i}.b").read_bytes() == data
+        assert (tmp_path / "work" / "right" / f"s{i}.c").read_bytes() == data
+
+def test_async_runner_stops_on_failure(tmp_path, source):
+    registry = {
+        "copy": copy_step("copy", ".txt", ".a"),
+        "fail": copy_step("fail", ".a", ".b", prog="false"),
+        "after": copy_step("after", ".b", ".c"),
+    }
+    w = Workflow("failing", registry)
+    w.connect("copy", ".a", "fail", ".a")
+    w.connect("fail", ".b", "after", ".b")
+
+    with pytest.raises(CommandFailed) as excinfo:
+        AsyncRunner(tmp_path / "work").run(w, {("copy", ".txt"): source})
+    assert excinfo.value.step_name == "fail"
+    assert not (tmp_path / "work" / "after").exists()
+
+def fan_out(tmp_path, n):
+    registry = {
+        "top": copy_step("top", ".txt", ".a"),
+        "left": copy_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+        "bottom": copy_step("bottom", ".b", ".d"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    w.connect("left", ".b", "bottom", ".b")
+    files = []
+    for i in range(n):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"{i}\n")
+        files.append(fp)
+    return w, list(gather_samples(w, files))
+
+@pytest.mark.parametrize("runner_class", [LocalRunner, AsyncRunner])
+def test_run_targets(tmp_path, runner_class):
+    w, samples = fan_out(tmp_path, 2)
+    work = tmp_path / "work"
+    runner = runner_class(work, max_jobs=2)
+    ran = runner.run_targets(w, samples, [("left", ".b")])
+    assert {name: set(cs) for name, cs in ran.items()} == \
+        {"s0": {"top", "left"}, "s1": {"top", "left"}}
+    assert not (work / "right").exists() and not (work / "bottom").exists()
+
+    # Up to date, so nothing runs
+    ran = runner.run_targets(w, samples, [("left", ".b")])
+    assert ran == {"s0": {}, "s1": {}}
+
+    # s1's source changed and only s1's bottom output is asked for; s0's
+    # left is still up to date
+    os.utime(tmp_path / "s1.txt", ns=(0, (work / "top" / "s1.a").stat().st_mtime_ns + 10**9))
+    ran = runner.run_targets(w, samples, [work / "bottom" / "s1.d", "left"])
+    assert ran["s0"] == {}
+    assert set(ran["s1"]) == {"top", "left", "bottom"}
+    assert (work / "bottom" / "s1.d").read_text() == "1\n"
+
+def test_run_targets_hashes_inputs_once(tmp_path):
+    w, samples = fan_out(tmp_path, 1)
+    hashed = []
+    def hasher(path):
+        hashed.append(os.path.basename(path))
+        return file_digest(path)
+    cache = RunCache(tmp_path / "cache.json", hasher)
+    runner = LocalRunner(tmp_path / "work", cache=cache)
+    # Pruning finds top out of date; launching it doesn't check again
+    runner.run_targets(w, samples, [("left", ".b")])
+    assert hashed.count("s0.txt") == 1
+    hashed.clear()
+    runner.run_targets(w, samples, [("left", ".b")])
+    assert hashed.count("s0.txt") == 1
+
+def test_run_targets_unknown_output(tmp_path):
+    w, samples = fan_out(tmp_path, 1)
+    with pytest.raises(WorkflowError):
+        LocalRunner(tmp_path / "work").run_targets(w, samples, [("left", ".zzz")])
+
+def test_run_targets_unmatched(tmp_path, monkeypatch):
+    w, samples = fan_out(tmp_path, 2)
+    runner = LocalRunner(tmp_path / "work")
+    with pytest.raises(WorkflowError):
+        runner.run_targets(w, samples, ["lefft"])
+    with pytest.raises(WorkflowError):
+        runner.run_targets(w, samples, [tmp_path / "work" / "left" / "s9.b"])
+
+    # Relative intermediate_dir, absolute target
+    monkeypatch.chdir(tmp_path)
+    runner = LocalRunner(Path("work"))
+    ran = runner.run_targets(w, samples, [tmp_path / "work" / "left" / "s1.b"])
+    assert set(ran["s1"]) == {"top", "left"} and ran["s0"] == {}
+
+def test_prune_makes_no_dirs(tmp_path):
+    w, samples = fan_out(tmp_path, 1)
+    runner = LocalRunner(tmp_path / "work")
+    dag, units = runner.plan(w)
+    files = CommandSpace(w, runner.intermediate_dir).file_space(samples[0].sources)
+    pruned = runner.prune(w, dag, units, files, Targets(w, ["bottom"]))
+    assert pruned == {"top": set(), "left": {"top"}, "bottom": {"left"}}
+    # Checking whether jobs are up to date touches nothing
+    assert not (tmp_path / "work").exists()
@@ -0,0 +1,92 @@
+import os
+import pytest
+from wfrcwflib.conda import CondaEnvironments
+from wfrcwflib.command import LocalRunner
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, PositionalArgument,
+    Step, Workflow, WorkflowFile,
+)
+
+fake_conda = """\
+#!/bin/sh
+# Stands in for `conda run -n NAME cmd...`
+shift; shift; name=$1; shift
+echo "$name" >> "{root}/calls.log"
+export CONDA_PREFIX="{root}/envs/$name"
+export PATH="$CONDA_PREFIX/bin:$PATH"
+exec "$@"
+"""
+
+@pytest.fixture
+def conda_root(tmp_path):
+    conda = tmp_path / "conda"
+    conda.write_text(fake_conda.format(root=tmp_path))
+    conda.chmod(0o755)
+    env_bin = tmp_path / "envs" / "tools" / "bin"
+    env_bin.mkdir(parents=True)
+    (tmp_path / "envs" / "tools" / "conda-meta").mkdir()
+    (tmp_path / "envs" / "tools" / "conda-meta" / "history").touch()
+    shout = env_bin / "shout"
+    shout.write_text("#!/bin/sh\ntr a-z A-Z < \"$1\" > \"$2\"\n")
+    shout.chmod(0o755)
+    return tmp_path
+
+def calls(root):
+    return (root / "calls.log").read_text().split()
+
+def test_environment_is_activated_once(conda_root):
+    envs = CondaEnvironments(
+        conda_root / "envs.json", conda=str(conda_root / "conda"))
+    env = envs.environ("tools")
+    assert env["CONDA_PREFIX"] == str(conda_root / "envs" / "tools")
+    assert env["PATH"].startswith(str(conda_root / "envs" / "tools" / "bin"))
+    envs.environ("tools")
+    assert calls(conda_root) == ["tools"]
+
+    # The cache file carries activations over to new processes
+    envs = CondaEnvironments(
+        conda_root / "envs.json", conda=str(conda_root / "conda"))
+    envs.environ("tools")
+    assert calls(conda_root) == ["tools"]
+
+    # Changing the env invalidates its activation
+    history = conda_root / "envs" / "tools" / "conda-meta" / "history"
+    st = history.stat()
+    os.utime(history, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    envs.environ("tools")
+    assert calls(conda_root) == ["tools", "tools"]
+
+def test_runner_launches_in_activated_env(conda_root):
+    fp = conda_root / "s1.txt"
+    fp.write_text("quiet\n")
+    shout = Step("shout", "shout", [
+        PositionalArgument(InputConnector(".txt")),
+        PositionalArgument(OutputConnector(".out")),
+    ])
+    w = Workflow("shout", {"shout": shout})
+    w._add_step("shout")
+    runner = LocalRunner(
+        conda_root / "work",
+        conda_envs={"shout": "tools"},
+        environments=CondaEnvironments(conda=str(conda_root / "conda")),
+    )
+    commands = runner.run(w, {("shout", ".txt"): WorkflowFile(conda_root, "s1", ".txt")})
+    assert commands["shout"].command_args()[:4] == ["conda", "run", "-n", "tools"]
+    assert (conda_root / "work" / "shout" / "s1.out").read_text() == "QUIET\n"
+    assert calls(conda_root) == ["tools"]
+
+def test_changed_base_environment_reactivates(conda_root, monkeypatch):
+    envs = CondaEnvironments(
+        conda_root / "envs.json", conda=str(conda_root / "conda"))
+    envs.environ("tools")
+    # A later process with another PATH must not get the old one back
+    extra = str(conda_root / "extra")
+    monkeypatch.setenv("PATH", extra + os.pathsep + os.environ["PATH"])
+    envs = CondaEnvironments(
+        conda_root / "envs.json", conda=str(conda_root / "conda"))
+    env = envs.environ("tools")
+    assert calls(conda_root) == ["tools", "tools"]
+    assert env["PATH"].split(os.pathsep)[:2] == [
+        str(conda_root / "envs" / "tools" / "bin"), extra]
+    envs.environ("tools")
+    assert calls(conda_root) == ["tools", "tools"]
@@ -0,0 +1,169 @@
+import pytest
+from wfrcwflib.workflow import (
+    InputConnector, OutputStdoutConnector, StdinConnector,
+    PositionalArgument,
+    Step, Workflow, RunnableCommand,
+)
+from wfrcwflib.executor import BatchExecutor, Job, DONE, FAILED
+from wfrcwflib.command import ExecutorRunner, CommandFailed, job_name
+from wfrcwflib.cache import RunCache
+from wfrcwflib.matrix import SampleMatrix, gather_samples
+from conftest import copy_step
+
+# Stands in for sbatch, squeue and scancel: jobs run in the background
+# and their pid is the job id
+FAKE_SCHEDULER = """\
+#!/bin/sh
+echo "$*" >> "$(dirname "$0")/calls"
+cmd="$1"
+shift
+case "$cmd" in
+submit) nohup sh "$1" > /dev/null 2>&1 & echo "$!" ;;
+status) for id in "$@"; do kill -0 "$id" 2>/dev/null && echo "$id"; done ;;
+cancel) kill "$@" ;;
+esac
+exit 0
+"""
+
+@pytest.fixture
+def fake_scheduler(tmp_path):
+    fp = tmp_path / "sched" / "fakesched"
+    fp.parent.mkdir()
+    fp.write_text(FAKE_SCHEDULER)
+    fp.chmod(0o755)
+    return fp
+
+def batch_executor(tmp_path, sched, **kwargs):
+    return BatchExecutor(
+        tmp_path / "jobs",
+        submit_command=f"{sched} submit {{script}}",
+        status_command=f"{sched} status {{ids}}",
+        cancel_command=f"{sched} cancel {{ids}}",
+        poll_interval=0.05,
+        **kwargs)
+
+def test_batch_executor_runs_workflow(tmp_path, fake_scheduler, source):
+    registry = {
+        "top": copy_step("top", ".txt", ".a"),
+        "left": copy_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+
+    executor = batch_executor(tmp_path, fake_scheduler)
+    runner = ExecutorRunner(tmp_path / "work", max_jobs=4, executor=executor)
+    commands = runner.run(w, {("top", ".txt"): source})
+    assert set(commands) == {"top", "left", "right"}
+    assert (tmp_path / "work" / "right" / "sample1.c").read_text() == "hello\n"
+    calls = (fake_scheduler.parent / "calls").read_text().splitlines()
+    assert sum(c.startswith("submit") for c in calls) == 3
+    # At most one status call per poll, however many jobs are out
+    assert sum(c.startswith("status") for c in calls) <= executor.polls
+
+def test_batch_executor_pipeline(tmp_path, fake_scheduler, source):
+    cat = Step("cat", "cat", [PositionalArgument(InputConnector(".txt"))])
+    cat.stdout = OutputStdoutConnector(".raw")
+    upper = Step("upper", "tr", [PositionalArgument("a-z"), PositionalArgument("A-Z")])
+    upper.stdin = StdinConnector(".raw")
+    upper.stdout = OutputStdoutConnector(".up")
+    w = Workflow("chain", {"cat": cat, "upper": upper})
+    w.connect("cat", ".raw", "upper", ".raw")
+
+    executor = batch_executor(tmp_path, fake_scheduler)
+    runner = ExecutorRunner(tmp_path / "work", executor=executor, pipes=True)
+    runner.run(w, {("cat", ".txt"): source})
+    work = tmp_path / "work"
+    assert (work / "cat" / "sample1.raw").read_text() == "hello\n"
+    assert (work / "upper" / "sample1.up").read_text() == "HELLO\n"
+
+def test_batch_executor_reports_each_status(tmp_path, fake_scheduler, source):
+    executor = batch_executor(tmp_path, fake_scheduler)
+    jobs = [
+        Job("ok", RunnableCommand(copy_step("ok", ".txt", ".a"), tmp_path, {".txt": source})),
+        Job("bad", RunnableCommand(copy_step("bad", ".txt", ".b", "false"), tmp_path, {".txt": source})),
+    ]
+    for job in jobs:
+        executor.submit(job)
+    finished = []
+    while len(finished) < 2:
+        finished.extend(executor.poll(timeout=10))
+    assert [(j.state, j.returncodes) for j in jobs] == [(DONE, [0]), (FAILED, [1])]
+
+def test_batch_executor_lost_job(tmp_path, fake_scheduler, source):
+    # The job is accepted but never runs, and drops out of the queue
+    executor = batch_executor(tmp_path, fake_scheduler, lost_after=2)
+    executor.submit_command = "echo 999999999"
+    job = Job("lost", RunnableCommand(copy_step("c", ".txt", ".a"), tmp_path, {".txt": source}))
+    executor.submit(job)
+    assert executor.poll(timeout=10) == [job]
+    assert job.state == FAILED and job.returncodes == [None]
+    assert executor.polls == 2
+
+def test_executor_runner_stops_on_failure(tmp_path, source):
+    registry = {
+        "copy": copy_step("copy", ".txt", ".a"),
+        "fail": copy_step("fail", ".a", ".b", prog="false"),
+        "after": copy_step("after", ".b", ".c"),
+    }
+    w = Workflow("failing", registry)
+    w.connect("copy", ".a", "fail", ".a")
+    w.connect("fail", ".b", "after", ".b")
+
+    runner = ExecutorRunner(tmp_path / "work", max_jobs=2)
+    with pytest.raises(CommandFailed) as excinfo:
+        runner.run(w, {("copy", ".txt"): source})
+    assert excinfo.value.step_name == "fail"
+    assert not (tmp_path / "work" / "after").exists()
+
+def test_batch_executor_resources(tmp_path, source):
+    executor = BatchExecutor(tmp_path / "jobs")
+    step = copy_step("c", ".txt", ".a")
+    job = Job("c", RunnableCommand(step, tmp_path, {".txt": source}))
+    # Undeclared memory is left to the scheduler's default
+    assert executor.resources(job) == "--cpus-per-task=1"
+    step.memory = 2048
+    step.cpus = 4
+    assert executor.resources(job) == "--cpus-per-task=4 --mem=2048M"
+
+def test_batch_executor_status_failure(tmp_path, fake_scheduler, source):
+    # A failing status command says nothing about which jobs are gone
+    executor = batch_executor(tmp_path, fake_scheduler, lost_after=1)
+    executor.submit_command = "echo 999999999"
+    executor.status_command = "false {ids}"
+    job = Job("lost", RunnableCommand(copy_step("c", ".txt", ".a"), tmp_path, {".txt": source}))
+    executor.submit(job)
+    assert executor.poll(timeout=0.2) == []
+    assert executor.status_failures >= 2
+    assert job.state == "running"
+
+def test_job_names_stay_distinct():
+    names = [job_name("a b", "c"), job_name("a_b", "c"),
+             job_name("a.b", "c"), job_name("a", "b.c")]
+    assert len(set(names)) == 4
+    assert all(n.replace(".", "").replace("_", "").isalnum() for n in names)
+    assert job_name("s1", "top").startswith("s1.top.")
+
+def test_executor_runner_cached_fan_out(tmp_path):
+    # On a rerun both branches of each sample are cache hits, and they are
+    # marked done together
+    registry = {
+        "top": copy_step("top", ".txt", ".a"),
+        "left": copy_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    files = []
+    for i in range(2):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"{i}\n")
+        files.append(fp)
+    cache = RunCache(tmp_path / "cache.json")
+    for _ in range(2):
+        runner = ExecutorRunner(tmp_path / "work", max_jobs=2, cache=cache)
+        m = SampleMatrix(w, gather_samples(w, files), window=1)
+        assert sorted(runner.run_matrix(m)) == ["s0", "s1"]
+    assert cache.hits == 6
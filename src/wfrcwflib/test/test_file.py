@@ -0,0 +1,71 @@
+import pytest
+from wfrcwflib.file import (
+    SuffixedFiletype, SuffixedFiletypeBundle, FiletypeRegistry,
+    FiletypeScanner, FileMatch, FileSource, MultiFileSource,
+)
+
+csv_filetype = SuffixedFiletype("csv", ".csv")
+fasta_filetype = SuffixedFiletype("fasta", ".fasta", [".fna", ".fa"])
+fastq_r1 = SuffixedFiletype("r1", "_R1.fastq")
+fastq_r2 = SuffixedFiletype("r2", "_R2.fastq")
+paired_fastq = SuffixedFiletypeBundle("paired-fastq", (fastq_r1, fastq_r2))
+
+@pytest.fixture
+def run_dir(tmp_path):
+    for name in [
+        "a.csv", "b.fna", "c.fa", "notes.txt", "s1_R2.fastq", "s1_R1.fastq",
+        "s2_R1.fastq", ".csv",
+    ]:
+        (tmp_path / name).touch()
+    (tmp_path / "subdir.csv").mkdir()
+    return tmp_path
+
+def test_scanner_classify():
+    s = FiletypeScanner([fasta_filetype, paired_fastq])
+    assert list(s.classify("x.fa")) == [(fasta_filetype, None, "x")]
+    assert list(s.classify("x_R2.fastq")) == [(paired_fastq, 1, "x")]
+    assert list(s.classify("x.fastq")) == []
+    assert list(s.classify(".fa")) == []
+
+def test_registry_scan(run_dir):
+    registry = FiletypeRegistry()
+    registry.register(csv_filetype)
+    registry.register(fasta_filetype)
+    registry.register(paired_fastq)
+    matches = sorted(registry.scan(run_dir), key=lambda m: m.stem)
+    assert matches == [
+        FileMatch(csv_filetype, "a", (run_dir / "a.csv",)),
+        FileMatch(fasta_filetype, "b", (run_dir / "b.fna",)),
+        FileMatch(fasta_filetype, "c", (run_dir / "c.fa",)),
+        FileMatch(paired_fastq, "s1", (
+            run_dir / "s1_R1.fastq", run_dir / "s1_R2.fastq")),
+    ]
+
+def test_suffixed_filetype_gather(run_dir):
+    assert sorted(fasta_filetype.gather(run_dir)) == \
+        [run_dir / "b.fna", run_dir / "c.fa"]
+
+def test_file_source_gather(run_dir):
+    src = FileSource(run_dir, csv_filetype)
+    assert [m.paths for m in src.gather()] == [(run_dir / "a.csv",)]
+
+def test_multi_file_source_gather(tmp_path):
+    for relpath in [
+        "run1/s1_R1.fastq", "run1/s1_R2.fastq",
+        "run1/lane2/s3_R1.fastq", "run1/lane2/s3_R2.fastq",
+        "run2/s2_R1.fastq", "run2/s2_R2.fastq",
+        "run2/undetermined/u_R1.fastq", "run2/undetermined/u_R2.fastq",
+        "run2/a/b/deep_R1.fastq", "run2/a/b/deep_R2.fastq",
+    ]:
+        fp = tmp_path / relpath
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.touch()
+    src = MultiFileSource(
+        [tmp_path / "run2", tmp_path / "run1"], paired_fastq,
+        max_depth=1, exclude=["undetermined"])
+    matches = src.gather()
+    assert [m.stem for m in matches] == ["s3", "s1", "s2"]
+    assert matches[0].paths == (
+        tmp_path / "run1" / "lane2" / "s3_R1.fastq",
+        tmp_path / "run1" / "lane2" / "s3_R2.fastq",
+    )
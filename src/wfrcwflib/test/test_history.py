@@ -0,0 +1,75 @@
+import sys
+import pytest
+from wfrcwflib.history import RunHistory, percentile
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, PositionalArgument,
+    Step, Workflow, WorkflowFile, RunnableCommand,
+)
+from wfrcwflib.matrix import SampleMatrix, gather_samples
+from wfrcwflib.command import LocalRunner, AsyncRunner
+
+def zeros_step(name, size):
+    # Copies its input, then appends size zero bytes
+    return Step(name, "sh", [
+        PositionalArgument("-c"),
+        PositionalArgument(f'cat "$1" > "$2"; head -c {size} /dev/zero >> "$2"'),
+        PositionalArgument("sh"),
+        PositionalArgument(InputConnector(".txt")),
+        PositionalArgument(OutputConnector(".z")),
+    ])
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([4.0], 90) == 4.0
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 50) == 3.0
+    assert percentile([1.0, 2.0], 75) == 1.75
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs /proc")
+def test_run_records_metrics(tmp_path):
+    fp = tmp_path / "s1.txt"
+    fp.write_text("x\n")
+    command = RunnableCommand(
+        zeros_step("zeros", 3_000_000), tmp_path,
+        {".txt": WorkflowFile(tmp_path, "s1", ".txt")})
+    assert command.run().returncode == 0
+    m = command.metrics
+    assert m.wall > 0
+    assert m.max_rss > 0
+    assert m.wchar >= 3_000_000
+    assert m.rchar >= 3_000_000
+
+@pytest.mark.parametrize("runner_cls", [LocalRunner, AsyncRunner])
+def test_runner_records_history(tmp_path, runner_cls):
+    registry = {"small": zeros_step("small", 1000)}
+    registry["large"] = zeros_step("large", 2_000_000)
+    registry["large"].args[3] = PositionalArgument(InputConnector(".z"))
+    w = Workflow("zeros", registry)
+    w.connect("small", ".z", "large", ".z")
+    files = []
+    for i in range(4):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"{i}\n")
+        files.append(fp)
+
+    with RunHistory(tmp_path / "history.sqlite") as history:
+        runner = runner_cls(tmp_path / "work", max_jobs=2, history=history)
+        runner.run_matrix(SampleMatrix(w, gather_samples(w, files)))
+        jobs = history.jobs("large")
+        assert sorted(j["inputs"] for j in jobs) == ["s0", "s1", "s2", "s3"]
+        assert all(j["run_id"] == history.run_id for j in jobs)
+        assert all(j["returncode"] == 0 for j in jobs)
+
+    # A second run, in a new history, adds to the same database
+    with RunHistory(tmp_path / "history.sqlite") as history:
+        runner = runner_cls(tmp_path / "work2", history=history)
+        runner.run_matrix(SampleMatrix(w, gather_samples(w, files[:1])))
+        ps = history.percentiles("wall", (50, 90))
+        assert set(ps) == {"small", "large"}
+        assert 0 < ps["large"][50] <= ps["large"][90]
+        assert len(history.jobs("small")) == 5
+        assert set(history.runtimes()) == {"small", "large"}
+        if sys.platform.startswith("linux"):
+            written = history.percentiles("wchar", (0,))
+            assert written["large"][0] >= 2_000_000 > written["small"][0]
+        with pytest.raises(ValueError):
+            history.percentiles("wall; DROP TABLE jobs")
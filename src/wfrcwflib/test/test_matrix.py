@@ -0,0 +1,87 @@
+import pytest
+from wfrcwflib.workflow import (
+    InputConnector,
+    PositionalArgument,
+    Step, Workflow, WorkflowFile,
+)
+from wfrcwflib.matrix import Sample, SampleMatrix, gather_samples
+from wfrcwflib.command import LocalRunner, AsyncRunner
+from conftest import copy_step
+
+@pytest.fixture
+def workflow():
+    registry = {
+        "first": copy_step("first", ".txt", ".a"),
+        "second": copy_step("second", ".a", ".b"),
+    }
+    w = Workflow("copy-copy", registry)
+    w.connect("first", ".a", "second", ".a")
+    return w
+
+def test_sample_from_paired_files(tmp_path):
+    paste = Step("paste", "paste", [
+        PositionalArgument(InputConnector("_R1.fastq")),
+        PositionalArgument(InputConnector("_R2.fastq")),
+    ])
+    w = Workflow("paste", {"paste": paste})
+    w._add_step("paste")
+    s = Sample.from_files(w, [tmp_path / "s1_R1.fastq", tmp_path / "s1_R2.fastq"])
+    assert s.name == "s1"
+    assert s.sources == {
+        ("paste", "_R1.fastq"): WorkflowFile(tmp_path, "s1", "_R1.fastq"),
+        ("paste", "_R2.fastq"): WorkflowFile(tmp_path, "s1", "_R2.fastq"),
+    }
+    with pytest.raises(ValueError):
+        Sample.from_files(w, [tmp_path / "s1_R1.fastq"])
+
+def test_sample_matrix_jobs(tmp_path, workflow):
+    files = [tmp_path / f"s{i}.txt" for i in range(3)]
+    m = SampleMatrix(workflow, list(gather_samples(workflow, files)))
+    assert list(m.jobs()) == [
+        (("s0", "first"), set()),
+        (("s0", "second"), {("s0", "first")}),
+        (("s1", "first"), set()),
+        (("s1", "second"), {("s1", "first")}),
+        (("s2", "first"), set()),
+        (("s2", "second"), {("s2", "first")}),
+    ]
+    assert [[s.name for s in c] for c in m.chunks(2)] == [["s0", "s1"], ["s2"]]
+
+def test_run_matrix(tmp_path, workflow):
+    files = []
+    for i in range(5):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"sample {i}\n")
+        files.append(fp)
+    # A generator keeps the samples lazy all the way into the runner
+    m = SampleMatrix(workflow, gather_samples(workflow, files), window=2)
+    runner = LocalRunner(tmp_path / "work", max_jobs=3)
+    completed = runner.run_matrix(m)
+    assert sorted(completed) == ["s0", "s1", "s2", "s3", "s4"]
+    for i in range(5):
+        out = tmp_path / "work" / "second" / f"s{i}.b"
+        assert out.read_text() == f"sample {i}\n"
+
+@pytest.mark.parametrize("runner_cls", [LocalRunner, AsyncRunner])
+def test_run_matrix_fan_out(tmp_path, runner_cls):
+    # Parallel steps of one sample often finish together
+    registry = {
+        "top": copy_step("top", ".txt", ".a"),
+        "left": copy_step("left", ".a", ".b"),
+        "right": copy_step("right", ".a", ".c"),
+    }
+    w = Workflow("fan-out", registry)
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    files = []
+    for i in range(20):
+        fp = tmp_path / f"s{i}.txt"
+        fp.write_text(f"sample {i}\n")
+        files.append(fp)
+    m = SampleMatrix(w, gather_samples(w, files), window=4)
+    runner = runner_cls(tmp_path / "work", max_jobs=8)
+    completed = runner.run_matrix(m)
+    assert sorted(completed) == sorted(f"s{i}" for i in range(20))
+    for i in range(20):
+        assert (tmp_path / "work" / "right" / f"s{i}.c").read_text() == \
+            f"sample {i}\n"
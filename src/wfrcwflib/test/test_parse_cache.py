@@ -0,0 +1,112 @@
+import os
+from wfrcwflib import parse as parse_module
+from wfrcwflib.parse import load, load_registry, cache_path, encode, decode
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, OutputStdoutConnector, StdinConnector,
+    PositionalArgument, OptionalArgument,
+    Step, UnresolvedWorkflow,
+)
+
+library = """\
+step copy_1 # copy the toml
+  cp
+  { input .toml }
+  { output .txt }
+
+step copy_2
+  cp
+  -v
+  { input .txt }
+  { output .config }
+
+workflow double_copy
+  copy_1 .txt --> copy_2 .txt
+"""
+
+expected = [
+    Step("copy_1", "cp", [
+        PositionalArgument(InputConnector(".toml")),
+        PositionalArgument(OutputConnector(".txt")),
+    ]),
+    Step("copy_2", "cp", [
+        OptionalArgument("-v"),
+        PositionalArgument(InputConnector(".txt")),
+        PositionalArgument(OutputConnector(".config")),
+    ]),
+    UnresolvedWorkflow("double_copy", [
+        ("copy_1", ".txt", "copy_2", ".txt"),
+    ]),
+]
+
+def forbid_parse(monkeypatch):
+    def fail(lines):
+        raise AssertionError("parse should not run on a warm start")
+    monkeypatch.setattr(parse_module, "parse", fail)
+
+def test_load_uses_cache(tmp_path, monkeypatch):
+    fp = tmp_path / "library.wf"
+    fp.write_text(library)
+    assert load(fp) == expected
+    assert cache_path(fp).exists()
+
+    forbid_parse(monkeypatch)
+    assert load(fp) == expected
+
+    # Same content with a new mtime is recognised by its hash
+    st = fp.stat()
+    os.utime(fp, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert load(fp) == expected
+
+def test_load_reparses_changed_file(tmp_path):
+    fp = tmp_path / "library.wf"
+    fp.write_text(library)
+    cache_dir = tmp_path / "cache"
+    load(fp, cache_dir)
+    fp.write_text(library.replace("-v", "-n"))
+    objs = load(fp, cache_dir)
+    assert objs[1].args[0] == OptionalArgument("-n")
+
+def test_load_ignores_corrupt_cache(tmp_path):
+    fp = tmp_path / "library.wf"
+    fp.write_text(library)
+    cp = cache_path(fp)
+    cp.parent.mkdir()
+    cp.write_bytes(b"not a pickle")
+    assert load(fp) == expected
+
+def test_load_registry(tmp_path, monkeypatch):
+    fp = tmp_path / "library.wf"
+    fp.write_text(library)
+    load(fp)
+    forbid_parse(monkeypatch)
+    steps, workflows = load_registry(fp)
+    assert list(steps) == ["copy_1", "copy_2"]
+    assert steps["copy_2"] == expected[1]
+    assert steps["copy_2"] is steps["copy_2"]
+    w = workflows["double_copy"].resolve(steps)
+    assert w.order == ["copy_1", "copy_2"]
+
+def test_encode_round_trips_stdio():
+    step = Step("sort", "sort", [OptionalArgument("-k", ["2"])])
+    step.stdin = StdinConnector(".sam")
+    step.stdout = OutputStdoutConnector(".sorted")
+    assert decode(encode(step)) == step
+
+def test_load_checks_content_and_path(tmp_path):
+    fp = tmp_path / "library.wf"
+    fp.write_text(library)
+    st = fp.stat()
+    load(fp)
+    # An edit that keeps the size and mtime is still seen
+    fp.write_text(library.replace("-v", "-n"))
+    os.utime(fp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert load(fp)[1].args[0] == OptionalArgument("-n")
+
+    # Files of the same name in different directories share a cache_dir
+    cache_dir = tmp_path / "cache"
+    other = tmp_path / "other" / "library.wf"
+    other.parent.mkdir()
+    other.write_text(library)
+    assert cache_path(fp, cache_dir) != cache_path(other, cache_dir)
+    load(fp, cache_dir)
+    assert load(other, cache_dir) == expected
@@ -0,0 +1,103 @@
+import pytest
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, OutputStdoutConnector, StdinConnector,
+    PositionalArgument,
+    Step, Workflow, WorkflowError, WorkflowFile,
+)
+from wfrcwflib.pipeline import fuse_pipes
+from wfrcwflib.matrix import Sample
+from wfrcwflib.command import LocalRunner, AsyncRunner, CommandFailed
+
+def filter_step(name, prog, args, in_ext, out_ext):
+    # Reads in_ext on stdin and writes out_ext on stdout
+    step = Step(name, prog, [PositionalArgument(a) for a in args])
+    step.stdin = StdinConnector(in_ext)
+    step.stdout = OutputStdoutConnector(out_ext)
+    return step
+
+def registry():
+    cat = Step("cat", "cat", [PositionalArgument(InputConnector(".txt"))])
+    cat.stdout = OutputStdoutConnector(".raw")
+    return {
+        "cat": cat,
+        "upper": filter_step("upper", "tr", ["a-z", "A-Z"], ".raw", ".up"),
+        "rev": filter_step("rev", "rev", [], ".up", ".rev"),
+        "copy": Step("copy", "cp", [
+            PositionalArgument(InputConnector(".up")),
+            PositionalArgument(OutputConnector(".copy")),
+        ]),
+    }
+
+def chain(keep_raw=True, keep_up=True):
+    w = Workflow("chain", registry())
+    w.connect("cat", ".raw", "upper", ".raw", keep=keep_raw)
+    w.connect("upper", ".up", "rev", ".up", keep=keep_up)
+    return w
+
+@pytest.fixture
+def source(tmp_path):
+    fp = tmp_path / "s1.txt"
+    fp.write_text("".join(f"line {i}\n" for i in range(100000)))
+    return WorkflowFile(tmp_path, "s1", ".txt")
+
+def test_fuse_pipes():
+    dag, units = fuse_pipes(chain())
+    assert units == {"cat": ("cat", "upper", "rev")}
+    assert dag == {"cat": set()}
+
+    # upper's stdout is also read from its file, so rev can't be piped
+    w = chain()
+    w.connect("upper", ".up", "copy", ".up")
+    dag, units = fuse_pipes(w)
+    assert units == {"cat": ("cat", "upper"), "rev": ("rev",), "copy": ("copy",)}
+    assert dag == {"cat": set(), "rev": {"cat"}, "copy": {"cat"}}
+
+def test_transient_connections():
+    w = Workflow("w", registry())
+    with pytest.raises(WorkflowError):
+        w.connect("upper", ".up", "copy", ".up", keep=False)
+    w = chain(keep_up=False)
+    assert w.transient == {("rev", ".up")}
+    w.connect("upper", ".up", "copy", ".up")
+    with pytest.raises(WorkflowError):
+        fuse_pipes(w)
+
+@pytest.mark.parametrize("runner_cls", [LocalRunner, AsyncRunner])
+def test_runner_pipes_steps(tmp_path, source, runner_cls):
+    runner = runner_cls(tmp_path / "work", pipes=True)
+    runner.run(chain(keep_raw=False), {("cat", ".txt"): source})
+    work = tmp_path / "work"
+    lines = source.path.read_text().splitlines()
+    assert not (work / "cat" / "s1.raw").exists()
+    assert (work / "upper" / "s1.up").read_text().splitlines() == \
+        [line.upper() for line in lines]
+    assert (work / "rev" / "s1.rev").read_text().splitlines() == \
+        [line.upper()[::-1] for line in lines]
+
+def test_pipeline_reports_last_failure(tmp_path, source):
+    reg = registry()
+    reg["rev"] = filter_step("rev", "false", [], ".up", ".rev")
+    w = Workflow("chain", reg)
+    w.connect("cat", ".raw", "upper", ".raw", keep=False)
+    w.connect("upper", ".up", "rev", ".up", keep=False)
+    runner = LocalRunner(tmp_path / "work", pipes=True)
+    with pytest.raises(CommandFailed) as excinfo:
+        runner.run(w, {("cat", ".txt"): source})
+    assert excinfo.value.step_name == "rev"
+
+def test_runner_without_pipes_uses_files(tmp_path, source):
+    runner = LocalRunner(tmp_path / "work")
+    runner.run(chain(keep_raw=False), {("cat", ".txt"): source})
+    work = tmp_path / "work"
+    assert (work / "cat" / "s1.raw").read_text() == source.path.read_text()
+    assert (work / "rev" / "s1.rev").exists()
+
+def test_run_targets_prunes_pipelines(tmp_path, source):
+    w = chain(keep_raw=False)
+    w.connect("upper", ".up", "copy", ".up")
+    samples = [Sample("s1", {("cat", ".txt"): source})]
+    runner = LocalRunner(tmp_path / "work", pipes=True)
+    ran = runner.run_targets(w, samples, [("copy", ".copy")])
+    assert set(ran["s1"]) == {"cat", "upper", "copy"}
+    # cat | upper never writes .raw, yet counts as up to date
+    assert runner.run_targets(w, samples, [("copy", ".copy")]) == {"s1": {}}
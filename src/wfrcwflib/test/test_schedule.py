@@ -0,0 +1,86 @@
+import pytest
+from wfrcwflib.schedule import Scheduler
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, PositionalArgument, CPUS,
+    Step, Workflow,
+)
+from wfrcwflib.matrix import SampleMatrix, gather_samples
+from wfrcwflib.command import LocalRunner, AsyncRunner
+
+def test_scheduler_packs_by_priority():
+    s = Scheduler(cpus=8, memory=100)
+    s.prepare({"a": set(), "b": {"a"}, "c": set()})
+    s.push("c1", "c", 2)
+    s.push("a1", "a", 6, 50)
+    s.push("a2", "a", 6)
+    s.push("c2", "c", 1, 60)
+    # a is on the longer path; a2 doesn't fit beside a1, c2 is out of memory
+    assert s.pop() == ["a1", "c1"]
+    assert s.used_cpus == 8
+    assert s.pop() == []
+    s.release("a1")
+    assert s.pop() == ["a2"]
+    s.release("c1")
+    assert s.pop() == ["c2"]
+    with pytest.raises(ValueError):
+        s.push("big", "a", 9)
+
+def test_scheduler_holds_unhashable_items():
+    # Runners push batches, which are lists; equal ones are still separate
+    s = Scheduler(cpus=4, memory=0)
+    first, second = ["job"], ["job"]
+    s.push(first, "x", 1)
+    s.push(second, "x", 2)
+    assert s.pop() == [first, second]
+    s.release(second)
+    assert s.used_cpus == 1
+    with pytest.raises(KeyError):
+        s.release(second)
+    s.release(first)
+    assert s.used_cpus == 0
+
+def test_scheduler_stops_backfilling():
+    s = Scheduler(cpus=4, memory=0, backfill_limit=2)
+    s.push("small0", "x", 1)
+    assert s.pop() == ["small0"]
+    s.push("big", "x", 4)
+    launched = []
+    for i in range(1, 5):
+        s.push(f"small{i}", "x", 1)
+        launched.extend(s.pop())
+    # The big job waits through two rounds of backfilling, then holds the rest
+    assert launched == ["small1", "small2"]
+    for item in ["small0"] + launched:
+        s.release(item)
+    assert s.pop() == ["big"]
+
+def threaded_step(cpus):
+    # Writes its thread count, as passed through { cpus }, to its output
+    step = Step("count", "sh", [
+        PositionalArgument("-c"),
+        PositionalArgument('sleep 0.05; echo "$1" > "$2"'),
+        PositionalArgument("sh"),
+        PositionalArgument(CPUS),
+        PositionalArgument(OutputConnector(".n")),
+        PositionalArgument(InputConnector(".txt")),
+    ], cpus=cpus)
+    return step
+
+@pytest.mark.parametrize("runner_cls", [LocalRunner, AsyncRunner])
+def test_runner_never_oversubscribes(tmp_path, runner_cls):
+    w = Workflow("count", {"count": threaded_step(3)})
+    w._add_step("count")
+    files = []
+    for i in range(6):
+        fp = tmp_path / f"s{i}.txt"
+        fp.touch()
+        files.append(fp)
+    scheduler = Scheduler(cpus=7, memory=0)
+    runner = runner_cls(tmp_path / "work", max_jobs=6, scheduler=scheduler)
+    runner.run_matrix(SampleMatrix(w, gather_samples(w, files)))
+    for i in range(6):
+        assert (tmp_path / "work" / "count" / f"s{i}.n").read_text() == "3\n"
+    report = scheduler.report()
+    assert report["jobs"] == 6
+    assert report["peak_cpus"] == 6
+    assert 0 < report["cpu_utilisation"] <= 6 / 7
@@ -0,0 +1,93 @@
+import errno
+import hashlib
+import os
+import pytest
+from wfrcwflib.workflow import WorkflowFile
+from wfrcwflib import stage
+from wfrcwflib.stage import Stager, mmap_digest, is_staged
+
+@pytest.mark.parametrize("size", [0, 1, 1000, 5000])
+def test_mmap_digest(tmp_path, size):
+    fp = tmp_path / "f"
+    data = os.urandom(size)
+    fp.write_bytes(data)
+    assert mmap_digest(fp, chunk_size=1024) == hashlib.sha256(data).hexdigest()
+
+@pytest.fixture
+def sources(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    files = []
+    for i in range(3):
+        (src / f"s{i}.fastq").write_bytes(os.urandom(10000 * (i + 1)))
+        files.append(WorkflowFile(src, f"s{i}", ".fastq"))
+    return files
+
+def test_stage_hardlinks(tmp_path, sources):
+    stager = Stager(tmp_path / "staged")
+    staged = stager.stage(sources)
+    assert [f.dir for f in staged] == [tmp_path / "staged"] * 3
+    for src, dest in zip(sources, staged):
+        assert os.path.samefile(src.path, dest.path)
+    assert stager.staged.methods == {"hardlink": 3}
+    assert stager.staged.bytes == 60000
+
+    # Already staged files are left alone
+    stager.stage(sources)
+    assert stager.staged.methods["skipped"] == 3
+    assert stager.staged.bytes == 60000
+
+def test_stage_copies(tmp_path, sources):
+    stager = Stager(tmp_path / "staged", methods=("reflink", "copy"))
+    staged = stager.stage(sources)
+    for src, dest in zip(sources, staged):
+        assert dest.path.read_bytes() == src.path.read_bytes()
+        assert not os.path.samefile(src.path, dest.path)
+        assert is_staged(src.path, dest.path)
+    assert sum(stager.staged.methods.values()) == 3
+    assert set(stager.staged.methods) <= {"reflink", "copy"}
+    assert stager.report()["staged_mb_per_second"] > 0
+
+    # A changed source is staged again
+    sources[0].path.write_bytes(b"changed")
+    stager.stage(sources[:1])
+    assert staged[0].path.read_bytes() == b"changed"
+
+@pytest.mark.parametrize("err", [errno.EMLINK, errno.EPERM])
+def test_stage_per_file_failure(tmp_path, sources, monkeypatch, err):
+    # A file that can't be linked doesn't stop the others being linked
+    def link(src, dest):
+        if os.path.basename(src) == "s0.fastq":
+            raise OSError(err, os.strerror(err), src)
+        os.link(src, dest)
+    monkeypatch.setitem(stage.stage_methods, "hardlink", link)
+    stager = Stager(tmp_path / "staged", methods=("hardlink", "copy"),
+                    max_workers=1)
+    stager.stage(sources)
+    assert stager.staged.methods == {"copy": 1, "hardlink": 2}
+
+def test_stage_device_failure(tmp_path, sources, monkeypatch):
+    # Links that fail across filesystems aren't tried again
+    calls = []
+    def link(src, dest):
+        calls.append(src)
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src)
+    monkeypatch.setitem(stage.stage_methods, "hardlink", link)
+    stager = Stager(tmp_path / "staged", methods=("hardlink", "copy"),
+                    max_workers=1)
+    stager.stage(sources)
+    assert stager.staged.methods == {"copy": 3}
+    assert len(calls) == 1
+
+def test_stage_digest(tmp_path, sources):
+    stager = Stager(tmp_path / "staged")
+    paths = [f.path for f in sources]
+    digests = stager.digest(paths)
+    assert digests == {
+        p: hashlib.sha256(p.read_bytes()).hexdigest() for p in paths
+    }
+    assert stager.hashed.files == 3 and stager.hashed.bytes == 60000
+
+def test_stage_unknown_method(tmp_path):
+    with pytest.raises(ValueError):
+        Stager(tmp_path, methods=("teleport",))
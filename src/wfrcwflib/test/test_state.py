@@ -0,0 +1,141 @@
+import io
+import pytest
+from wfrcwflib.state import (
+    ParseError, WFSM, tokenize,
+    WORD, FLAG, LBRACE, RBRACE, NEWLINE, BLANK, EOF, BAD,
+)
+from wfrcwflib.parse import parse, parse_paragraphs
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector, CPUS,
+    PositionalArgument, OptionalArgument,
+    Step, UnresolvedWorkflow,
+)
+
+library = """\
+step blastn-mydb  # search
+  blastn
+  -query { input .fasta }
+  -db myblastdb
+  -out { output .tsv }
+  -evalue 1e-5 -5
+
+# copy results
+step copy
+  cp
+  { input .tsv }
+  { output .txt }
+
+workflow blast-and-copy
+  blastn-mydb .tsv --> copy .tsv
+"""
+
+expected = [
+    Step("blastn-mydb", "blastn", [
+        OptionalArgument("-query", [InputConnector(".fasta")]),
+        OptionalArgument("-db", ["myblastdb"]),
+        OptionalArgument("-out", [OutputConnector(".tsv")]),
+        OptionalArgument("-evalue", ["1e-5", "-5"]),
+    ]),
+    Step("copy", "cp", [
+        PositionalArgument(InputConnector(".tsv")),
+        PositionalArgument(OutputConnector(".txt")),
+    ]),
+    UnresolvedWorkflow("blast-and-copy", [
+        ("blastn-mydb", ".tsv", "copy", ".tsv"),
+    ]),
+]
+
+def test_tokenize():
+    assert list(tokenize(["step a # note", "", "  -f { input .x }"])) == [
+        (WORD, "step", 1, 1),
+        (WORD, "a", 1, 6),
+        (NEWLINE, "", 1, 7),
+        (BLANK, "", 2, 1),
+        (FLAG, "-f", 3, 3),
+        (LBRACE, "{", 3, 6),
+        (WORD, "input", 3, 8),
+        (WORD, ".x", 3, 14),
+        (RBRACE, "}", 3, 17),
+        (NEWLINE, "", 3, 18),
+        (EOF, "", 4, 1),
+    ]
+    assert list(tokenize(["{input"]))[0] == (BAD, "{input", 1, 1)
+
+def test_parse_file_object():
+    assert list(parse(io.StringIO(library))) == expected
+
+def test_parse_matches_line_splitting_parser():
+    lines = library.splitlines()
+    assert list(parse(lines)) == list(parse_paragraphs(lines))
+
+def test_parse_resources():
+    text = "step bwa cpus=16 memory=8000\n  bwa\n  mem\n  -t { cpus }\n"
+    step, = parse(io.StringIO(text))
+    assert step == Step("bwa", "bwa", [
+        PositionalArgument("mem"),
+        OptionalArgument("-t", [CPUS]),
+    ], cpus=16, memory=8000)
+    assert step.template.argv == ("bwa", "mem", "-t", "16")
+    assert list(parse_paragraphs(text.splitlines())) == [step]
+    with pytest.raises(ParseError, match="unknown resource 'threads'"):
+        list(parse_paragraphs(["step a threads=2", "cp"]))
+
+@pytest.mark.parametrize("text, line, col, msg", [
+    ("stp a\n  cp\n", 1, 1, "invalid keyword"),
+    ("step a b\n  cp\n", 1, 8, "name must appear by itself"),
+    ("step a threads=2\n  cp\n", 1, 8, "unknown resource 'threads'"),
+    ("step a cpus=two\n  cp\n", 1, 8, "cpus must be a whole number"),
+    ("step a\n  cp x\n", 2, 6, "prog must appear by itself"),
+    ("step a\n  cp\n  x y\n", 3, 5, "only one positional argument per line"),
+    ("step a\n  cp\n  { in .x }\n", 3, 5, "invalid connector type"),
+    ("step a\n  cp\n  {input .x}\n", 3, 3, "expected an argument"),
+    ("step a\n  cp\n  { input .x\n", 3, 13, "connector must end with ' }'"),
+    ("step a\n\n", 2, 1, "expected a prog"),
+    ("workflow w\n  a .x --> b .x c\n", 2, 17, "too many tokens in connection"),
+])
+def test_parse_errors(text, line, col, msg):
+    with pytest.raises(ParseError) as excinfo:
+        list(parse(io.StringIO(text)))
+    assert (excinfo.value.line, excinfo.value.col) == (line, col)
+    assert str(excinfo.value) == f"line {line}, column {col}: {msg}"
+
+def test_machine_yields_each_paragraph_when_complete():
+    m = WFSM()
+    objs = m.parse(library.splitlines())
+    assert next(objs).name == "blastn-mydb"
+    # The second step is only complete once the blank line after it is seen
+    assert m.state == "start"
+
+def generated_workflow(n):
+    yield "workflow generated"
+    for i in range(n):
+        yield f"  s{i % 3} .out --> s{i % 3 + 1} .in"
+    yield ""
+    yield "step after"
+    yield "  true"
+
+def test_parse_stream_connections():
+    objs = parse(generated_workflow(5), stream=True)
+    w = next(objs)
+    assert w.name == "generated"
+    assert next(w.connections) == ("s0", ".out", "s1", ".in")
+    # Moving on to the next object skips the rest of the connections
+    assert next(objs) == Step("after", "true")
+    assert list(w.connections) == []
+
+def test_parse_stream_resolve_memory():
+    import tracemalloc
+    registry = {
+        f"s{i}": Step(f"s{i}", "cat", [
+            PositionalArgument(InputConnector(".in")),
+            PositionalArgument(OutputConnector(".out")),
+        ])
+        for i in range(4)
+    }
+    tracemalloc.start()
+    w = next(parse(generated_workflow(20_000), stream=True))
+    resolved = w.resolve(registry)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert resolved.order == ["s0", "s1", "s2", "s3"]
+    assert peak < 500_000
@@ -0,0 +1,34 @@
+from wfrcwflib import tracing
+from wfrcwflib.workflow import (
+    InputConnector, OutputConnector,
+    PositionalArgument,
+    Step, UnresolvedWorkflow,
+)
+
+registry = {
+    "a": Step("a", "cp", [
+        PositionalArgument(InputConnector(".txt")),
+        PositionalArgument(OutputConnector(".b")),
+    ]),
+    "b": Step("b", "cp", [
+        PositionalArgument(InputConnector(".b")),
+        PositionalArgument(OutputConnector(".c")),
+    ]),
+}
+
+def test_tracing_disabled_by_default():
+    assert tracing.get_tracer() is None
+    assert tracing.span("anything", x=1) is tracing.span("else")
+
+def test_timing_tracer_records_spans():
+    uw = UnresolvedWorkflow("ab", [("a", ".b", "b", ".b")])
+    with tracing.enabled(tracing.TimingTracer()) as tracer:
+        w = uw.resolve(registry)
+        w.order
+        w.order
+    assert tracing.get_tracer() is None
+    assert [s.name for s in tracer.spans] == \
+        ["workflow.resolve", "workflow.order"]
+    assert tracer.spans[0].attrs == {"workflow": "ab"}
+    assert tracer.spans[0].duration >= 0
+    assert tracer.totals()["workflow.order"][0] == 1
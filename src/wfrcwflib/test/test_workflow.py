@@ -1,8 +1,11 @@
 import pytest
+from pathlib import Path
 from wfrcwflib.workflow import (
-    InputConnector, OutputConnector,
+    InputConnector, OutputConnector, InputPrefixConnector,
     PositionalArgument, OptionalArgument,
-    Step, Workflow,
+    Step, Workflow, WorkflowError,
+    WorkflowFile, RunnableCommand, path_str,
+    FileSpace, CommandSpace,
 )
 
 # Positional arguments
@@ -133,3 +136,179 @@ def test_workflow_blast_copy():
     assert list(w.inputs) == [("blast-nt", ".fasta")]
     assert list(w.outputs) == [("copy-blastout", ".tsv")]
     assert w.order == ["blast-nt", "copy-blastout"]
+
+def diamond_registry():
+    def step(name, inputs, outputs):
+        args = [PositionalArgument(InputConnector(x)) for x in inputs]
+        args += [PositionalArgument(OutputConnector(x)) for x in outputs]
+        return Step(name=name, prog="cat", args=args)
+    return {
+        "top": step("top", [".in"], [".a"]),
+        "left": step("left", [".a"], [".b"]),
+        "right": step("right", [".a"], [".c"]),
+        "bottom": step("bottom", [".b", ".c"], [".d"]),
+    }
+
+def test_workflow_reconnect_updates_indexes():
+    w = Workflow(name="diamond", registry=diamond_registry())
+    w.connect("top", ".a", "left", ".a")
+    w.connect("left", ".b", "bottom", ".b")
+    w.connect("left", ".b", "bottom", ".c")
+    assert w.dag["bottom"] == {"left"}
+    assert list(w.outputs) == [("bottom", ".d")]
+
+    # Moving one of two connections between the same steps keeps the edge
+    w.connect("right", ".c", "bottom", ".c")
+    assert w.dag["bottom"] == {"left", "right"}
+    assert w.connections_out[("left", ".b")] == [("bottom", ".b")]
+    assert w.connections_out[("right", ".c")] == [("bottom", ".c")]
+    assert list(w.inputs) == [("top", ".in"), ("right", ".a")]
+
+    # Moving the last one drops it
+    w.connect("right", ".c", "bottom", ".b")
+    assert w.dag["bottom"] == {"right"}
+    assert list(w.outputs) == [("bottom", ".d"), ("left", ".b")]
+    assert w.order.index("right") < w.order.index("bottom")
+
+def test_workflow_freeze():
+    w = Workflow(name="diamond", registry=diamond_registry())
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    w.connect("left", ".b", "bottom", ".b")
+    w.connect("right", ".c", "bottom", ".c")
+    order = w.order
+    assert w.freeze() is w
+    assert w.frozen
+    assert w.order == order
+    assert w.connections_out[("top", ".a")] == \
+        (("left", ".a"), ("right", ".a"))
+    assert w.dag["bottom"] == frozenset({"left", "right"})
+    assert list(w.inputs) == [("top", ".in")]
+    assert list(w.outputs) == [("bottom", ".d")]
+    with pytest.raises(WorkflowError):
+        w.connect("top", ".a", "bottom", ".b")
+    with pytest.raises(TypeError):
+        w.connections_in[("top", ".in")] = ("left", ".b")
+
+# Compact representation
+
+def test_connectors_are_shared_and_hashable():
+    c = InputConnector.shared(".fastq")
+    assert c is InputConnector.shared(".fastq")
+    assert c == InputConnector(".fastq")
+    assert c != OutputConnector(".fastq")
+    assert OutputConnector.shared(".fastq") is not c
+    assert len({c, InputConnector(".fastq")}) == 1
+    assert not hasattr(c, "__dict__")
+    with pytest.raises(AttributeError):
+        c.ext = ".fq"
+
+def test_connector_ext_is_interned():
+    ext = "".join([".fa", "stq"])
+    assert InputConnector(ext).ext is InputConnector(".fastq").ext
+
+def test_arguments_are_immutable():
+    a = OptionalArgument(flag="-k", values=["3"])
+    assert a.values == ("3",)
+    assert hash(a) == hash(OptionalArgument("-k", ("3",)))
+    assert not hasattr(a, "__dict__")
+    assert not hasattr(PositionalArgument("x"), "__dict__")
+    assert not hasattr(Step("s", "cp"), "__dict__")
+
+# Commands
+
+def reference_command_args(cmd):
+    # The original per-value walk over step.iterargs()
+    res = []
+    if cmd.conda_env is not None:
+        res += ["conda", "run", "-n", cmd.conda_env]
+    output_files = dict(cmd.output_files)
+    for x in cmd.step.iterargs():
+        if isinstance(x, InputConnector):
+            res.append(str(cmd.input_files[x.ext].path))
+        elif isinstance(x, OutputConnector):
+            res.append(str(output_files[x.ext].path))
+        else:
+            res.append(x)
+    return res
+
+def test_command_args_template():
+    s = Step("bwa-align", "bwa", [
+        PositionalArgument("mem"),
+        OptionalArgument("-t", ["4"]),
+        PositionalArgument(InputPrefixConnector(".bwt")),
+        PositionalArgument(InputConnector("_R1.fastq")),
+        PositionalArgument(InputConnector("_R2.fastq")),
+        OptionalArgument("-o", [OutputConnector(".sam")]),
+    ])
+    inputs = {
+        ".bwt": WorkflowFile(Path("ref"), "phix", ".bwt"),
+        "_R1.fastq": WorkflowFile(Path("in"), "s1", "_R1.fastq"),
+        "_R2.fastq": WorkflowFile(Path("in"), "s1", "_R2.fastq"),
+    }
+    cmd = RunnableCommand(s, Path("out"), inputs)
+    assert s.template.argv == \
+        ("bwa", "mem", "-t", "4", None, None, None, "-o", None)
+    assert cmd.command_args() == reference_command_args(cmd) == [
+        "bwa", "mem", "-t", "4", "ref/phix.bwt", "in/s1_R1.fastq",
+        "in/s1_R2.fastq", "-o", "out/phix__s1.sam",
+    ]
+    cmd = RunnableCommand(s, Path("out"), inputs, conda_env="bwa")
+    assert cmd.command_args() == reference_command_args(cmd)
+    assert cmd.command_args()[:4] == ["conda", "run", "-n", "bwa"]
+
+@pytest.mark.parametrize("dir", [
+    Path("."), Path("/"), Path("a/b"), Path("/x/"), Path("./y"), "z//w/",
+])
+def test_path_str(dir):
+    assert path_str(dir, "f.txt") == str(Path(dir) / "f.txt")
+    assert path_str(dir, "g/f.txt") == str(Path(dir) / "g/f.txt")
+
+def diamond_workflow():
+    w = Workflow(name="diamond", registry=diamond_registry())
+    w.connect("top", ".a", "left", ".a")
+    w.connect("top", ".a", "right", ".a")
+    w.connect("left", ".b", "bottom", ".b")
+    w.connect("right", ".c", "bottom", ".c")
+    return w
+
+def test_file_space():
+    w = diamond_workflow()
+    source = WorkflowFile(Path("in"), "s1", ".in")
+    files = FileSpace(w, Path("work"), Path("out"), {("top", ".in"): source})
+    assert files.inputs[("top", ".in")] is source
+    assert files.outputs[("left", ".b")] == WorkflowFile(Path("work/left"), "s1", ".b")
+    # Nothing reads bottom's output, so it goes to output_dir
+    assert files.outputs[("bottom", ".d")] == WorkflowFile(Path("out/bottom"), "s1", ".d")
+    assert files.input_files("bottom") == {
+        ".b": files.outputs[("left", ".b")],
+        ".c": files.outputs[("right", ".c")],
+    }
+    assert files.producer(Path("work/top/s1.a")) == ("top", ".a")
+    assert files.producer("in/s1.in") is None
+    assert files.dependents(Path("work/top/s1.a")) == [("left", ".a"), ("right", ".a")]
+
+    cmd = files.command("bottom", conda_env="env")
+    assert cmd.command_args(conda_run=False) == [
+        "cat", "work/left/s1.b", "work/right/s1.c", "out/bottom/s1.d",
+    ]
+    assert cmd.conda_env == "env"
+
+def test_file_space_missing_source():
+    with pytest.raises(WorkflowError):
+        FileSpace(diamond_workflow(), Path("work"))
+
+def test_command_space():
+    space = CommandSpace(diamond_workflow(), Path("work"))
+    for name in ["s1", "s2"]:
+        space.add(name, {("top", ".in"): WorkflowFile(Path("in"), name, ".in")})
+    assert len(space) == 2
+    assert space.producer(Path("work/right/s2.c")) == ("s2", "right", ".c")
+    assert space.dependents("in/s2.in") == [("s2", "top", ".in")]
+    assert space.command("s1", "left").command_args() == [
+        "cat", "work/top/s1.a", "work/left/s1.b",
+    ]
+    with pytest.raises(WorkflowError):
+        space.add("s1", {("top", ".in"): WorkflowFile(Path("in"), "s3", ".in")})
+    assert space.dependents("in/s1.in") == [("s1", "top", ".in")]
+    assert space.dependents("in/s3.in") == []
@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+from typing import Protocol
+import collections
+import contextlib
+import threading
+import time
+
+# Instrumented code calls span(); with no tracer installed this returns a
+# shared no-op context manager, so tracing is free unless switched on.
+_tracer = None
+_null_span = contextlib.nullcontext()
+
+
+def span(name, **attrs):
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, attrs)
+
+
+def get_tracer():
+    return _tracer
+
+
+def set_tracer(tracer):
+    global _tracer
+    previous = _tracer
+    _tracer = tracer
+    return previous
+
+
+@contextlib.contextmanager
+def enabled(tracer):
+    previous = set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+
+
+class Tracer(Protocol):
+    # Anything with span(name, attrs) returning a context manager
+    def span(self, name, attrs): ...
+
+
+@dataclass
+class Span:
+    name: str
+    attrs: dict
+    start: float
+    end: float | None = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class TimingTracer(Tracer):
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, attrs):
+        s = Span(name, attrs, time.perf_counter())
+        try:
+            yield s
+        finally:
+            s.end = time.perf_counter()
+            with self._lock:
+                self.spans.append(s)
+
+    def totals(self):
+        res = collections.defaultdict(lambda: [0, 0.0])
+        for s in self.spans:
+            res[s.name][0] += 1
+            res[s.name][1] += s.duration
+        return {k: tuple(v) for k, v in res.items()}
@@ -1,33 +1,71 @@
 from dataclasses import dataclass, field
 from typing import Optional
-from pathlib import Path
+from pathlib import Path, PurePath
+from types import MappingProxyType
+import collections
+import contextlib
+import functools
 import graphlib
+import os
 import subprocess
+import sys
+import time
 
+from wfrcwflib import tracing
+from wfrcwflib.cache import file_digest
+from wfrcwflib.history import Metrics, wait_with_metrics
 
-@dataclass
+
+# Connectors and arguments are immutable and slotted: per-sample jobs share
+# them by the thousand, so they carry no __dict__ and can be hashed.
+_shared_connectors = {}
+
+@dataclass(frozen=True, slots=True)
 class Connector:
     ext: str
 
+    def __post_init__(self):
+        object.__setattr__(self, "ext", sys.intern(self.ext))
+
+    @classmethod
+    def shared(cls, ext):
+        key = (cls, ext)
+        try:
+            return _shared_connectors[key]
+        except KeyError:
+            c = _shared_connectors[key] = cls(ext)
+            return c
+
 class InputConnector(Connector):
-    pass
+    __slots__ = ()
 
 class OutputConnector(Connector):
-    pass
+    __slots__ = ()
 
 class OutputPrefixConnector(OutputConnector):
-    pass
+    __slots__ = ()
 
 class InputPrefixConnector(InputConnector):
-    pass
+    __slots__ = ()
 
 class StdoutConnector(OutputConnector):
-    pass
+    __slots__ = ()
 
 class OutputStdoutConnector(OutputConnector):
-    pass
+    __slots__ = ()
 
-@dataclass
+class StdinConnector(InputConnector):
+    __slots__ = ()
+
+@dataclass(frozen=True, slots=True)
+class Placeholder:
+    # Stands in an argument for the step attribute it names, e.g. { cpus }
+    name: str
+
+CPUS = Placeholder("cpus")
+placeholders = {CPUS.name: CPUS}
+
+@dataclass(frozen=True, slots=True)
 class PositionalArgument:
     value: str | Connector
 
@@ -45,10 +83,13 @@ class PositionalArgument:
         yield self.value
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class OptionalArgument:
     flag: str
-    values: list[str | Connector] = field(default_factory=list)
+    values: tuple[str | Connector, ...] = ()
+
+    def __post_init__(self):
+        object.__setattr__(self, "values", tuple(self.values))
 
     @property
     def inputs(self):
@@ -68,18 +109,26 @@ class OptionalArgument:
             yield value
 
 
-@dataclass
+@dataclass(slots=True)
 class Step:
     name: str
     prog: str
     args: list[PositionalArgument | OptionalArgument] = field(default_factory=list)
     stdout: StdoutConnector | None = None
+    stdin: StdinConnector | None = None
+    # Resources the scheduler reserves while the step runs; memory in MB
+    cpus: int = 1
+    memory: int = 0
+    _template: "ArgvTemplate | None" = field(
+        default=None, init=False, repr=False, compare=False)
 
     @property
     def inputs(self):
         for arg in self.args:
             for input in arg.inputs:
                 yield input
+        if self.stdin is not None:
+            yield self.stdin
 
     @property
     def outputs(self):
@@ -95,6 +144,51 @@ class Step:
             for value in arg.itervals():
                 yield value
 
+    @property
+    def template(self):
+        # Compiled on first use, so finish building a step before running it
+        if self._template is None:
+            self._template = ArgvTemplate.compile(self)
+        return self._template
+
+
+@dataclass(frozen=True, slots=True)
+class ArgvTemplate:
+    # Literal argv with None in each hole, plus (index, ext) for every
+    # input and output hole
+    argv: tuple[str | None, ...]
+    input_slots: tuple[tuple[int, str], ...]
+    output_slots: tuple[tuple[int, str], ...]
+    # Extensions of step.inputs, in order, for naming outputs
+    input_exts: tuple[str, ...]
+
+    @classmethod
+    def compile(cls, step):
+        argv = []
+        input_slots = []
+        output_slots = []
+        for i, x in enumerate(step.iterargs()):
+            if isinstance(x, InputConnector):
+                input_slots.append((i, x.ext))
+                x = None
+            elif isinstance(x, OutputConnector):
+                output_slots.append((i, x.ext))
+                x = None
+            elif isinstance(x, Placeholder):
+                x = str(getattr(step, x.name))
+            argv.append(x)
+        input_exts = tuple(x.ext for x in step.inputs)
+        return cls(
+            tuple(argv), tuple(input_slots), tuple(output_slots), input_exts)
+
+    def render(self, input_paths, output_paths):
+        argv = list(self.argv)
+        for i, ext in self.input_slots:
+            argv[i] = input_paths[ext]
+        for i, ext in self.output_slots:
+            argv[i] = output_paths[ext]
+        return argv
+
 
 @dataclass
 class UnresolvedWorkflow:
@@ -102,72 +196,151 @@ class UnresolvedWorkflow:
     connections: list[tuple[str, str, str, str]] = field(default_factory=list)
 
     def resolve(self, registry):
-        w = Workflow(self.name, registry)
-        for args in self.connections:
-            w.connect(*args)
+        with tracing.span("workflow.resolve", workflow=self.name):
+            w = Workflow(self.name, registry)
+            for args in self.connections:
+                w.connect(*args)
         return w
 
 
+class WorkflowError(Exception):
+    pass
+
+
 class Workflow:
     def __init__(self, name, registry):
         self.name = name
         self.registry = registry
-        self._active_steps = set()
+        self._active_steps = {}
+        self._frozen = False
         # Reverse directed graph
         # (step2, input) => (step1, output)
         self.connections_in = {}
-
-    def connect(self, from_step, from_output, to_step, to_input):
+        # Forward directed graph, kept in step with connections_in
+        # (step1, output) => [(step2, input), ...]
+        self._connections_out = {}
+        # Unconnected inputs and outputs, as ordered sets
+        self._inputs = {}
+        self._outputs = {}
+        # Connections whose file need not be written when the runner pipes
+        # the two steps together, as (step2, input)
+        self._transient = set()
+        # step2 => {step1, ...}
+        self._dag = {}
+        # (step1, step2) => number of connections between them
+        self._edge_counts = collections.Counter()
+        self._order = None
+
+    def connect(self, from_step, from_output, to_step, to_input, keep=True):
+        if self._frozen:
+            raise WorkflowError(f"workflow {self.name} is frozen")
+        if not keep and not self.is_pipe(from_step, from_output, to_step, to_input):
+            raise WorkflowError(
+                f"connection {from_step} {from_output} --> {to_step} {to_input} "
+                f"is not stdout to stdin, so its file must be kept")
         self._add_step(from_step)
         self._add_step(to_step)
-        self.connections_in[(to_step, to_input)] = (from_step, from_output)
+        src = (from_step, from_output)
+        dest = (to_step, to_input)
+        consumers = self._connections_out[src]
+        old_src = self.connections_in.get(dest)
+        if old_src is not None:
+            self._disconnect(old_src, dest)
+        self.connections_in[dest] = src
+        self._inputs.pop(dest, None)
+        consumers.append(dest)
+        self._outputs.pop(src, None)
+        self._dag[to_step].add(from_step)
+        self._edge_counts[(from_step, to_step)] += 1
+        if not keep:
+            self._transient.add(dest)
+        self._order = None
+
+    def is_pipe(self, from_step, from_output, to_step, to_input):
+        stdout = self.registry[from_step].stdout
+        stdin = self.registry[to_step].stdin
+        return (
+            stdout is not None and stdout.ext == from_output and
+            stdin is not None and stdin.ext == to_input
+        )
+
+    def _disconnect(self, src, dest):
+        self._transient.discard(dest)
+        consumers = self._connections_out[src]
+        consumers.remove(dest)
+        if not consumers:
+            self._outputs[src] = None
+        edge = (src[0], dest[0])
+        self._edge_counts[edge] -= 1
+        # Keep the DAG edge while another connection still uses it
+        if not self._edge_counts[edge]:
+            del self._edge_counts[edge]
+            self._dag[dest[0]].discard(src[0])
 
     def _add_step(self, step_name):
         if step_name not in self._active_steps:
             step = self.registry[step_name]
             for input in step.inputs:
                 self.connections_in[(step.name, input.ext)] = None
-            self._active_steps.add(step.name)
+                self._inputs[(step.name, input.ext)] = None
+            for output in step.outputs:
+                self._connections_out[(step.name, output.ext)] = []
+                self._outputs[(step.name, output.ext)] = None
+            self._dag[step.name] = set()
+            self._active_steps[step.name] = None
+            self._order = None
+
+    def freeze(self):
+        # Lock the finished workflow into read-only tuples and mappings
+        if self._frozen:
+            return self
+        with tracing.span("workflow.freeze", workflow=self.name):
+            self._order = tuple(self._compute_order())
+            self.connections_in = MappingProxyType(self.connections_in)
+            self._connections_out = MappingProxyType(
+                {k: tuple(v) for k, v in self._connections_out.items()})
+            self._inputs = tuple(self._inputs)
+            self._outputs = tuple(self._outputs)
+            self._dag = MappingProxyType(
+                {k: frozenset(v) for k, v in self._dag.items()})
+            self._transient = frozenset(self._transient)
+            self._frozen = True
+        return self
+
+    @property
+    def frozen(self):
+        return self._frozen
 
     @property
     def connections_out(self):
-        res = {}
-        for step_name in self._active_steps:
-            step = self.registry[step_name]
-            for output in step.outputs:
-                res[(step.name, output.ext)] = []
-        for k, v in self.connections_in.items():
-            if v is not None:
-                res[v].append(k)
-        return res
+        return self._connections_out
 
     @property
     def inputs(self):
-        for k, v in self.connections_in.items():
-            if v is None:
-                yield k
+        return iter(self._inputs)
 
     @property
     def outputs(self):
-        for k, vs in self.connections_out.items():
-            if not vs:
-                yield k
+        return iter(self._outputs)
 
     @property
     def dag(self):
-        graph = {step: set() for step in self._active_steps}
-        for dest, src in self.connections_in.items():
-            print("Making DAG:", dest, src)
-            if src is not None:
-                src_step, _ = src
-                dest_step, _ = dest
-                graph[dest_step].add(src_step)
-        return graph
+        return self._dag
+
+    @property
+    def transient(self):
+        return self._transient
+
+    def _compute_order(self):
+        with tracing.span("workflow.order", workflow=self.name):
+            ts = graphlib.TopologicalSorter(self._dag)
+            return list(ts.static_order())
 
     @property
     def order(self):
-        ts = graphlib.TopologicalSorter(self.dag)
-        return list(ts.static_order())
+        if self._order is None:
+            self._order = self._compute_order()
+        return list(self._order)
 
     @property
     def edges(self):
@@ -201,45 +374,77 @@ class WorkflowFile:
     def open(self, mode):
         return open(self.filepath, mode)
 
+    def digest(self, index=None):
+        if index is None:
+            return file_digest(self.path)
+        return index.digest(self.path)
+
+
+def path_str(dir, filename):
+    # Same string as str(dir / filename) for a plain file name, without
+    # building an intermediate Path
+    if "/" in filename or not isinstance(dir, PurePath):
+        return str(Path(dir) / filename)
+    dir = str(dir)
+    if dir == ".":
+        return filename
+    if dir.endswith("/"):
+        return dir + filename
+    return dir + "/" + filename
 
 def unique_inorder(xs):
     return list(dict.fromkeys(xs))
 
+def output_basename_for(step, input_files):
+    # A step's outputs are named after its inputs, e.g. s1 or s1__s2
+    return "__".join(unique_inorder(
+        input_files[ext].basename for ext in step.template.input_exts))
+
 @dataclass
 class RunnableCommand:
     step: Step
     output_dir: Path
     input_files: dict[str, WorkflowFile] = field(default_factory=dict)
     conda_env: str | None = None
-
-    def command_args(self):
-        if self.conda_env is not None:
-            yield "conda"
-            yield "run"
-            yield "-n"
-            yield self.conda_env
-        output_files = dict(self.output_files)
-        for x in self.step.iterargs():
-            if isinstance(x, InputConnector):
-                infile = self.input_files[x.ext]
-                val = str(infile.path)
-            elif isinstance(x, OutputConnector):
-                outfile = output_files[x.ext]
-                val = str(outfile.path)
-            else:
-                val = x
-            yield val
-
-    def run(self):
-        args = list(self.command_args())
-        subprocess.run(args, stdout=self.stdout_fileobj)
-
-    @property
+    # Resource usage of the last run, where it ran in its own process
+    metrics: Metrics | None = field(default=None, repr=False, compare=False)
+
+    def command_args(self, conda_run=True):
+        template = self.step.template
+        input_files = self.input_files
+        input_paths = {
+            ext: path_str(input_files[ext].dir, input_files[ext].filename)
+            for _, ext in template.input_slots
+        }
+        output_dir = self.output_dir
+        basename = self.output_basename
+        output_paths = {
+            ext: path_str(output_dir, basename + ext)
+            for _, ext in template.output_slots
+        }
+        argv = template.render(input_paths, output_paths)
+        if self.conda_env is not None and conda_run:
+            argv[:0] = ["conda", "run", "-n", self.conda_env]
+        return argv
+
+    def run(self, environ=None):
+        # With an already activated environ, skip the `conda run` wrapper
+        args = self.command_args(conda_run=environ is None)
+        with tracing.span("command.run", step=self.step.name), \
+                self.open_stdin() as stdin, self.open_stdout() as stdout:
+            started = time.monotonic()
+            proc = subprocess.Popen(args, stdin=stdin, stdout=stdout, env=environ)
+            try:
+                returncode, self.metrics = wait_with_metrics(proc, started)
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+        return subprocess.CompletedProcess(args, returncode)
+
+    @functools.cached_property
     def output_basename(self):
-        input_files = [self.input_files[x.ext] for x in self.step.inputs]
-        basenames = [x.basename for x in input_files]
-        unique_basenames = unique_inorder(basenames)
-        return "__".join(unique_basenames)
+        return output_basename_for(self.step, self.input_files)
 
     @property
     def output_files(self):
@@ -247,22 +452,168 @@ class RunnableCommand:
             yield output.ext, WorkflowFile(self.output_dir, self.output_basename, output.ext)
 
     @property
-    def stdout_fileobj(self):
+    def stdout_path(self):
         if self.step.stdout is not None:
-            wf = WorkflowFile(self.output_dir, self.output_basename, self.step.stdout.ext)
-            return open(wf, "w")
+            return path_str(
+                self.output_dir, self.output_basename + self.step.stdout.ext)
+        return None
+
+    @property
+    def stdin_path(self):
+        if self.step.stdin is not None:
+            wf = self.input_files[self.step.stdin.ext]
+            return path_str(wf.dir, wf.filename)
         return None
 
+    def open_stdin(self):
+        if self.step.stdin is None:
+            return contextlib.nullcontext()
+        return open(self.stdin_path, "rb")
+
+    def open_stdout(self, buffering=-1):
+        # Context manager for the stdout target, closed when the block exits;
+        # steps without one get None, i.e. the parent's stdout
+        if self.step.stdout is None:
+            return contextlib.nullcontext()
+        return open(self.stdout_path, "wb", buffering=buffering)
+
+
+def resolution_plan(workflow):
+    # Where each step's inputs come from, in an order where every step comes
+    # after the steps it reads from: [(step name, step, [(input, src), ...],
+    # whether nothing reads the step's outputs)], where src is the upstream
+    # (step, output) or None for a source file. Worked out once per workflow
+    # and shared by every sample's FileSpace.
+    connections_in = workflow.connections_in
+    connections_out = workflow.connections_out
+    plan = []
+    for step_name in workflow.order:
+        step = workflow.registry[step_name]
+        inputs = [
+            (input.ext, connections_in[(step_name, input.ext)])
+            for input in step.inputs
+        ]
+        is_final = not any(
+            connections_out.get((step_name, output.ext))
+            for output in step.outputs)
+        plan.append((step_name, step, inputs, is_final))
+    return plan
+
 
 @dataclass
 class FileSpace:
+    # Every file one sample's run reads and writes, resolved up front so
+    # that a step's inputs, or a file's producer, is a dict lookup
     workflow: Workflow
     intermediate_dir: Path
-    output_dir: Path
+    # Outputs that no step reads are written under here, if given, rather
+    # than under intermediate_dir
+    output_dir: Path | None = None
     # Reverse directed graph
     # (step, input) => source
     sources: dict[tuple[str, str], WorkflowFile] = field(default_factory=dict)
+    plan: list | None = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.plan is None:
+            self.plan = resolution_plan(self.workflow)
+        # (step, input) => WorkflowFile, and likewise for outputs
+        self.inputs = {}
+        self.outputs = {}
+        self.step_dirs = {}
+        self._input_files = {}
+        self._steps = {}
+        for step_name, step, inputs, is_final in self.plan:
+            input_files = {}
+            for ext, src in inputs:
+                if src is None:
+                    wf = self.sources.get((step_name, ext))
+                    if wf is None:
+                        raise WorkflowError(f"no source file for {step_name} {ext}")
+                else:
+                    wf = self.outputs[src]
+                input_files[ext] = wf
+                self.inputs[(step_name, ext)] = wf
+            basename = output_basename_for(step, input_files)
+            if is_final and self.output_dir is not None:
+                step_dir = self.output_dir / step_name
+            else:
+                step_dir = self.intermediate_dir / step_name
+            for output in step.outputs:
+                self.outputs[(step_name, output.ext)] = WorkflowFile(
+                    step_dir, basename, output.ext)
+            self.step_dirs[step_name] = step_dir
+            self._input_files[step_name] = input_files
+            self._steps[step_name] = step
+        # path => (step, output) writing it, and path => [(step, input), ...]
+        # reading it, by absolute path
+        abspath = os.path.abspath
+        self.producers = {
+            abspath(path_str(wf.dir, wf.filename)): key
+            for key, wf in self.outputs.items()
+        }
+        self.consumers = collections.defaultdict(list)
+        for key, wf in self.inputs.items():
+            self.consumers[abspath(path_str(wf.dir, wf.filename))].append(key)
+
+    def input_files(self, step_name):
+        return dict(self._input_files[step_name])
+
+    def producer(self, path):
+        return self.producers.get(os.path.abspath(path))
+
+    def dependents(self, path):
+        return list(self.consumers.get(os.path.abspath(path), ()))
+
+    def command(self, step_name, conda_env=None):
+        return RunnableCommand(
+            self._steps[step_name], self.step_dirs[step_name],
+            self.input_files(step_name), conda_env)
 
 
 class CommandSpace:
-    pass
+    # FileSpaces for many samples of one workflow, sharing one resolution
+    # plan, with producer and consumer indexes across all of them that are
+    # keyed by path and lead back to (sample, step, ext)
+    def __init__(self, workflow, intermediate_dir, output_dir=None):
+        self.workflow = workflow
+        self.intermediate_dir = intermediate_dir
+        self.output_dir = output_dir
+        self.plan = resolution_plan(workflow)
+        # sample name => FileSpace
+        self.spaces = {}
+        self.producers = {}
+        self.consumers = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self.spaces)
+
+    def file_space(self, sources):
+        # A FileSpace that is not added to the indexes, for runners that
+        # only need one sample's files at a time
+        return FileSpace(
+            self.workflow, self.intermediate_dir, self.output_dir, sources,
+            self.plan)
+
+    def add(self, sample_name, sources):
+        # Each sample is added once; adding it again would leave its old
+        # files in the indexes alongside the new ones
+        if sample_name in self.spaces:
+            raise WorkflowError(f"sample {sample_name} is already added")
+        files = self.file_space(sources)
+        self.spaces[sample_name] = files
+        for path, (step_name, ext) in files.producers.items():
+            self.producers[path] = (sample_name, step_name, ext)
+        for path, keys in files.consumers.items():
+            self.consumers[path].extend(
+                (sample_name, step_name, ext) for step_name, ext in keys)
+        return files
+
+    def command(self, sample_name, step_name, conda_env=None):
+        return self.spaces[sample_name].command(step_name, conda_env)
+
+    def producer(self, path):
+        return self.producers.get(os.path.abspath(path))
+
+    def dependents(self, path):
+        return list(self.consumers.get(os.path.abspath(path), ()))